@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of maxcarrot, run them with:
+
+        python -m benchmarks --output results.json
+
+    and compare two runs with:
+
+        python -m benchmarks --compare baseline.json --output results.json
+"""
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    End to end benchmarks, against the rabbitmq vhost given as context,
+    a dict with the url and the transport, memory to run them in process.
+    All the exchanges and queues of the vhost are deleted on each repetition.
+"""
+from benchmarks.harness import benchmark
+from maxcarrot import RabbitClient
+
+USERS = 1000
+MESSAGES = 1000
+MEMBERS = 100
+
+
+def connect(context, **kwargs):
+    return RabbitClient(context['url'], transport=context['transport'], **kwargs)
+
+
+def server(context, usernames=[]):
+    """
+        Returns a client on an empty vhost with the global exchanges
+        and queues declared, and usernames provisioned
+    """
+    client = connect(context)
+    client.management.cleanup(delete_all=True)
+    client.declare()
+    if usernames:
+        client.provision_users(usernames)
+    return client
+
+
+def usernames(count):
+    return ['user{}'.format(num) for num in range(count)]
+
+
+class Session(object):
+    """
+        A server client and a user client in a conversation
+    """
+
+    def __init__(self, context):
+        self.server = server(context, ['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', ['sheldon', 'leonard'])
+        self.sheldon = connect(context, user='sheldon')
+        self.leonard = connect(context, user='leonard')
+
+    def close(self):
+        for client in [self.sheldon, self.leonard, self.server]:
+            client.disconnect()
+
+
+@benchmark('broker', number=1, repeat=3, items=MESSAGES, setup=Session, teardown=Session.close)
+def send_get_all(session):
+    for num in range(MESSAGES):
+        session.sheldon.conversations.send('conversation1', 'Hello')
+    received = session.leonard.get_all(retry=True, timeout=10, max_messages=MESSAGES)
+    assert len(received) == MESSAGES, 'Received {} of {} messages'.format(len(received), MESSAGES)
+
+
+@benchmark('broker', number=1, repeat=3, items=MESSAGES, setup=Session, teardown=Session.close)
+def send_many(session):
+    result = session.sheldon.conversations.send_many(('conversation1', 'Hello') for num in range(MESSAGES))
+    assert result['acked'] == MESSAGES, 'Confirmed {} of {} messages'.format(result['acked'], MESSAGES)
+
+
+@benchmark('broker', number=1, repeat=3, items=USERS, setup=server, teardown=RabbitClient.disconnect)
+def provision_users(client):
+    report = client.provision_users(usernames(USERS))
+    assert not report.failed_batches, report
+
+
+@benchmark('broker', number=1, repeat=3, items=MEMBERS, setup=server, teardown=RabbitClient.disconnect)
+def create_users(client):
+    client.create_users(usernames(MEMBERS))
+
+
+@benchmark('broker', number=1, repeat=3, items=MEMBERS,
+           setup=lambda context: server(context, usernames(MEMBERS)), teardown=RabbitClient.disconnect)
+def create_delete_conversation(client):
+    client.conversations.create('conversation1', usernames(MEMBERS))
+    client.conversations.delete('conversation1')
+
+
+@benchmark('broker', number=1, repeat=3, items=MEMBERS,
+           setup=lambda context: server(context, usernames(MEMBERS + 1)), teardown=RabbitClient.disconnect)
+def sync_conversation(client):
+    for members in [usernames(MEMBERS), usernames(MEMBERS + 1)[1:]]:
+        result = client.conversations.sync('conversation1', members)
+        assert not result['bound'].failed_batches, result['bound']
+        assert not result['unbound'].failed_batches, result['unbound']
+
+
+@benchmark('broker', number=1, repeat=3, items=USERS * 2,
+           setup=lambda context: server(context, usernames(USERS)), teardown=RabbitClient.disconnect)
+def cleanup(client):
+    client.management.cleanup(delete_all=True)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    Codec microbenchmarks, on the message shapes defined in specification.json
+"""
+from benchmarks.harness import benchmark
+from maxcarrot.message import CODEC
+from maxcarrot.message import RabbitMessage
+
+import json
+
+CONVERSATION_MESSAGE = {
+    'action': 'add',
+    'object': 'message',
+    'source': 'android',
+    'domain': 'demo',
+    'version': '4.0.0',
+    'destination': '5386f6b4c7a1d5276fe5c57e',
+    'uuid': 'a2c3d1c2-6f3e-11e4-9803-0800200c9a66',
+    'published': '2014-11-17T10:31:26.000Z',
+    'user': {'username': 'sheldon.cooper', 'displayname': 'Sheldon Cooper'},
+    'data': {'text': 'Bazinga! Have you seen the new episode of Fun with Flags?'}
+}
+
+ACK_MESSAGE = {
+    'action': 'ack',
+    'object': 'message',
+    'source': 'ios',
+    'destination': '5386f6b4c7a1d5276fe5c57e',
+    'uuid': 'a2c3d1c2-6f3e-11e4-9803-0800200c9a66',
+    'user': {'username': 'leonard.hofstadter'}
+}
+
+ACTIVITY_MESSAGE = {
+    'action': 'add',
+    'object': 'activity',
+    'source': 'max',
+    'domain': 'demo',
+    'destination': '90c8f28a7867fbad7a2359c6427ae8798a37ff07',
+    'published': '2014-11-17T10:31:26.000Z',
+    'user': {'username': 'penny', 'displayname': 'Penny'},
+    'data': {
+        'text': 'Bring a jacket, the Cheesecake Factory is cold',
+        'url': 'http://example.com/contexts/cheesecake-factory',
+        'tags': ['food', 'work']
+    }
+}
+
+TWEET_MESSAGE = {
+    'action': 'add',
+    'object': 'tweet',
+    'source': 'tweety',
+    'domain': 'demo',
+    'user': {'username': 'howard', 'displayname': 'Howard Wolowitz'},
+    'data': {'text': '#bigbang Going to space!', 'id': 534327813961502721}
+}
+
+SHAPES = {
+    'conversation': CONVERSATION_MESSAGE,
+    'ack': ACK_MESSAGE,
+    'activity': ACTIVITY_MESSAGE,
+    'tweet': TWEET_MESSAGE
+}
+
+
+def register(shape, message):
+    packed = RabbitMessage(message).packed
+    body = json.dumps(packed)
+
+    benchmark('codec', name='pack_{}'.format(shape), setup=lambda context: RabbitMessage(message))(
+        lambda state: state.packed)
+    benchmark('codec', name='unpack_dict_{}'.format(shape))(
+        lambda state: RabbitMessage.unpack(packed))
+    benchmark('codec', name='unpack_dict_nocopy_{}'.format(shape))(
+        lambda state: RabbitMessage.unpack(packed, copy=False))
+    benchmark('codec', name='unpack_str_{}'.format(shape))(
+        lambda state: RabbitMessage.unpack(body))
+    benchmark('codec', name='view_field_{}'.format(shape))(
+        lambda state: RabbitMessage.view(body)['action'])
+
+
+for shape, message in sorted(SHAPES.items()):
+    register(shape, message)
+
+
+@benchmark('codec', setup=lambda context: RabbitMessage(CONVERSATION_MESSAGE))
+def prepare(state):
+    state.prepare()
+
+
+@benchmark('codec', number=100, items=100, setup=lambda context: [RabbitMessage(CONVERSATION_MESSAGE) for num in range(100)])
+def prepare_many(state):
+    RabbitMessage.prepare_many(state)
+
+
+BATCH = [CONVERSATION_MESSAGE, ACK_MESSAGE, ACTIVITY_MESSAGE, TWEET_MESSAGE] * 25
+PACKED_BATCH = CODEC.pack_many(BATCH)
+
+
+@benchmark('codec', number=100, items=len(BATCH))
+def pack_many(state):
+    CODEC.pack_many(BATCH)
+
+
+@benchmark('codec', number=100, items=len(BATCH))
+def unpack_many(state):
+    CODEC.unpack_many(PACKED_BATCH)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import pkg_resources
+import platform
+import sys
+import time
+
+BENCHMARKS = []
+
+
+class Benchmark(object):
+    """
+        A benchmarked function, called number times per repetition.
+
+        setup is called with the run context before each repetition and returns
+        the state passed to func. teardown is called with the state after it.
+        items is the number of operations done by each call, to report the
+        time per operation of bulk benchmarks.
+    """
+
+    def __init__(self, func, group, name=None, number=1000, repeat=5, items=1, setup=None, teardown=None):
+        self.func = func
+        self.group = group
+        self.name = name or func.__name__
+        self.number = number
+        self.repeat = repeat
+        self.items = items
+        self.setup = setup
+        self.teardown = teardown
+
+    @property
+    def fullname(self):
+        return '{}.{}'.format(self.group, self.name)
+
+    def run(self, context):
+        timings = []
+        for repetition in range(self.repeat):
+            state = self.setup(context) if self.setup is not None else context
+            try:
+                start = time.time()
+                for iteration in xrange(self.number):
+                    self.func(state)
+                timings.append(time.time() - start)
+            finally:
+                if self.teardown is not None:
+                    self.teardown(state)
+
+        timings.sort()
+        operations = self.number * self.items
+        best = timings[0]
+        return {
+            'group': self.group,
+            'number': self.number,
+            'repeat': self.repeat,
+            'items': self.items,
+            'best': best,
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+            'per_op': best / operations,
+            'ops_per_sec': operations / best if best else None
+        }
+
+
+def benchmark(group, **options):
+    """
+        Registers a function as a benchmark, see Benchmark for the options
+    """
+    def decorator(func):
+        BENCHMARKS.append(Benchmark(func, group, **options))
+        return func
+    return decorator
+
+
+def environment():
+    try:
+        version = pkg_resources.get_distribution('maxcarrot').version
+    except pkg_resources.DistributionNotFound:
+        version = 'unknown'
+
+    return {
+        'maxcarrot': version,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def run(context, groups=None, match=None, progress=None):
+    """
+        Runs the registered benchmarks, optionally only those in groups or
+        with match in their name, and returns the results document.
+
+        Benchmarks raising an error are recorded as skipped, with the error.
+    """
+    results = {}
+    for bench in BENCHMARKS:
+        if groups and bench.group not in groups:
+            continue
+        if match and match not in bench.fullname:
+            continue
+        try:
+            results[bench.fullname] = bench.run(context)
+        except Exception as error:
+            results[bench.fullname] = {'group': bench.group, 'skipped': '{}: {}'.format(error.__class__.__name__, error)}
+        if progress is not None:
+            progress(bench.fullname, results[bench.fullname])
+
+    return {'environment': environment(), 'results': results}
+
+
+def load(filename):
+    with open(filename) as results:
+        return json.load(results)
+
+
+def save(document, filename):
+    with open(filename, 'w') as results:
+        json.dump(document, results, indent=2, sort_keys=True)
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+        Compares the time per operation of the benchmarks in two results
+        documents. Returns a list of (name, baseline, current, ratio, regression)
+        tuples, where regression is True if current is slower by more than threshold.
+    """
+    comparison = []
+    for name, result in sorted(current['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous is None or 'per_op' not in previous or 'per_op' not in result:
+            continue
+        ratio = result['per_op'] / previous['per_op'] if previous['per_op'] else None
+        regression = ratio is not None and ratio > 1 + threshold
+        comparison.append((name, previous['per_op'], result['per_op'], ratio, regression))
+    return comparison
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+    Startup benchmarks, importing maxcarrot in a new interpreter each time.
+    Compare them with startup.interpreter, the cost of starting python alone.
+"""
+from benchmarks.harness import benchmark
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def python(code):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+
+
+@benchmark('startup', number=5, repeat=5)
+def interpreter(state):
+    python('pass')
+
+
+@benchmark('startup', number=5, repeat=5)
+def import_maxcarrot(state):
+    python('import maxcarrot')
+
+
+@benchmark('startup', number=5, repeat=5)
+def import_and_pack(state):
+    python('from maxcarrot import RabbitMessage; RabbitMessage({"action": "add"}).packed')
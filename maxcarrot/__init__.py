@@ -1,2 +1,3 @@
 from maxcarrot.message import RabbitMessage
 from maxcarrot.client import RabbitClient
+from maxcarrot.pool import RabbitConnectionPool
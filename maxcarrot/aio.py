@@ -0,0 +1,712 @@
+# -*- coding: utf-8 -*-
+"""
+    Asyncio client, mirroring RabbitClient.
+
+    All the operations return futures, so they can be awaited on python 3 or
+    yielded with From() on python 2 using trollius. Each client runs on its own
+    connection driven by the event loop, so many sessions can share one loop
+    without threads.
+"""
+from haigha.connections.rabbit_connection import RabbitConnection
+from haigha.exceptions import ChannelClosed
+from haigha.exceptions import ConnectionClosed
+from haigha.message import Message
+from haigha.transports.transport import Transport
+from maxcarrot.client import RabbitClient
+from maxcarrot.client import decode_body
+from maxcarrot.client import encode_body
+from maxcarrot.client import parse_url
+from maxcarrot.management import RabbitManagement
+
+from collections import deque
+from functools import partial
+from itertools import count
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+try:
+    StopAsyncIteration
+except NameError:
+    StopAsyncIteration = StopIteration
+
+
+def resolved(value, loop):
+    """
+        Returns a future already resolved with value
+    """
+    future = asyncio.Future(loop=loop)
+    future.set_result(value)
+    return future
+
+
+def gather(futures, loop):
+    """
+        Returns a future resolved with the results of all futures
+    """
+    if not futures:
+        return resolved([], loop)
+    return asyncio.gather(*futures)
+
+
+class AsyncioProtocol(asyncio.Protocol):
+    """
+        Feeds the data received on the socket to an AsyncioTransport
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.data_received(data)
+
+    def connection_lost(self, exc):
+        self.transport.connection_lost(exc)
+
+
+class AsyncioTransport(Transport):
+    """
+        Haigha transport on top of an asyncio event loop.
+
+        Frames are read as soon as data arrives on the socket, and writes done
+        before the socket is connected are sent once connected.
+    """
+
+    def __init__(self, connection, loop):
+        super(AsyncioTransport, self).__init__(connection)
+        self._synchronous = False
+        self._loop = loop
+        self._transport = None
+        self._buffer = bytearray()
+        self._pending_writes = []
+        self._disconnected = False
+
+    def connect(self, address):
+        host, port = address
+        self._host = '{}:{}'.format(host, port)
+        connecting = asyncio.ensure_future(
+            self._loop.create_connection(partial(AsyncioProtocol, self), host, port),
+            loop=self._loop)
+        connecting.add_done_callback(self._connected)
+
+    def _connected(self, future):
+        if future.exception() is not None:
+            self.connection.transport_closed(msg='failed to connect to {}: {}'.format(self._host, future.exception()))
+            return
+
+        self._transport, protocol = future.result()
+        for data in self._pending_writes:
+            self._transport.write(data)
+        self._pending_writes = []
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        self.connection.read_frames()
+
+    def connection_lost(self, exc):
+        self._transport = None
+        if not self._disconnected:
+            self.connection.transport_closed(msg='connection to {} lost: {}'.format(self._host, exc))
+
+    def read(self, timeout=None):
+        if not self._buffer:
+            return None
+        data = self._buffer
+        self._buffer = bytearray()
+        return data
+
+    def buffer(self, data):
+        self._buffer[0:0] = data
+
+    def write(self, data):
+        if self._transport is None:
+            self._pending_writes.append(bytes(data))
+        else:
+            self._transport.write(bytes(data))
+
+    def disconnect(self):
+        self._disconnected = True
+        if self._transport is not None:
+            self._transport.close()
+
+
+class AsyncioRabbitConnection(RabbitConnection):
+    """
+        RabbitConnection using an AsyncioTransport on the given loop
+    """
+
+    def __init__(self, loop, **kwargs):
+        kwargs['transport'] = AsyncioTransport(self, loop)
+        super(AsyncioRabbitConnection, self).__init__(**kwargs)
+
+
+class AsyncRabbitClient(object):
+    """
+        Asyncio version of RabbitClient.
+
+        Create the client and resolve connect() before using it:
+
+            client = AsyncRabbitClient(url, user='sheldon')
+            await client.connect()
+
+        Operations sent before a previous one completes are pipelined on the channel.
+    """
+
+    resource_specs = RabbitClient.resource_specs
+
+    def __init__(self, url, user=None, loop=None, management_options={}):
+        self.url = url
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.username = user
+        self.queue = None
+        self.connection = None
+        self.ch = None
+        self._pending = set()
+        self._disconnecting = None
+
+        self.user, self.password, self.host, self.port, self.vhost_url = parse_url(url)
+        self.vhost = self.vhost_url.replace('%2F', '/')
+
+        self.exchange_specs_by_name = {spec['name']: spec for spec in self.resource_specs['exchanges']}
+        self.queue_specs_by_name = {spec['name']: spec for spec in self.resource_specs['queues']}
+
+        # Wrapper to interact with conversations
+        self.conversations = AsyncRabbitConversations(self)
+        self.activity = AsyncRabbitActivity(self)
+        self.management = AsyncRabbitManagement(self, 'http://{}:15672/api'.format(self.host), self.vhost_url, self.user, self.password, **management_options)
+
+    def _future(self):
+        """
+            Returns a future that will fail if the channel closes before it's resolved
+        """
+        future = asyncio.Future(loop=self.loop)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def _call(self, method, *args, **kwargs):
+        """
+            Calls a haigha method with a callback that resolves the returned future
+        """
+        future = self._future()
+
+        def cb(*result):
+            if not future.done():
+                future.set_result(result[0] if len(result) == 1 else result or None)
+
+        method(*args, cb=cb, **kwargs)
+        return future
+
+    def _fail_pending(self, exception):
+        for future in list(self._pending):
+            if not future.done():
+                future.set_exception(exception)
+
+    def connect(self):
+        """
+            Connects to rabbitmq and opens a channel. If the client
+            has a user, binds the user queue too.
+        """
+        future = self._future()
+        params = dict(
+            user=self.user, password=self.password,
+            vhost=self.vhost, host=self.host, port=int(self.port),
+            close_cb=self._connection_closed_cb
+        )
+        self.connection = AsyncioRabbitConnection(self.loop, **params)
+        self.ch = self.connection.channel()
+        self.ch.add_close_listener(self._channel_closed_cb)
+
+        def on_open(ch):
+            if self.username is None:
+                future.set_result(self)
+            else:
+                self.bind(self.username).add_done_callback(
+                    lambda bound: future.set_exception(bound.exception()) if bound.exception() else future.set_result(self))
+
+        self.ch.add_open_listener(on_open)
+        return future
+
+    def _channel_closed_cb(self, ch):
+        self.ch = None
+        self._fail_pending(ChannelClosed(ch.close_info))
+
+    def _connection_closed_cb(self):
+        self.connection = None
+        self._fail_pending(ConnectionClosed())
+        if self._disconnecting is not None and not self._disconnecting.done():
+            self._disconnecting.set_result(None)
+
+    def disconnect(self):
+        """
+            Disconnects from rabbitmq, resolves when the connection is closed
+        """
+        self._disconnecting = asyncio.Future(loop=self.loop)
+        if self.connection is None:
+            self._disconnecting.set_result(None)
+        else:
+            self.connection.close()
+        return self._disconnecting
+
+    def declare(self):
+        """
+            Create all defined exchanges and queues on rabbit.
+            Ignore those marked as internal or not global
+        """
+        futures = []
+        for exchange in self.resource_specs['exchanges']:
+            if exchange.get('global', True) and not exchange.get('native', False):
+                futures.append(self._call(
+                    self.ch.exchange.declare,
+                    exchange=exchange['name'],
+                    type=exchange['type'],
+                    durable=True,
+                    auto_delete=False
+                ))
+                for binding in exchange.get('bindings', []):
+                    futures.append(self._call(
+                        self.ch.exchange.bind,
+                        exchange=exchange['name'],
+                        source=binding['source'],
+                        routing_key=binding.get('routing_key', ''),
+                    ))
+
+        for queue in self.resource_specs['queues']:
+            if queue.get('global', True) and not queue.get('native', False):
+                futures.append(self._call(
+                    self.ch.queue.declare,
+                    queue=queue['name'],
+                    durable=True,
+                    auto_delete=False
+                ))
+                for binding in queue.get('bindings', []):
+                    futures.append(self._call(
+                        self.ch.queue.bind,
+                        queue=queue['name'],
+                        exchange=binding['exchange'],
+                        routing_key=binding.get('routing_key', ''),
+                    ))
+        return gather(futures, self.loop)
+
+    def bind(self, username):
+        """
+        Declare a dynamic queue to consume user messages
+        and set active user
+        """
+        self.username = username
+        future = self._future()
+
+        def on_declared(declared):
+            if declared.exception() is not None:
+                future.set_exception(declared.exception())
+                return
+            self.queue = declared.result()[0]
+            self._call(self.ch.queue.bind, self.queue, self.user_subscribe_exchange(username)).add_done_callback(
+                lambda bound: future.set_exception(bound.exception()) if bound.exception() else future.set_result(self.queue))
+
+        self._call(self.ch.queue.declare, exclusive=True).add_done_callback(on_declared)
+        return future
+
+    def create_users(self, usernames):
+        """
+            Batch create user exchanges, all the declares are pipelined
+        """
+        return gather([self.create_user(username) for username in usernames], self.loop)
+
+    def create_user(self, username, create_exchanges=True):
+        """
+            Creates user exchanges and internal binding
+        """
+        futures = []
+        if create_exchanges:
+            futures.append(self._call(
+                self.ch.exchange.declare,
+                exchange=self.user_publish_exchange(username),
+                type=self.exchange_specs_by_name['user_publish']['type'],
+                durable=True,
+                auto_delete=False
+            ))
+
+            futures.append(self._call(
+                self.ch.exchange.declare,
+                exchange=self.user_subscribe_exchange(username),
+                type=self.exchange_specs_by_name['user_subscribe']['type'],
+                durable=True,
+                auto_delete=False
+            ))
+
+        futures.append(self._call(
+            self.ch.exchange.bind,
+            exchange=self.user_subscribe_exchange(username),
+            source=self.user_publish_exchange(username),
+            routing_key='internal',
+        ))
+        return gather(futures, self.loop)
+
+    def delete_user(self, username):
+        return gather([
+            self._call(self.ch.exchange.delete, self.user_publish_exchange(username)),
+            self._call(self.ch.exchange.delete, self.user_subscribe_exchange(username))
+        ], self.loop)
+
+    def user_publish_exchange(self, username):
+        """
+            Returns name of exchange used to send messages to rabbit
+        """
+        return '{}.publish'.format(username)
+
+    def user_subscribe_exchange(self, username):
+        """
+            Returns name of exchange used to broadcast messages for this user to all
+            the consumers identified with this username
+        """
+        return '{}.subscribe'.format(username)
+
+    def send(self, exchange, message, routing_key=''):
+        """
+            Publishes a message. Publishing doesn't wait for the broker,
+            so the returned future is already resolved.
+        """
+        self.ch.publish(Message(encode_body(message)), exchange, routing_key=routing_key)
+        return resolved(None, self.loop)
+
+    def send_internal(self, message):
+        return self.send(self.user_publish_exchange(self.username), message, routing_key='internal')
+
+    def get(self, queue_name):
+        """
+            Resolves with the next message in the queue, or None if empty
+        """
+        future = self._future()
+        self.ch.basic.get(queue_name, consumer=lambda message_obj: future.done() or future.set_result(message_obj))
+        return future
+
+    def get_all(self, queue=None, max_messages=None):
+        """
+            Resolves with a list of (payload, message) tuples
+            for the messages in a queue, defaults to the user queue
+        """
+        queue_name = self.queue if queue is None else queue
+        future = self._future()
+        messages = []
+
+        def on_message(message_obj):
+            if message_obj is not None:
+                messages.append(decode_body(message_obj))
+            if message_obj is None or (max_messages is not None and len(messages) >= max_messages):
+                if not future.done():
+                    future.set_result(messages)
+                return
+            self.ch.basic.get(queue_name, consumer=on_message)
+
+        self.ch.basic.get(queue_name, consumer=on_message)
+        return future
+
+    def consume(self, queue=None, prefetch_count=100, no_ack=True):
+        """
+            Starts a push based consumer on a queue, defaults to the user queue.
+            Returns an AsyncRabbitConsumer, to be used with async for.
+        """
+        queue_name = self.queue if queue is None else queue
+        consumer = AsyncRabbitConsumer(self, queue_name, prefetch_count=prefetch_count, no_ack=no_ack)
+        consumer.start()
+        return consumer
+
+
+class AsyncRabbitConsumer(object):
+    """
+        Asyncio version of RabbitConsumer.
+
+        Use it with async for, or call get() to get a future of the next
+        (payload, message) delivery. Iteration ends when the consumer is cancelled.
+    """
+
+    consumer_tags = count(1)
+
+    def __init__(self, client, queue, prefetch_count=100, no_ack=True):
+        self.client = client
+        self.queue = queue
+        self.prefetch_count = prefetch_count
+        self.no_ack = no_ack
+        self.consumer_tag = None
+        self.deliveries = deque()
+        self.waiters = deque()
+
+    def start(self):
+        """
+            Registers the consumer on the broker
+        """
+        if self.prefetch_count and not self.no_ack:
+            self.client.ch.basic.qos(prefetch_count=self.prefetch_count)
+
+        self.consumer_tag = 'maxcarrot.{}.{}'.format(self.queue, next(self.consumer_tags))
+        self.client.ch.basic.consume(
+            queue=self.queue,
+            consumer=self._on_message,
+            consumer_tag=self.consumer_tag,
+            no_ack=self.no_ack,
+            cancel_cb=self._on_cancel
+        )
+
+    def cancel(self):
+        """
+            Stops receiving messages. Messages already delivered can still be read.
+        """
+        if self.consumer_tag is not None:
+            self.client.ch.basic.cancel(consumer_tag=self.consumer_tag)
+            self._on_cancel(self.consumer_tag)
+
+    def ack(self, message, multiple=False):
+        """
+            Acknowledges a delivered message, or all messages up to it if multiple=True
+        """
+        self.client.ch.basic.ack(message.delivery_info['delivery_tag'], multiple=multiple)
+
+    def _on_message(self, message_obj):
+        delivery = decode_body(message_obj)
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(delivery)
+                return
+        self.deliveries.append(delivery)
+
+    def _on_cancel(self, consumer_tag):
+        self.consumer_tag = None
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(StopAsyncIteration())
+
+    def get(self):
+        """
+            Resolves with the next (payload, message) delivery.
+            Fails with StopAsyncIteration if the consumer is cancelled.
+        """
+        future = asyncio.Future(loop=self.client.loop)
+        if self.deliveries:
+            future.set_result(self.deliveries.popleft())
+        elif self.consumer_tag is None:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self.waiters.append(future)
+        return future
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.get()
+
+
+class AsyncRabbitConversations(object):
+    """
+        Asyncio version of RabbitConversations
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def send(self, conversation, message, destination='messages'):
+        routing_key = '{}.{}'.format(conversation, destination)
+        return self.client.send(
+            self.client.user_publish_exchange(self.client.username),
+            message,
+            routing_key=routing_key)
+
+    def create(self, conversation, users):
+        """
+            Batch creates conversation bindings for a bunch
+            of users, all the binds are pipelined
+        """
+        return gather([self.bind_user(conversation, user) for user in users], self.client.loop)
+
+    def bind_user(self, conversation, username):
+        """
+            Creates the bindings to route messages between
+            a conversation and a user
+        """
+        return gather([
+            self.client._call(
+                self.client.ch.exchange.bind,
+                exchange='conversations',
+                source=self.client.user_publish_exchange(username),
+                routing_key='{}.*'.format(conversation)
+            ),
+            self.client._call(
+                self.client.ch.exchange.bind,
+                exchange=self.client.user_subscribe_exchange(username),
+                source='conversations',
+                routing_key='{}.*'.format(conversation)
+            )
+        ], self.client.loop)
+
+    def unbind_user(self, conversation, username):
+        """
+            Deletes the bindings to route messages between
+            a conversation and a user
+        """
+        return gather([
+            self.client._call(
+                self.client.ch.exchange.unbind,
+                exchange='conversations',
+                source=self.client.user_publish_exchange(username),
+                routing_key='{}.*'.format(conversation)
+            ),
+            self.client._call(
+                self.client.ch.exchange.unbind,
+                exchange=self.client.user_subscribe_exchange(username),
+                source='conversations',
+                routing_key='{}.*'.format(conversation)
+            )
+        ], self.client.loop)
+
+    def delete(self, conversation):
+        """
+            Deletes all the bindings for a specific conversation
+        """
+        return self.client.management.unbind_matching('conversations', conversation)
+
+
+class AsyncRabbitActivity(object):
+    """
+        Asyncio version of RabbitActivity
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, context, users):
+        """
+            Batch create user context bindings
+            for a bunch of users, all the binds are pipelined
+        """
+        return gather([self.bind_user(context, user) for user in users], self.client.loop)
+
+    def bind_user(self, context, username):
+        """
+            Creates the binding to route messages from a context
+            to a specific user
+        """
+        return self.client._call(
+            self.client.ch.exchange.bind,
+            exchange=self.client.user_subscribe_exchange(username),
+            source='activity',
+            routing_key=context
+        )
+
+    def unbind_user(self, context, username):
+        """
+            Deletes the bindings to route messages from a context
+            to a specific user
+        """
+        return self.client._call(
+            self.client.ch.exchange.unbind,
+            exchange=self.client.user_subscribe_exchange(username),
+            source='activity',
+            routing_key=context
+        )
+
+    def delete(self, context):
+        """
+            Deletes all the bindings for a specific context
+        """
+        return self.client.management.unbind_matching('activity', context)
+
+
+class AsyncRabbitManagement(object):
+    """
+        Asyncio version of RabbitManagement.
+
+        Management HTTP requests run in the loop default executor, so they don't
+        block the loop. AMQP operations run on the client channel.
+    """
+
+    def __init__(self, client, url, vhost, user, password, **options):
+        self.client = client
+        self.sync = RabbitManagement(client, url, vhost, user, password, **options)
+
+    def _run(self, method, *args):
+        return self.client.loop.run_in_executor(None, method, *args)
+
+    def load_exchanges(self):
+        """
+            Resolves with the list of exchanges in the vhost
+        """
+        future = self._run(self.sync.load_exchanges)
+        return self._then(future, lambda result: self.sync.exchanges)
+
+    def load_queues(self):
+        """
+            Resolves with the list of queues in the vhost
+        """
+        future = self._run(self.sync.load_queues)
+        return self._then(future, lambda result: self.sync.queues)
+
+    def load_exchange_bindings(self, exchange):
+        """
+            Resolves with the list of bindings of an exchange
+        """
+        return self._run(lambda: list(self.sync.load_exchange_bindings(exchange)))
+
+    def delete_binding(self, source, destination, routing_key):
+        return self._run(self.sync.delete_binding, source, destination, routing_key)
+
+    def force_close(self, remote, message="Closed via MaxCarrot"):
+        return self._run(self.sync.force_close, remote, message)
+
+    def delete_exchange(self, name):
+        return self.client._call(self.client.ch.exchange.delete, name)
+
+    def delete_queue(self, name):
+        if name.startswith('amq.gen'):
+            return resolved(None, self.client.loop)
+        return self.client._call(self.client.ch.queue.delete, name)
+
+    def unbind_matching(self, exchange, key):
+        """
+            Deletes all the bindings of an exchange with key as routing key,
+            or as the first word of the routing key, as conversation1 matches
+            conversation1.* but not conversation10.*. All the unbinds are pipelined
+        """
+        future = asyncio.Future(loop=self.client.loop)
+
+        def on_bindings(loaded):
+            if loaded.exception() is not None:
+                future.set_exception(loaded.exception())
+                return
+            unbinds = gather([
+                self.client._call(
+                    self.client.ch.exchange.unbind,
+                    exchange=binding['destination'],
+                    source=binding['source'],
+                    routing_key=binding['routing_key'])
+                for binding in loaded.result()
+                if binding['routing_key'] == key or binding['routing_key'].startswith(key + '.')
+            ], self.client.loop)
+            self._chain(unbinds, future)
+
+        self.load_exchange_bindings(exchange).add_done_callback(on_bindings)
+        return future
+
+    def _then(self, future, transform):
+        result = asyncio.Future(loop=self.client.loop)
+
+        def done(completed):
+            if completed.exception() is not None:
+                result.set_exception(completed.exception())
+            else:
+                result.set_result(transform(completed.result()))
+        future.add_done_callback(done)
+        return result
+
+    @staticmethod
+    def _chain(source, destination):
+        def done(completed):
+            if completed.exception() is not None:
+                destination.set_exception(completed.exception())
+            else:
+                destination.set_result(completed.result())
+        source.add_done_callback(done)
@@ -1,16 +1,50 @@
 # -*- coding: utf-8 -*-
+from haigha import __version__ as haigha_version
 from haigha.connections.rabbit_connection import RabbitConnection
 from haigha.message import Message
-from maxcarrot.management import RabbitManagement
+from maxcarrot.index import BindingIndex
+from maxcarrot.metrics import METRICS
+from maxcarrot.metrics import MeteredChannel
+from maxcarrot.pipeline import ChannelPipeline
+from maxcarrot.provisioning import UserProvisioner
+from maxcarrot.pump import PUMP
+from maxcarrot.pump import load_gevent
 
+from collections import deque
+from itertools import count
+import errno
 import json
-import pkg_resources
+import random
 import re
-try:
-    import gevent
-    gevent_available = True
-except:
-    gevent_available = False
+import select
+import socket
+import threading
+import time
+
+
+def parse_url(url):
+    """
+        Returns the (user, password, host, port, vhost_url) parts of an amqp url
+    """
+    return re.search(r'amqp://(\w+):(\w+)@([^\:]+)\:(\d+)\/(.*)\/?', url).groups()
+
+
+def encode_body(message):
+    """
+        Returns the body to send for a message, json encoded unless it's already a string
+    """
+    return message if isinstance(message, basestring) else json.dumps(message)
+
+
+def decode_body(message_obj):
+    """
+        Returns a (payload, message) tuple for a received message,
+        payload being the decoded json body, or the raw body if it is not json
+    """
+    try:
+        return (json.loads(str(message_obj.body)), message_obj)
+    except ValueError:
+        return (message_obj.body, message_obj)
 
 
 class RabbitClient(object):
@@ -22,11 +56,18 @@ class RabbitClient(object):
         * Internal queues definitions are marked as native, to avoid deletion
         * Exchanges and queues that need to be created always are marked as global
 
+        With shards=N, the messages and push queues are split in N queues,
+        see sharded_specs, to be consumed in parallel with ShardWorkers.
+
+        The conversations and activity binding indexes are loaded again from the
+        management api index_ttl seconds after loading them, see BindingIndex.
+        Use index_ttl=None when this client makes all the binding changes.
+
     """
 
     __client_properties__ = {
         'library': 'haigha',
-        'library-version': pkg_resources.require('haigha')[0].version
+        'library-version': haigha_version
     }
 
     resource_specs = {
@@ -60,29 +101,94 @@ class RabbitClient(object):
         ]
     }
 
-    def __init__(self, url, declare=False, user=None, client_properties={}, transport='socket'):
+    reconnect_attempts = 5
+    reconnect_delay = 0.1
+
+    def __init__(self, url, declare=False, user=None, client_properties={}, transport='socket', pool=None, management_options={}, metrics=METRICS, pump=PUMP,
+                 queue_affinity=None, failover=None, shards=None, index_ttl=30):
         self.__client_properties__.update(client_properties)
-        self.transport = transport
+        self.shards = shards
+        if shards:
+            from maxcarrot.sharding import sharded_specs
+            self.resource_specs = sharded_specs(self.resource_specs, shards)
+        self.transport = transport if pool is None else pool.transport
+        self.pool = pool
+        self.metrics = metrics
+        self.pump = pump
+        self.failover = failover
+        self.broker = None
+        self.node = None
+        self.queue = None
+        self.consumers = []
+        self.prefetch_count = 0
+        self._publisher = None
+        self._pipeline = None
+        self._management = None
+        self._management_options = management_options
+        self._closing = False
+        self._channel_error = False
+        self._reconnecting = False
 
         # Fallback to socket transport if gevent not available
-        if self.transport == 'gevent' and not gevent_available:
+        if self.transport == 'gevent' and load_gevent() is None:
             self.transport = 'socket'
 
         self.connect(url)
+
+        if queue_affinity is not None:
+            node = self.cluster.node_named(self.management.queue_node(queue_affinity) or '')
+            if node is not None and node != self.node:
+                self.reconnect(node)
+
         if declare:
             self.declare()
 
         self.exchange_specs_by_name = {spec['name']: spec for spec in self.resource_specs['exchanges']}
         self.queue_specs_by_name = {spec['name']: spec for spec in self.resource_specs['queues']}
 
-        # Wrapper to interact with conversations
-        self.conversations = RabbitConversations(self)
-        self.activity = RabbitActivity(self)
-        self.management = RabbitManagement(self, 'http://{}:15672/api'.format(self.host), self.vhost_url, self.user, self.password)
+        # Wrapper to interact with conversations, pooled clients share the binding indexes
+        shared = self.pool is not None
+        self.conversations = RabbitConversations(
+            self, index=self.pool.binding_index('conversations') if shared else BindingIndex(index_ttl))
+        self.activity = RabbitActivity(
+            self, index=self.pool.binding_index('activity') if shared else BindingIndex(index_ttl))
 
         if user is not None:
             self.bind(user)
 
+    @property
+    def management(self):
+        """
+            Client of the management api, created on first use. Pooled clients
+            share the one of the pool, see RabbitConnectionPool.shared_client.
+        """
+        if self._management is None:
+            if self.pool is not None and self.pool.shared_client() is not self:
+                self._management = self.pool.shared_client().management
+            else:
+                self._management = self._create_management()
+        return self._management
+
+    def _create_management(self):
+        # Imported here, as requests and ijson are slow to import
+        from maxcarrot.management import RabbitManagement
+        management_options = dict(self._management_options)
+        management_options.setdefault('metrics', self.metrics)
+        if self.broker is not None:
+            from maxcarrot.memory import MemoryManagementSession
+            management_options.setdefault('session', MemoryManagementSession(self.broker))
+        return RabbitManagement(self, self.management_urls(), self.vhost_url, self.user, self.password, **management_options)
+
+    def management_urls(self):
+        """
+            Returns the management api urls of the cluster nodes, starting with the connected node
+        """
+        hosts = [self.host]
+        for host, port in self.nodes:
+            if host not in hosts:
+                hosts.append(host)
+        return ['http://{}:15672/api'.format(host) for host in hosts]
+
     def spec_by_name(self, type, name):
         for spec in self.resource_specs[type]:
             if spec['name'] == name:
@@ -91,49 +197,169 @@ class RabbitClient(object):
 
     def connect(self, url):
         """
-            Connect to rabbitmq and create a channel
+            Connect to rabbitmq and create a channel.
+            Pooled clients get a channel on one of the pool connections instead.
+
+            url can list the nodes of a cluster, see parse_nodes. The client
+            connects to the node with fewer connections, and with failover
+            enabled, moves to another node when the connection is lost.
         """
-        parts = re.search(r'amqp://(\w+):(\w+)@([^\:]+)\:(\d+)\/(.*)\/?', url).groups()
-        self.user, self.password, self.host, self.port, self.vhost_url = parts
+        from maxcarrot.cluster import get_cluster
+        from maxcarrot.cluster import parse_nodes
+        self.user, self.password, self.nodes, self.vhost_url = parse_nodes(url)
+        self.login = (self.user, self.password)
         self.vhost = self.vhost_url.replace('%2F', '/')
+        self.cluster = get_cluster(self.nodes)
+        if self.failover is None:
+            self.failover = len(self.nodes) > 1
 
-        params = dict(
-            user=self.user, password=self.password,
-            vhost=self.vhost, host=self.host, transport=self.transport
-        )
-        if self.transport == 'gevent':
-            params['close_cb'] = self._connection_closed_cb,
+        if self.transport == 'memory':
+            from maxcarrot.memory import get_broker
+            self.broker = get_broker(*self.nodes[0])
+
+        if self.pool is not None:
+            self.connection, channel = self.pool.acquire()
+            self.node = self.pool.connection_nodes.get(self.connection, self.nodes[0])
+            self.host, self.port = self.node
+            self.ch = MeteredChannel(channel, self.metrics)
+            return
 
-        self.connection = RabbitConnection(**params)
+        self._open()
+
+    def _open(self, preferred=None):
+        """
+            Opens the connection and channel on a node of the cluster, preferred
+            if given and available. Nodes that refuse the connection are marked
+            as failed and the next one is tried, until all of them were tried.
+        """
+        tried = []
+        while True:
+            node = self.cluster.choose(preferred, exclude=tried)
+            self.node = node
+            self.host, self.port = node
+            try:
+                if self.transport == 'memory':
+                    self.connection = self.broker.connect(self.vhost, node=node, close_cb=self._connection_closed_cb)
+                else:
+                    self.connection = RabbitConnection(
+                        user=self.login[0], password=self.login[1],
+                        vhost=self.vhost, host=self.host, port=self.port, transport=self.transport,
+                        close_cb=self._connection_closed_cb
+                    )
+            except socket.error:
+                self.cluster.failed(node)
+                tried.append(node)
+                if len(set(tried)) >= len(self.nodes):
+                    raise
+            else:
+                self.cluster.connected(node)
+                break
 
-        self.ch = self.connection.channel()
+        self.ch = MeteredChannel(self.connection.channel(), self.metrics)
+        self.prefetch_count = 0
+        self._channel_error = False
         if self.transport == 'gevent':
-            self._message_pump_greenlet = gevent.spawn(self._message_pump_greenthread)
+            self.pump.register(self.connection)
             self.ch.add_close_listener(self._channel_closed_cb)
 
-    def _message_pump_greenthread(self):
+    def _channel_closed_cb(self, ch):
+        self.ch = None
+        if self.connection is not None:
+            # Closed on purpose, not a lost node, until a new channel is opened
+            self._channel_error = True
+            self.connection.close()
+
+    def _connection_closed_cb(self):
+        if self._closing or self._channel_error or self._reconnecting or not self.failover:
+            return
+        self.cluster.failed(self.node)
+        self.metrics.inc('maxcarrot_failovers_total')
+        if self.transport == 'gevent':
+            load_gevent().spawn(self.reconnect)
+        else:
+            self.reconnect()
+
+    def reconnect(self, node=None):
+        """
+            Moves the client to another node of the cluster, or to node if given.
+
+            The connection is opened again, retrying with a jittered backoff up to
+            reconnect_attempts times, then the user queue is declared and bound
+            again and the consumers of the client are restarted on the new channel.
+            Deliveries of consumers with no_ack=False that were not acked are
+            dropped, the broker delivers them again.
+        """
+        self._reconnecting = True
         try:
-            while self.connection is not None:
-                # Pump
-                self.connection.read_frames()
+            old = self.connection
+            self.cluster.disconnected(self.node)
+            if self.transport == 'gevent':
+                self.pump.unregister(old)
+            try:
+                old.close(disconnect=True)
+            except Exception:
+                pass
+            self._publisher = None
+            self._pipeline = None
+
+            for attempt in range(self.reconnect_attempts):
+                try:
+                    self._open(node)
+                    break
+                except socket.error:
+                    if attempt == self.reconnect_attempts - 1:
+                        raise
+                    delay = self.reconnect_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+                    if self.transport == 'gevent':
+                        load_gevent().sleep(delay)
+                    else:
+                        time.sleep(delay)
 
-                # Yield to other greenlets so they don't starve
-                gevent.sleep()
+            self.restore()
         finally:
-            return
+            self._reconnecting = False
 
-    def _channel_closed_cb(self, ch):
-        self.ch = None
-        self.connection.close()
-        return
+    def restore(self):
+        """
+            Declares again the user queue, and restarts the consumers of the client
+        """
+        old_queue = self.queue
+        if old_queue is not None:
+            self.bind(self.user)
 
-    def _connection_closed_cb(self):
-        self.connection = None
+        for consumer in list(self.consumers):
+            if consumer.queue == old_queue:
+                consumer.queue = self.queue
+            if not consumer.no_ack:
+                consumer.deliveries.clear()
+                consumer._iterated = None
+            consumer.start()
 
     def disconnect(self):
         """
-            Disconnecto from rabbitmq
+            Disconnecto from rabbitmq.
+            Pooled clients delete their user queue, as it belongs to the shared
+            connection, close their channels, and leave the connection to the pool.
         """
+        self._closing = True
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+        # The management api client of pooled clients belongs to the pool
+        if self._management is not None and self._management.client is self:
+            self._management.close()
+
+        if self.pool is not None:
+            if self._publisher is not None:
+                self._publisher.ch.close()
+                self._publisher = None
+            if self.queue is not None and self.ch is not None and not self.ch.closed and self.connected:
+                self.ch.queue.delete(self.queue)
+                self.queue = None
+            self.pool.release(self.connection, self.ch)
+            return
+
+        self.cluster.disconnected(self.node)
         self.connection.close()
 
     def declare(self):
@@ -149,6 +375,12 @@ class RabbitClient(object):
                     durable=True,
                     auto_delete=False
                 )
+                for binding in exchange.get('bindings', []):
+                    self.ch.exchange.bind(
+                        exchange=exchange['name'],
+                        source=binding['source'],
+                        routing_key=binding.get('routing_key', ''),
+                    )
 
         for queue in self.resource_specs['queues']:
             if queue.get('global', True) and not queue.get('native', False):
@@ -164,6 +396,8 @@ class RabbitClient(object):
                         routing_key=binding.get('routing_key', ''),
                     )
 
+        self.management.invalidate()
+
     def bind(self, username):
         """
         Declare a dynamic queue to consume user messages
@@ -180,6 +414,18 @@ class RabbitClient(object):
         for username in usernames:
             self.create_user(username)
 
+    def provision_users(self, usernames, batch_size=500, channels=4, start=0, create_exchanges=True, progress_cb=None):
+        """
+            Bulk create user exchanges, pipelining the declares and binds
+            over several channels. Returns a ProvisioningReport, see UserProvisioner.
+        """
+        provisioner = UserProvisioner(self, channels=channels, batch_size=batch_size)
+        try:
+            return provisioner.provision(usernames, start=start, create_exchanges=create_exchanges, progress_cb=progress_cb)
+        finally:
+            provisioner.close()
+            self.management.invalidate()
+
     def create_user(self, username, create_exchanges=True):
         """
             Creates user exchanges and internal binding
@@ -204,11 +450,137 @@ class RabbitClient(object):
             source=self.user_publish_exchange(username),
             routing_key='internal',
         )
+        self.management.invalidate(('exchanges',))
+        self.management.invalidate_bindings(self.user_publish_exchange(username), self.user_subscribe_exchange(username))
 
     def delete_user(self, username):
         self.ch.exchange.delete(self.user_publish_exchange(username))
         self.ch.exchange.delete(self.user_subscribe_exchange(username))
 
+        # Bindings of the user are gone with its exchanges
+        self.conversations.index.remove_user(username)
+        self.activity.index.remove_user(username)
+        self.management.invalidate()
+
+    @property
+    def pipeline(self):
+        """
+            Pipeline to run channel operations in bulk, created on first use.
+            Pooled clients share the one of the pool, on a single connection.
+        """
+        if self.pool is not None and self.pool.shared_client() is not self:
+            return self.pool.shared_client().pipeline
+        if self._pipeline is None:
+            self._pipeline = ChannelPipeline(self, channels=1)
+        return self._pipeline
+
+    def wait_for_channel(self, timeout=None):
+        """
+            Waits until the broker has processed the operations sent on the client
+            channel, as the nowait binds, using a passive declare as a barrier.
+            Returns False if timeout expires first or the channel is closed.
+        """
+        confirmed = load_gevent().event.Event() if self.transport == 'gevent' else []
+        callback = confirmed.set if self.transport == 'gevent' else lambda: confirmed.append(True)
+        self.ch.exchange.declare(exchange='amq.direct', type='direct', passive=True, cb=callback)
+
+        if self.transport == 'gevent':
+            return confirmed.wait(timeout)
+        deadline = None if timeout is None else time.time() + timeout
+        while not confirmed and not self.ch.closed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            self.wait_for_frames(remaining)
+        return bool(confirmed)
+
+    def unbind_exchanges(self, bindings):
+        """
+            Deletes a list of (source, destination, routing_key) exchange bindings,
+            in pipelined batches. Returns a PipelineReport.
+
+            The pipeline runs on its own connection, so it first waits for the
+            client channel, not to race with binds still being processed there.
+        """
+        bindings = list(bindings)
+        if bindings:
+            self.wait_for_channel()
+
+        def unbind(channel, binding):
+            source, destination, routing_key = binding
+            channel.exchange.unbind(exchange=destination, source=source, routing_key=routing_key)
+
+        try:
+            return self.pipeline.run(bindings, unbind)
+        finally:
+            self.management.invalidate_bindings(*set(exchange for binding in bindings for exchange in binding[:2]))
+
+    def bind_exchanges(self, bindings):
+        """
+            Creates a list of (source, destination, routing_key) exchange bindings,
+            in pipelined batches. Returns a PipelineReport.
+        """
+        bindings = list(bindings)
+        if bindings:
+            self.wait_for_channel()
+
+        def bind(channel, binding):
+            source, destination, routing_key = binding
+            channel.exchange.bind(exchange=destination, source=source, routing_key=routing_key)
+
+        try:
+            return self.pipeline.run(bindings, bind)
+        finally:
+            self.management.invalidate_bindings(*set(exchange for binding in bindings for exchange in binding[:2]))
+
+    def sync_bindings(self, wrapper, key, users):
+        """
+            Binds and unbinds users of a conversation or context, on a conversations
+            or activity wrapper, so the users bound to key are exactly users.
+            Only the difference against the wrapper index is sent to rabbit.
+        """
+        index = wrapper.index
+        if not index.loaded:
+            wrapper.rebuild_index()
+
+        current = index.users(key)
+        users = set(users)
+        added = users - current
+        removed = current - users
+
+        unbound = self.unbind_exchanges([binding for username in removed for binding in index.remove(key, username)])
+        bound = self.bind_exchanges([binding for username in added for binding in wrapper.user_bindings(key, username)])
+        for username in added:
+            for binding in wrapper.user_bindings(key, username):
+                index.add(key, username, binding)
+
+        # Partially applied changes leave the index unknown, reload it on next use
+        if unbound.failed_batches or bound.failed_batches:
+            index.loaded = False
+
+        return {
+            'added': sorted(added),
+            'removed': sorted(removed),
+            'bound': bound,
+            'unbound': unbound
+        }
+
+    def unbind_key(self, wrapper, key):
+        """
+            Unbinds all the users of a conversation or context, on a conversations
+            or activity wrapper. Returns the PipelineReport of the unbinds.
+        """
+        index = wrapper.index
+        if not index.loaded:
+            wrapper.rebuild_index()
+
+        report = self.unbind_exchanges(index.pop(key))
+
+        # The bindings of failed batches are still in rabbit, reload the index on next use
+        if report.failed_batches:
+            index.loaded = False
+        return report
+
     def user_publish_exchange(self, username):
         """
             Returns name of exchange used to send messages to rabbit
@@ -222,44 +594,586 @@ class RabbitClient(object):
         """
         return '{}.subscribe'.format(username)
 
+    def encode(self, message):
+        """
+            Returns the body to send for a message, timed in maxcarrot_codec_seconds
+        """
+        with self.metrics.timer('maxcarrot_codec_seconds', operation='encode'):
+            return encode_body(message)
+
+    def decode(self, message_obj):
+        """
+            Returns the (payload, message) tuple of a received message, timed in maxcarrot_codec_seconds
+        """
+        with self.metrics.timer('maxcarrot_codec_seconds', operation='decode'):
+            return decode_body(message_obj)
+
     def send(self, exchange, message, routing_key=''):
-        body = message if isinstance(message, basestring) else json.dumps(message)
+        body = self.encode(message)
         message = Message(body)
         self.ch.publish(message, exchange, routing_key=routing_key)
 
+    def send_many(self, messages, confirm=True, window=1000, ack_cb=None, nack_cb=None, timeout=None):
+        """
+            Publishes an iterable of (exchange, routing_key, message) tuples back to back.
+
+            With confirm=True, messages are published through the client RabbitPublisher,
+            tracking publisher confirms. See RabbitPublisher.publish_many for the parameters.
+            Returns a dict with published, acked, nacked and pending counts.
+        """
+        bodies = ((exchange, routing_key, self.encode(message)) for exchange, routing_key, message in messages)
+
+        if not confirm:
+            published = 0
+            for exchange, routing_key, body in bodies:
+                self.ch.publish(Message(body), exchange, routing_key=routing_key)
+                published += 1
+            return {'published': published, 'acked': 0, 'nacked': 0, 'pending': 0}
+
+        return self.publisher.publish_many(bodies, window=window, ack_cb=ack_cb, nack_cb=nack_cb, timeout=timeout)
+
+    @property
+    def publisher(self):
+        """
+            Publisher with confirms enabled, on its own channel, created on first use
+        """
+        if self._publisher is None:
+            self._publisher = RabbitPublisher(self)
+        return self._publisher
+
     def send_internal(self, message):
         self.send(self.user_publish_exchange(self.user), message, routing_key='internal')
 
-    def get_all(self, queue=None, retry=False):
+    def get_all(self, queue=None, retry=False, timeout=None, max_messages=None, max_bytes=None):
+        """
+            Returns a list with all the messages in a queue, defaults to the user queue.
+            See iter_all for the meaning of the parameters.
+        """
+        return list(self.iter_all(queue, retry=retry, timeout=timeout, max_messages=max_messages, max_bytes=max_bytes))
+
+    def iter_all(self, queue=None, retry=False, timeout=None, max_messages=None, max_bytes=None):
+        """
+            Generator that yields (payload, message) tuples for the messages in a queue,
+            one at a time, until the queue is empty.
+
+            With retry=True and an empty queue, waits for a message to arrive, for
+            timeout seconds or forever if timeout is None. The wait sleeps on the socket,
+            using a consumer with a prefetch of one message, instead of polling the queue.
+
+            Stops early when max_messages are received, or once the received bodies
+            reach max_bytes.
+        """
         queue_name = self.queue if queue is None else queue
-        messages = []
-        message_obj = True
-        tries = 1 if not retry else -1
-        while not(tries == 0 or messages != []):
-            while message_obj is not None:
-                message_obj = self.get(queue_name)
-                if message_obj is not None:
-                    tries = 1
-                    try:
-                        message = (json.loads(str(message_obj.body)), message_obj)
-                    except ValueError:
-                        message = (message_obj.body, message_obj)
-                    messages.append(message)
-            tries -= 1
-            message_obj = True
-        return messages
+        deadline = None if timeout is None else time.time() + timeout
+        received = 0
+        received_bytes = 0
+
+        while True:
+            message_obj = self.get(queue_name)
+            if message_obj is not None:
+                message = self.decode(message_obj)
+            elif received or not retry:
+                return
+            else:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return
+                message = self._wait_for_message(queue_name, remaining)
+                if message is None:
+                    return
+                message_obj = message[1]
+
+            received += 1
+            received_bytes += len(message_obj.body)
+            yield message
+
+            if max_messages is not None and received >= max_messages:
+                return
+            if max_bytes is not None and received_bytes >= max_bytes:
+                return
+
+    def _wait_for_message(self, queue_name, timeout=None):
+        """
+            Blocks until a message arrives to the queue, and returns it as
+            a (payload, message) tuple, or None if timeout expires.
+
+            The consumer sets a prefetch of one message on the client channel,
+            the previous prefetch is set back for the consumers started later.
+        """
+        previous_prefetch_count = self.prefetch_count
+        consumer = RabbitConsumer(self, queue_name, prefetch_count=1, no_ack=False)
+        consumer.start()
+        try:
+            delivery = consumer.get(timeout)
+        finally:
+            consumer.cancel()
+            if self.prefetch_count != previous_prefetch_count and self.connected:
+                self.ch.basic.qos(prefetch_count=previous_prefetch_count)
+                self.prefetch_count = previous_prefetch_count
+
+        # Messages delivered while cancelling go back to the queue
+        for payload, message_obj in consumer.deliveries:
+            self.ch.basic.reject(message_obj.delivery_info['delivery_tag'], requeue=True)
+
+        if delivery is not None:
+            consumer.ack(delivery[1])
+        return delivery
 
     def get(self, queue_name):
         return self.ch.basic.get(queue_name)
 
+    def consume(self, queue=None, prefetch_count=100, no_ack=False, timeout=None):
+        """
+            Starts a push based consumer on a queue, defaults to the user queue.
+            Returns a RabbitConsumer, see its docs for usage.
+
+            Up to prefetch_count messages are in flight, acked as they are
+            iterated or by run(). With no_ack=True the broker acks them on
+            delivery and pushes them without limit.
+        """
+        queue_name = self.queue if queue is None else queue
+        consumer = RabbitConsumer(self, queue_name, prefetch_count=prefetch_count, no_ack=no_ack, timeout=timeout)
+        consumer.start()
+        return consumer
+
+    @property
+    def connected(self):
+        """
+            False once the connection is closed, or its transport was lost
+        """
+        if self.connection is None or self.connection.closed:
+            return False
+        # haigha drops the transport of lost connections without closing them
+        return self.transport == 'memory' or self.connection.transport is not None
+
+    def wait_for_frames(self, timeout=None):
+        """
+            Waits until the connection socket is readable, and processes
+            the incoming frames. Returns False if timeout expired with nothing read.
+        """
+        if self.transport == 'memory':
+            return self.connection.wait(timeout)
+        if self.connection is None or self.connection.transport is None:
+            return False
+        try:
+            readable, writable, errored = select.select([self.connection.transport._sock], [], [], timeout)
+        except select.error as error:
+            # Interrupted by a signal, let the caller check if it has to stop
+            if error.args[0] != errno.EINTR:
+                raise
+            return False
+        if not readable:
+            return False
+        self.connection.read_frames()
+        return True
+
+
+class RabbitConsumer(object):
+    """
+        Push based consumer of a queue using basic.consume
+
+        The broker pushes messages as they arrive, with up to prefetch_count
+        unacknowledged messages in flight, so there's no round trip per message.
+        Prefetch only applies with the default no_ack=False: iterating acks each
+        delivery when the next one is requested, and run() acks each batch once
+        its callback returns. Deliveries read with get() must be acked with ack().
+        With no_ack=True, messages are acked on delivery and pushed without limit.
+
+        Iterate the consumer to get (payload, message) tuples. Iteration stops
+        when timeout expires without deliveries, or the consumer is cancelled.
+        A delivery left by breaking out of the loop is not acked, and the broker
+        delivers it again once the channel closes.
+        Use run() to get the deliveries in batches through a callback.
+
+        With decode=False, the payload is the raw body string, to decode it elsewhere.
+    """
+
+    consumer_tags = count(1)
+
+    def __init__(self, client, queue, prefetch_count=100, no_ack=False, timeout=None, decode=True):
+        self.client = client
+        self.queue = queue
+        self.prefetch_count = prefetch_count
+        self.no_ack = no_ack
+        self.timeout = timeout
+        self.decode = decode
+        self.consumer_tag = None
+        self.deliveries = deque()
+        self._iterated = None
+        self._delivered = load_gevent().event.Event() if client.transport == 'gevent' else None
+
+    def start(self):
+        """
+            Registers the consumer on the broker
+        """
+        if self.prefetch_count and not self.no_ack:
+            self.client.ch.basic.qos(prefetch_count=self.prefetch_count)
+            self.client.prefetch_count = self.prefetch_count
+
+        self.consumer_tag = 'maxcarrot.{}.{}'.format(self.queue, next(self.consumer_tags))
+        if self not in self.client.consumers:
+            self.client.consumers.append(self)
+        self.client.ch.basic.consume(
+            queue=self.queue,
+            consumer=self._on_message,
+            consumer_tag=self.consumer_tag,
+            no_ack=self.no_ack,
+            cancel_cb=self._on_cancel
+        )
+
+    def cancel(self):
+        """
+            Stops receiving messages. Messages already delivered can still be read.
+        """
+        if self.consumer_tag is not None:
+            self.client.ch.basic.cancel(consumer_tag=self.consumer_tag)
+            self.consumer_tag = None
+        if self in self.client.consumers:
+            self.client.consumers.remove(self)
+
+    def ack(self, message, multiple=False):
+        """
+            Acknowledges a delivered message, or all messages up to it if multiple=True
+        """
+        self.client.ch.basic.ack(message.delivery_info['delivery_tag'], multiple=multiple)
+
+    def _on_message(self, message_obj):
+        self.deliveries.append(self.client.decode(message_obj) if self.decode else (str(message_obj.body), message_obj))
+        if self._delivered is not None:
+            self._delivered.set()
+
+    def _on_cancel(self, consumer_tag):
+        self.consumer_tag = None
+        if self in self.client.consumers:
+            self.client.consumers.remove(self)
+        if self._delivered is not None:
+            self._delivered.set()
+
+    def _wait(self, timeout):
+        if self._delivered is not None:
+            self._delivered.wait(timeout)
+            self._delivered.clear()
+        else:
+            self.client.wait_for_frames(timeout)
+
+    def get(self, timeout=None):
+        """
+            Returns the next (payload, message) delivery, or None if timeout
+            expires, the consumer is cancelled or the connection is lost
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.deliveries:
+            if self.consumer_tag is None or not self.client.connected:
+                return None
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            self._wait(remaining)
+        return self.deliveries.popleft()
+
+    def get_batch(self, size, timeout=None):
+        """
+            Waits for a delivery, and returns it with the ones already
+            received, up to size. Returns an empty list if timeout expires.
+        """
+        delivery = self.get(timeout)
+        if delivery is None:
+            return []
+        if len(self.deliveries) < size - 1 and self._delivered is None:
+            # Process any frame already waiting in the socket, without blocking
+            self.client.wait_for_frames(0)
+        batch = [delivery]
+        while self.deliveries and len(batch) < size:
+            batch.append(self.deliveries.popleft())
+        return batch
+
+    def run(self, callback, batch_size=100):
+        """
+            Calls callback with lists of up to batch_size deliveries,
+            until timeout expires without deliveries or the consumer is cancelled.
+            If no_ack=False, each batch is acked after the callback returns.
+        """
+        while True:
+            batch = self.get_batch(batch_size, self.timeout)
+            if not batch:
+                return
+            callback(batch)
+            if not self.no_ack:
+                self.ack(batch[-1][1], multiple=True)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        # The previous delivery was handled by the loop body
+        if self._iterated is not None:
+            if self.client.connected:
+                self.ack(self._iterated)
+            self._iterated = None
+        delivery = self.get(self.timeout)
+        if delivery is None:
+            raise StopIteration
+        if not self.no_ack:
+            self._iterated = delivery[1]
+        return delivery
+
+
+class ShardWorkers(object):
+    """
+        Consumes the shards of a sharded queue, with one worker per shard.
+
+        Each worker has its own client, connected to the node hosting its shard
+        when url lists the nodes of a cluster, and consumes its shard with
+        no_ack=False. callback is called with the batches of deliveries of a
+        shard, one batch at a time, and each batch is acked once callback returns,
+        so the messages of a conversation are processed in order.
+
+        Workers run in greenlets with the gevent transport, and in threads
+        otherwise. They check if they were stopped after each batch, or every
+        poll_interval seconds when their shard is empty.
+    """
+
+    def __init__(self, url, queue, shards, callback, batch_size=100, prefetch_count=100, poll_interval=1, transport='socket', **client_options):
+        self.url = url
+        self.queue = queue
+        from maxcarrot.sharding import shard_queues
+        self.queues = shard_queues(queue, shards)
+        self.callback = callback
+        self.batch_size = batch_size
+        self.prefetch_count = prefetch_count
+        self.poll_interval = poll_interval
+        self.transport = transport
+        self.client_options = client_options
+        self.processed = {name: 0 for name in self.queues}
+        self.active = set()
+        self.running = False
+        self.workers = []
+
+        # Fallback to threads if gevent not available
+        if self.transport == 'gevent' and load_gevent() is None:
+            self.transport = 'socket'
+
+    def start(self):
+        """
+            Connects a client for each shard, and starts the workers
+        """
+        self.running = True
+        for name in self.queues:
+            client = RabbitClient(self.url, transport=self.transport, queue_affinity=name, **self.client_options)
+            consumer = RabbitConsumer(client, name, prefetch_count=self.prefetch_count, no_ack=False, timeout=self.poll_interval)
+            consumer.start()
+            if self.transport == 'gevent':
+                worker = load_gevent().spawn(self._work, client, consumer)
+            else:
+                worker = threading.Thread(target=self._work, args=(client, consumer), name='maxcarrot-{}'.format(name))
+                worker.daemon = True
+                worker.start()
+            self.workers.append(worker)
+
+    def _work(self, client, consumer):
+        self.active.add(consumer.queue)
+        try:
+            # The consumer is cancelled for good when the shard is deleted, and
+            # the connection only stays lost without failover
+            while self.running and consumer.consumer_tag is not None and client.connected:
+                batch = consumer.get_batch(self.batch_size, self.poll_interval)
+                if not batch:
+                    continue
+                self.callback(batch)
+                consumer.ack(batch[-1][1], multiple=True)
+                self.processed[consumer.queue] += len(batch)
+
+            if not client.connected:
+                # The broker requeues the unacked deliveries of lost connections
+                return
+
+            # Deliveries not processed yet go back to the shard
+            consumer.cancel()
+            for payload, message_obj in consumer.deliveries:
+                client.ch.basic.reject(message_obj.delivery_info['delivery_tag'], requeue=True)
+            consumer.deliveries.clear()
+        finally:
+            client.disconnect()
+            self.active.discard(consumer.queue)
+
+    def stop(self, timeout=None):
+        """
+            Stops the workers once they finish their current batch, and waits for them
+        """
+        self.running = False
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        """
+            Waits for the workers to finish, up to timeout seconds for all of them
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time.time(), 0))
+
+    @property
+    def stats(self):
+        """
+            Messages processed from each shard
+        """
+        return {
+            'workers': len(self.active),
+            'processed': dict(self.processed)
+        }
+
+
+class RabbitPublisher(object):
+    """
+        Publishes messages on a dedicated channel in publisher confirm mode
+
+        Messages are published back to back, keeping up to a window of messages
+        published but not yet confirmed by the broker. Confirms are tracked
+        asynchronously and reported to the ack and nack callbacks, with the
+        (exchange, routing_key, body) tuple of the confirmed message.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}
+        self.published = 0
+        self.acked = 0
+        self.nacked = 0
+        self.ack_cb = None
+        self.nack_cb = None
+        self._confirmed = load_gevent().event.Event() if client.transport == 'gevent' else None
+
+        self.ch = MeteredChannel(client.connection.channel(), client.metrics)
+        self.ch.confirm.select()
+        self.ch.basic.set_ack_listener(self._on_ack)
+        self.ch.basic.set_nack_listener(self._on_nack)
+
+    def _on_ack(self, msg_id):
+        published = self.pending.pop(msg_id, None)
+        self.acked += 1
+        self.client.metrics.inc('maxcarrot_confirms_total', result='ack')
+        if self.ack_cb is not None and published is not None:
+            self.ack_cb(published)
+        if self._confirmed is not None:
+            self._confirmed.set()
+
+    def _on_nack(self, msg_id, requeue):
+        published = self.pending.pop(msg_id, None)
+        self.nacked += 1
+        self.client.metrics.inc('maxcarrot_confirms_total', result='nack')
+        if self.nack_cb is not None and published is not None:
+            self.nack_cb(published)
+        if self._confirmed is not None:
+            self._confirmed.set()
+
+    def _wait(self, timeout):
+        if self._confirmed is not None:
+            self._confirmed.wait(timeout)
+            self._confirmed.clear()
+        else:
+            self.client.wait_for_frames(timeout)
+
+    def publish(self, exchange, routing_key, body):
+        """
+            Publishes a single encoded body, without waiting for its confirm
+        """
+        msg_id = self.ch.basic.publish(Message(body), exchange, routing_key)
+        self.pending[msg_id] = (exchange, routing_key, body)
+        self.published += 1
+
+    def wait_for_confirms(self, max_pending=0, timeout=None):
+        """
+            Waits until there are at most max_pending messages unconfirmed.
+            Returns False if timeout expires before.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.pending) > max_pending:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._wait(remaining)
+        return True
+
+    def publish_many(self, bodies, window=1000, ack_cb=None, nack_cb=None, timeout=None):
+        """
+            Publishes an iterable of (exchange, routing_key, body) tuples, waiting
+            for confirms only when window messages are pending.
+
+            Returns when all the messages are confirmed, or when waiting for
+            confirms takes more than timeout seconds, with a dict of counts.
+            Publishing stops if the window doesn't get a free slot in time.
+            ack_cb and nack_cb only apply to the messages of this call.
+        """
+        previous_callbacks = self.ack_cb, self.nack_cb
+        self.ack_cb = ack_cb
+        self.nack_cb = nack_cb
+        published, acked, nacked = self.published, self.acked, self.nacked
+
+        try:
+            for exchange, routing_key, body in bodies:
+                if len(self.pending) >= window and not self.wait_for_confirms(max_pending=window - 1, timeout=timeout):
+                    break
+                self.publish(exchange, routing_key, body)
+            else:
+                self.wait_for_confirms(timeout=timeout)
+        finally:
+            self.ack_cb, self.nack_cb = previous_callbacks
+
+        return {
+            'published': self.published - published,
+            'acked': self.acked - acked,
+            'nacked': self.nacked - nacked,
+            'pending': len(self.pending)
+        }
+
 
 class RabbitConversations(object):
     """
         Wrapper around conversations, to send and receive messages as a user
     """
 
-    def __init__(self, client):
+    def __init__(self, client, index=None):
         self.client = client
+        self.index = index if index is not None else BindingIndex()
+
+    def routing_key(self, conversation):
+        return '{}.*'.format(conversation)
+
+    def parse_binding(self, binding):
+        """
+            Returns the (conversation, username, binding) of a conversations exchange
+            binding loaded from the management api, or None if it's not a user binding
+        """
+        if binding.get('destination_type', 'exchange') != 'exchange' or not binding['routing_key'].endswith('.*'):
+            return None
+        if binding['source'] == 'conversations' and binding['destination'].endswith('.subscribe'):
+            username = binding['destination'][:-len('.subscribe')]
+        elif binding['destination'] == 'conversations' and binding['source'].endswith('.publish'):
+            username = binding['source'][:-len('.publish')]
+        else:
+            return None
+        return binding['routing_key'][:-2], username, (binding['source'], binding['destination'], binding['routing_key'])
+
+    def user_bindings(self, conversation, username):
+        """
+            Returns the (source, destination, routing_key) bindings between
+            a conversation and a user
+        """
+        routing_key = self.routing_key(conversation)
+        return [
+            (self.client.user_publish_exchange(username), 'conversations', routing_key),
+            ('conversations', self.client.user_subscribe_exchange(username), routing_key)
+        ]
+
+    def rebuild_index(self):
+        """
+            Loads the index with all the conversation bindings, from the management api
+        """
+        self.index.clear()
+        for binding in self.client.management.load_exchange_bindings('conversations'):
+            parsed = self.parse_binding(binding)
+            if parsed is not None:
+                self.index.add(*parsed)
+        self.index.loaded = True
 
     def send(self, conversation, message, destination='messages'):
         routing_key = '{}.{}'.format(conversation, destination)
@@ -268,6 +1182,16 @@ class RabbitConversations(object):
             message,
             routing_key=routing_key)
 
+    def send_many(self, messages, destination='messages', **kwargs):
+        """
+            Publishes an iterable of (conversation, message) tuples back to back,
+            with publisher confirms. Accepts the same options as RabbitClient.send_many.
+        """
+        exchange = self.client.user_publish_exchange(self.client.user)
+        return self.client.send_many(
+            ((exchange, '{}.{}'.format(conversation, destination), message) for conversation, message in messages),
+            **kwargs)
+
     def create(self, conversation, users):
         """
             Batch creates conversation bindings for a bunch
@@ -281,45 +1205,55 @@ class RabbitConversations(object):
             Creates the bindings to route messages between
             a conversation and a user
         """
+        routing_key = self.routing_key(conversation)
         self.client.ch.exchange.bind(
             exchange='conversations',
             source=self.client.user_publish_exchange(username),
-            routing_key='{}.*'.format(conversation)
+            routing_key=routing_key
         )
         self.client.ch.exchange.bind(
             exchange=self.client.user_subscribe_exchange(username),
             source='conversations',
-            routing_key='{}.*'.format(conversation)
+            routing_key=routing_key
         )
+        for binding in self.user_bindings(conversation, username):
+            self.index.add(conversation, username, binding)
+            self.client.management.invalidate_bindings(*binding[:2])
 
     def unbind_user(self, conversation, username):
         """
             Deletes the bindings to route messages between
             a conversation and a user
         """
+        routing_key = self.routing_key(conversation)
         self.client.ch.exchange.unbind(
             exchange='conversations',
             source=self.client.user_publish_exchange(username),
-            routing_key='{}.*'.format(conversation)
+            routing_key=routing_key
         )
         self.client.ch.exchange.unbind(
             exchange=self.client.user_subscribe_exchange(username),
             source='conversations',
-            routing_key='{}.*'.format(conversation)
+            routing_key=routing_key
         )
+        self.index.remove(conversation, username)
+        for binding in self.user_bindings(conversation, username):
+            self.client.management.invalidate_bindings(*binding[:2])
 
     def delete(self, conversation):
         """
-            Deletes all the bindings for a specific conversation
+            Deletes all the bindings for a specific conversation.
+            Bindings are found in the index, loaded again from the management
+            api once expired, and unbound in pipelined batches.
         """
-        bindings = self.client.management.load_exchange_bindings('conversations')
-        for binding in bindings:
-            if binding['routing_key'].startswith(conversation):
-                self.client.ch.exchange.unbind(
-                    exchange=binding['destination'],
-                    source=binding['source'],
-                    routing_key=binding['routing_key']
-                )
+        return self.client.unbind_key(self, conversation)
+
+    def sync(self, conversation, users):
+        """
+            Makes users the exact members of a conversation, binding and unbinding
+            only the users that changed. Returns the added and removed users.
+        """
+        return self.client.sync_bindings(self, conversation, users)
 
 
 class RabbitActivity(object):
@@ -327,8 +1261,39 @@ class RabbitActivity(object):
         Wrapper around context activity, to receive messages as a user
     """
 
-    def __init__(self, wrapper):
+    def __init__(self, wrapper, index=None):
         self.client = wrapper
+        self.index = index if index is not None else BindingIndex()
+
+    def parse_binding(self, binding):
+        """
+            Returns the (context, username, binding) of an activity exchange
+            binding loaded from the management api, or None if it's not a user binding
+        """
+        if binding.get('destination_type', 'exchange') != 'exchange' or binding['source'] != 'activity':
+            return None
+        if not binding['destination'].endswith('.subscribe'):
+            return None
+        username = binding['destination'][:-len('.subscribe')]
+        return binding['routing_key'], username, (binding['source'], binding['destination'], binding['routing_key'])
+
+    def user_bindings(self, context, username):
+        """
+            Returns the (source, destination, routing_key) bindings
+            from a context to a user
+        """
+        return [('activity', self.client.user_subscribe_exchange(username), context)]
+
+    def rebuild_index(self):
+        """
+            Loads the index with all the context bindings, from the management api
+        """
+        self.index.clear()
+        for binding in self.client.management.load_exchange_bindings('activity'):
+            parsed = self.parse_binding(binding)
+            if parsed is not None:
+                self.index.add(*parsed)
+        self.index.loaded = True
 
     def create(self, context, users):
         """
@@ -348,6 +1313,9 @@ class RabbitActivity(object):
             source='activity',
             routing_key=context
         )
+        for binding in self.user_bindings(context, username):
+            self.index.add(context, username, binding)
+            self.client.management.invalidate_bindings(*binding[:2])
 
     def unbind_user(self, context, username):
         """
@@ -359,16 +1327,21 @@ class RabbitActivity(object):
             source='activity',
             routing_key=context
         )
+        self.index.remove(context, username)
+        for binding in self.user_bindings(context, username):
+            self.client.management.invalidate_bindings(*binding[:2])
 
     def delete(self, context):
         """
-            Deletes all the bindings for a specific conversation
+            Deletes all the bindings for a specific context.
+            Bindings are found in the index, loaded again from the management
+            api once expired, and unbound in pipelined batches.
         """
-        bindings = self.client.management.load_exchange_bindings('activity')
-        for binding in bindings:
-            if binding['routing_key'].startswith(context):
-                self.client.ch.exchange.unbind(
-                    exchange=binding['destination'],
-                    source=binding['source'],
-                    routing_key=binding['routing_key']
-                )
+        return self.client.unbind_key(self, context)
+
+    def sync(self, context, users):
+        """
+            Makes users the exact subscribers of a context, binding and unbinding
+            only the users that changed. Returns the added and removed users.
+        """
+        return self.client.sync_bindings(self, context, users)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+PLAIN = 0
+VALUES = 1
+FIELDS = 2
+
+
+class SpecCodec(object):
+    """
+        Packs and unpacks messages following a specification.
+
+        The specification is compiled once into flat lookup tables indexed
+        by field name (to pack) and by field id (to unpack), so each message
+        field costs a single dict lookup instead of walking the specification.
+
+        With a metrics registry, pack and unpack are timed in maxcarrot_codec_seconds.
+        It can also be set later, e.g. CODEC.metrics = METRICS, and unset with None.
+    """
+
+    def __init__(self, specification, metrics=None):
+        self.specification = specification
+        self.metrics = metrics
+        self.packers = {}
+        self.unpackers = {}
+        self.field_unpackers = {}
+
+        for name, spec in specification.items():
+            values = spec.get('values', {})
+            fields = spec.get('fields', {})
+
+            if values:
+                pack_table = {}
+                unpack_table = {}
+                for value_name, value_spec in values.items():
+                    pack_table[value_name] = value_spec['id']
+                    unpack_table[value_spec['id']] = value_name
+                self.packers[name] = (VALUES, spec['id'], pack_table)
+                self.unpackers[spec['id']] = (VALUES, name, unpack_table)
+                self.field_unpackers[name] = (VALUES, spec['id'], unpack_table)
+
+            elif fields and spec['type'] == 'object':
+                pack_table = {}
+                unpack_table = {}
+                for field_name, field_spec in fields.items():
+                    pack_table[field_name] = field_spec['id']
+                    unpack_table[field_spec['id']] = field_name
+                self.packers[name] = (FIELDS, spec['id'], pack_table)
+                self.unpackers[spec['id']] = (FIELDS, name, unpack_table)
+                self.field_unpackers[name] = (FIELDS, spec['id'], unpack_table)
+
+            else:
+                self.packers[name] = (PLAIN, spec['id'], None)
+                self.unpackers[spec['id']] = (PLAIN, name, None)
+                self.field_unpackers[name] = (PLAIN, spec['id'], None)
+
+    def pack(self, message):
+        """
+            Returns a packed copy of an unpacked message dict.
+        """
+        if self.metrics is not None:
+            with self.metrics.timer('maxcarrot_codec_seconds', operation='pack'):
+                return self._pack(message)
+        return self._pack(message)
+
+    def _pack(self, message):
+        packed = {}
+        packers = self.packers
+
+        for field, value in message.items():
+            packer = packers.get(field)
+            if packer is None:
+                continue
+
+            kind, key, table = packer
+            if kind is VALUES:
+                packed_value = table.get(value)
+                if packed_value is not None:
+                    packed[key] = packed_value
+            elif kind is FIELDS and isinstance(value, dict):
+                packed[key] = {table.get(inner_field, inner_field): inner_value for inner_field, inner_value in value.items()}
+            else:
+                packed[key] = value
+
+        return packed
+
+    def unpack(self, packed):
+        """
+            Returns an unpacked copy of a packed message dict.
+        """
+        if self.metrics is not None:
+            with self.metrics.timer('maxcarrot_codec_seconds', operation='unpack'):
+                return self._unpack(packed)
+        return self._unpack(packed)
+
+    def _unpack(self, packed):
+        unpacked = {}
+        unpackers = self.unpackers
+
+        for field, value in packed.items():
+            unpacker = unpackers.get(field)
+            if unpacker is None:
+                continue
+
+            kind, name, table = unpacker
+            if kind is VALUES:
+                if isinstance(value, basestring):
+                    unpacked_value = table.get(value)
+                    if unpacked_value is not None:
+                        unpacked[name] = unpacked_value
+            elif kind is FIELDS and isinstance(value, dict):
+                unpacked[name] = {table.get(inner_field, inner_field): inner_value for inner_field, inner_value in value.items()}
+            else:
+                unpacked[name] = value
+
+        return unpacked
+
+    def unpack_field(self, packed, name):
+        """
+            Unpacks a single field by its unpacked name, without
+            touching the rest of the packed message.
+
+            Raises KeyError if the field is not present in the packed
+            message or its value cannot be unpacked.
+        """
+        kind, key, table = self.field_unpackers[name]
+        value = packed[key]
+
+        if kind is VALUES:
+            unpacked_value = table.get(value) if isinstance(value, basestring) else None
+            if unpacked_value is None:
+                raise KeyError(name)
+            return unpacked_value
+        elif kind is FIELDS and isinstance(value, dict):
+            return {table.get(inner_field, inner_field): inner_value for inner_field, inner_value in value.items()}
+        return value
+
+    def pack_many(self, messages):
+        """
+            Packs a sequence of unpacked messages
+        """
+        pack = self.pack
+        return [pack(message) for message in messages]
+
+    def unpack_many(self, packed_messages):
+        """
+            Unpacks a sequence of packed messages
+        """
+        unpack = self.unpack
+        return [unpack(packed) for packed in packed_messages]
+
+
+class LazySpecCodec(SpecCodec):
+    """
+        SpecCodec loading and compiling its specification on first use.
+        load is called without arguments and returns the specification.
+    """
+
+    compiled_attributes = ('specification', 'packers', 'unpackers', 'field_unpackers')
+
+    def __init__(self, load, metrics=None):
+        self._load = load
+        self.metrics = metrics
+
+    def __getattr__(self, attr):
+        if attr not in self.compiled_attributes:
+            raise AttributeError(attr)
+        # Compile apart and publish all the tables at once, so concurrent
+        # first uses never see them half built
+        compiled = SpecCodec(self._load())
+        self.__dict__.update(dict((name, getattr(compiled, name)) for name in self.compiled_attributes))
+        return getattr(self, attr)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+try:
+    import ujson
+    ujson_available = True
+except:
+    ujson_available = False
+
+try:
+    import simplejson
+    simplejson_available = True
+except:
+    simplejson_available = False
+
+
+def normalize_json(message):
+    """
+        Escapes control chars and slashes found in a json body, to be able
+        to decode bodies that contain them unescaped.
+    """
+    def control_char_replace(matchobj):
+        return matchobj.group()[0].encode('string_escape')
+    normalized = re.sub(r'[\n\t\r\f\b\/\\]', control_char_replace, message)
+    return normalized
+
+
+def get_backend(name=None):
+    """
+        Returns a (name, loads) tuple for the requested json backend.
+        If no name is given, the fastest backend installed is used.
+    """
+    if name is None:
+        name = 'ujson' if ujson_available else 'simplejson' if simplejson_available else 'json'
+
+    if name == 'ujson' and ujson_available:
+        return name, ujson.loads
+    if name == 'simplejson' and simplejson_available:
+        return name, simplejson.loads
+    if name == 'json':
+        return name, json.loads
+
+    raise ValueError('JSON backend "{}" is not available'.format(name))
+
+
+class JSONDecoder(object):
+    """
+        Decodes json message bodies.
+
+        Bodies are parsed strictly first, using the fastest json backend available.
+        Only the bodies that fail to parse go through the repair path, where
+        unescaped control chars are normalized before parsing them again
+        with the standard json module.
+    """
+
+    def __init__(self, backend=None):
+        self.backend, self._loads = get_backend(backend)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.decoded = 0
+        self.repaired = 0
+        self.failed = 0
+
+    @property
+    def stats(self):
+        """
+            Counters of decoded bodies, and how many of them needed a repair
+        """
+        return {
+            'backend': self.backend,
+            'decoded': self.decoded,
+            'repaired': self.repaired,
+            'failed': self.failed,
+            'repair_ratio': float(self.repaired) / self.decoded if self.decoded else 0.0
+        }
+
+    def loads(self, body):
+        self.decoded += 1
+        try:
+            return self._loads(body)
+        except Exception:
+            pass
+
+        self.repaired += 1
+        try:
+            return json.loads(normalize_json(body))
+        except Exception:
+            self.failed += 1
+            raise
+
+
+# Decoder shared by all messages
+DECODER = JSONDecoder()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+class BindingIndex(object):
+    """
+        Local index of the exchange bindings of conversations or contexts.
+
+        Bindings are indexed by key (conversation or context) and username, and
+        stored as (source, destination, routing_key) tuples, so the bindings of
+        a key can be found without listing all the bindings of the exchange.
+
+        The index is complete only after being loaded from the management api.
+        Until then, it only holds the bindings created through this client.
+        Bindings made by other clients are not seen until it's loaded again, so
+        it's considered not loaded ttl seconds after loading it. With ttl=None
+        it never expires.
+    """
+
+    def __init__(self, ttl=30):
+        self.bindings = {}
+        self.keys_by_user = {}
+        self.ttl = ttl
+        self.loaded_at = None
+
+    @property
+    def loaded(self):
+        if self.loaded_at is None:
+            return False
+        return self.ttl is None or time.time() - self.loaded_at < self.ttl
+
+    @loaded.setter
+    def loaded(self, loaded):
+        self.loaded_at = time.time() if loaded else None
+
+    def clear(self):
+        self.bindings.clear()
+        self.keys_by_user.clear()
+        self.loaded = False
+
+    def add(self, key, username, binding):
+        """
+            Adds a (source, destination, routing_key) binding of a user to a key
+        """
+        self.bindings.setdefault(key, {}).setdefault(username, set()).add(binding)
+        self.keys_by_user.setdefault(username, set()).add(key)
+
+    def remove(self, key, username):
+        """
+            Removes the bindings of a user to a key, and returns them
+        """
+        users = self.bindings.get(key, {})
+        removed = users.pop(username, set())
+        if not users:
+            self.bindings.pop(key, None)
+
+        keys = self.keys_by_user.get(username, set())
+        keys.discard(key)
+        if not keys:
+            self.keys_by_user.pop(username, None)
+        return removed
+
+    def pop(self, key):
+        """
+            Removes all the bindings of a key, and returns them
+        """
+        removed = []
+        for username in list(self.bindings.get(key, {})):
+            removed.extend(self.remove(key, username))
+        return removed
+
+    def remove_user(self, username):
+        """
+            Removes all the bindings of a user, and returns them
+        """
+        removed = []
+        for key in list(self.keys_by_user.get(username, set())):
+            removed.extend(self.remove(key, username))
+        return removed
+
+    def users(self, key):
+        """
+            Returns the set of users with bindings to a key
+        """
+        return set(self.bindings.get(key, {}))
+
+    def keys(self, username):
+        """
+            Returns the set of keys a user has bindings to
+        """
+        return set(self.keys_by_user.get(username, set()))
@@ -1,34 +1,276 @@
+from maxcarrot.metrics import METRICS
+from maxcarrot.pipeline import ChannelPipeline
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+
 import requests
 import re
+import threading
+import time
 from itertools import chain
+from itertools import islice
 import json
 
+try:
+    import ijson
+    ijson_available = True
+except:
+    ijson_available = False
+
+
+class SpecMatcher(object):
+    """
+        Finds the first resource spec matching a name, as re.match on each spec
+        in order would, with all the specs compiled into a single regex.
+    """
+
+    def __init__(self, specs):
+        self.specs = {}
+        patterns = []
+        for index, spec in enumerate(specs):
+            group = 'spec{}'.format(index)
+            self.specs[group] = spec
+            patterns.append('(?P<{}>{})'.format(group, spec['spec']))
+        self.regex = re.compile('|'.join(patterns))
+        self.types = {spec['type']: re.compile(spec['type']) for spec in specs if 'type' in spec}
+
+    def match(self, name):
+        """
+            Returns the first spec matching name, or None
+        """
+        match = self.regex.match(name)
+        return self.specs[match.lastgroup] if match else None
+
+    def mismatches(self, resource, spec):
+        """
+            Returns True if a resource loaded from the management api
+            doesn't have the type and flags defined in the spec
+        """
+        types_match = 'type' not in spec or self.types[spec['type']].match(resource['type'])
+        autodelete_match = spec.get('auto_delete', False) == resource['auto_delete']
+        durable_match = spec.get('durable', True) == resource['durable']
+        return not types_match or not autodelete_match or not durable_match
+
+
+class ManagementCache(object):
+    """
+        Cache of management api results, each kept for ttl seconds.
+
+        Holds up to size entries, the least recently used are dropped
+        when full. Keys are ('exchanges',), ('queues',) and
+        ('bindings', exchange) tuples.
+
+        The cache can be shared by threads, the lock is not held while
+        loading, and results loaded across an invalidation are not cached.
+    """
+
+    def __init__(self, ttl=30, size=1000):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, load):
+        """
+            Returns the cached value of key, or calls load and caches its result
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                self.entries[key] = entry
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.time() + self.ttl, value)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *keys):
+        """
+            Drops the given keys, or all the entries if no keys are given
+        """
+        with self.lock:
+            self.generation += 1
+            if not keys:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
 
 class RabbitManagement(object):
-    def __init__(self, client, url, vhost, user, password):
-        self.url = url
+    """
+        Client of the rabbitmq management http api.
+
+        All requests share a keep-alive session, with up to pool_size connections
+        to the server. timeout is passed to requests, a (connect, read) tuple or
+        a number of seconds. With concurrency > 1, independent requests run in
+        parallel on that many threads.
+
+        With cache_ttl, the exchanges, queues and exchange bindings loaded are
+        cached for cache_ttl seconds, see ManagementCache. Writes made through
+        the same client invalidate the affected entries.
+
+        Requests are timed in metrics, labeled by http method and endpoint.
+        A session can be given to send the requests elsewhere, as the
+        MemoryManagementSession of the in-memory broker.
+
+        url can be a list with the api url of each node of a cluster. Requests
+        go to the first one, and move to the next one when it can't be reached.
+    """
+
+    def __init__(self, client, url, vhost, user, password, pool_size=10, timeout=(5, 30), concurrency=1,
+                 cache_ttl=None, cache_size=1000, metrics=METRICS, session=None):
+        self.urls = list(url) if isinstance(url, (list, tuple)) else [url]
+        self.url = self.urls[0]
         self.vhost = vhost.replace('%2F', '/')
         self.vhost_url = vhost
         self.user = user
         self.password = password
         self.client = client
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.metrics = metrics
 
         self.auth = (self.user, self.password)
 
+        self.session = session if session is not None else requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._workers = None
+        self._matchers = {}
+        self.cache = ManagementCache(cache_ttl, cache_size) if cache_ttl else None
+
         self.exchanges = []
         self.queues = []
         self.exchanges_by_name = {}
         self.queues_by_name = {}
 
+    def request(self, method, path, **kwargs):
+        """
+            Makes a request to the management api through the shared session
+        """
+        kwargs.setdefault('timeout', self.timeout)
+
+        # Label by the kind of resource, not by the names in the path
+        parts = path.split('/')
+        endpoint = parts[0] + ('/bindings' if 'bindings' in parts[1:] else '')
+
+        # Start with the last node that answered, then try the next ones
+        start = self.urls.index(self.url)
+        urls = self.urls[start:] + self.urls[:start]
+
+        with self.metrics.timer('maxcarrot_management_seconds', method=method, endpoint=endpoint):
+            for url in urls:
+                try:
+                    response = self.session.request(method, '{}/{}'.format(url, path), **kwargs)
+                except requests.ConnectionError:
+                    if url == urls[-1]:
+                        raise
+                    self.metrics.inc('maxcarrot_management_errors_total', method=method, endpoint=endpoint, status='unreachable')
+                else:
+                    self.url = url
+                    break
+        if response.status_code >= 400:
+            self.metrics.inc('maxcarrot_management_errors_total', method=method, endpoint=endpoint, status=response.status_code)
+        return response
+
+    def run(self, *calls):
+        """
+            Runs callables without arguments and returns their results, in order.
+            Calls run in parallel when concurrency > 1.
+        """
+        if self.concurrency <= 1 or len(calls) <= 1:
+            return [call() for call in calls]
+
+        if self._workers is None:
+            self._workers = ThreadPool(self.concurrency)
+        return self._workers.map(lambda call: call(), calls)
+
+    def close(self):
+        """
+            Closes the http session and the worker threads
+        """
+        self.session.close()
+        if self._workers is not None:
+            self._workers.terminate()
+            self._workers = None
+
+    def cached(self, key, load):
+        """
+            Returns the result of load, from the cache if enabled
+        """
+        if self.cache is None:
+            return load()
+        hits = self.cache.hits
+        value = self.cache.get(key, load)
+        self.metrics.inc('maxcarrot_management_cache_total', result='hit' if self.cache.hits > hits else 'miss')
+        return value
+
+    def invalidate(self, *keys):
+        """
+            Drops cache entries, all of them if no keys are given
+        """
+        if self.cache is not None:
+            self.cache.invalidate(*keys)
+
+    def invalidate_bindings(self, *exchanges):
+        """
+            Drops the cached bindings of exchanges
+        """
+        self.invalidate(*[('bindings', exchange) for exchange in exchanges])
+
     def delete_exchange(self, name):
         self.client.ch.exchange.delete(name)
+        # Bindings of any exchange may point to the deleted one
+        self.invalidate()
 
     def delete_queue(self, name):
         if not name.startswith('amq.gen'):
             self.client.ch.queue.delete(name)
+            self.invalidate()
 
     def delete_binding(self, source, destination, routing_key):
-        requests.delete('{}/bindings/{}/e/{}/e/{}/{}'.format(self.url, self.vhost_url, source, destination, routing_key), auth=self.auth)
+        self.request('DELETE', 'bindings/{}/e/{}/e/{}/{}'.format(self.vhost_url, source, destination, routing_key))
+        self.invalidate_bindings(source, destination)
+
+    def delete_bindings(self, bindings, chunk_size=500):
+        """
+            Deletes exchange bindings loaded from the management api.
+            bindings can be a generator, it's consumed chunk_size bindings at a time.
+        """
+        bindings = iter(bindings)
+        chunk = list(islice(bindings, chunk_size))
+        while chunk:
+            self.run(*[
+                lambda binding=binding: self.delete_binding(binding['source'], binding['destination'], binding['routing_key'])
+                for binding in chunk
+            ])
+            chunk = list(islice(bindings, chunk_size))
 
     def force_close(self, remote, message="Closed via MaxCarrot"):
         # Fix ipv6 format bug
@@ -37,63 +279,306 @@ class RabbitManagement(object):
         payload = json.dumps({
             "name": remote,
             "reason": message})
-        requests.delete('{}/connections/{}'.format(self.url, remote), data=payload, auth=self.auth)
+        self.request('DELETE', 'connections/{}'.format(remote), data=payload)
+
+    def iter_response(self, response, prefix, fields=None):
+        """
+            Yields the items of a json response under prefix, an ijson prefix like
+            'item' for a top level array. With ijson available the response is parsed
+            as it's read, otherwise it's loaded at once.
+
+            The top level values of an object response, as page_count, are stored
+            in the fields dict if given, once all the items are yielded.
+        """
+        if ijson_available:
+            response.raw.decode_content = True
+            events = ijson.parse(response.raw)
+            if fields is not None:
+                events = self._record_fields(events, fields)
+            for item in ijson.common.items(events, prefix):
+                yield item
+        else:
+            result = response.json()
+            if fields is not None and isinstance(result, dict):
+                fields.update((key, value) for key, value in result.items() if not isinstance(value, (list, dict)))
+            for key in prefix.split('.')[:-1]:
+                result = result[key]
+            for item in result:
+                yield item
+
+    @staticmethod
+    def _record_fields(events, fields):
+        for path, event, value in events:
+            if '.' not in path and path and event in ('number', 'string', 'boolean', 'null'):
+                fields[path] = value
+            yield path, event, value
+
+    def iter_resources(self, path, page_size=500, columns=None):
+        """
+            Yields the items of a list endpoint of the management api, requesting
+            pages of page_size items, reduced to the given columns if any.
+            With page_size=None, all items are requested at once.
+            Pagination requires rabbitmq 3.6 or newer.
+
+            Pages are requested up to the page_count of the responses, as
+            rabbitmq answers 400 to the pages out of range.
+        """
+        params = {}
+        if columns:
+            params['columns'] = ','.join(columns)
+
+        if page_size is None:
+            response = self.request('GET', path, params=params, stream=True)
+            response.raise_for_status()
+            for item in self.iter_response(response, 'item'):
+                yield item
+            return
+
+        page = 1
+        while True:
+            params.update({'page': page, 'page_size': page_size})
+            response = self.request('GET', path, params=params, stream=True)
+            response.raise_for_status()
+            count = 0
+            fields = {}
+            for item in self.iter_response(response, 'items.item', fields):
+                count += 1
+                yield item
+            page_count = fields.get('page_count')
+            if count < page_size or (page_count is not None and page >= page_count):
+                return
+            page += 1
+
+    def iter_exchanges(self, page_size=500, columns=None):
+        """
+            Yields the exchanges of the vhost, see iter_resources
+        """
+        return self.iter_resources('exchanges/{}'.format(self.vhost_url), page_size, columns)
+
+    def iter_queues(self, page_size=500, columns=None):
+        """
+            Yields the queues of the vhost, see iter_resources
+        """
+        return self.iter_resources('queues/{}'.format(self.vhost_url), page_size, columns)
+
+    def queue_node(self, queue):
+        """
+            Returns the name of the node hosting a queue, as rabbit@host, or None if it doesn't exist
+        """
+        response = self.request('GET', 'queues/{}/{}'.format(self.vhost_url, queue), params={'columns': 'node'})
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get('node')
+
+    def iter_exchange_bindings(self, exchange, columns=None):
+        """
+            Yields the bindings with exchange as source, then as destination.
+            Bindings can't be paginated, but are parsed as they're read.
+        """
+        params = {'columns': ','.join(columns)} if columns else {}
+        for direction in ['source', 'destination']:
+            response = self.request(
+                'GET', 'exchanges/{}/{}/bindings/{}'.format(self.vhost_url, exchange, direction),
+                params=params, stream=True)
+            if response.status_code == 200:
+                for binding in self.iter_response(response, 'item'):
+                    yield binding
 
     def load_exchanges(self):
-        req = requests.get('{}/exchanges/{}'.format(self.url, self.vhost_url), auth=self.auth)
-        self.exchanges = [a for a in req.json() if a['vhost'] == self.vhost]
+        self.exchanges = self.cached(
+            ('exchanges',),
+            lambda: [a for a in self.iter_exchanges(page_size=None) if a['vhost'] == self.vhost])
         self.exchanges_by_name.clear()
         for exchange in self.exchanges:
             self.exchanges_by_name[exchange['name']] = exchange
 
     def load_queues(self):
-        req = requests.get('{}/queues/{}'.format(self.url, self.vhost_url), auth=self.auth)
-        self.queues = [a for a in req.json() if a['vhost'] == self.vhost]
+        self.queues = self.cached(
+            ('queues',),
+            lambda: [a for a in self.iter_queues(page_size=None) if a['vhost'] == self.vhost])
         self.queues_by_name.clear()
         for queue in self.queues:
             self.queues_by_name[queue['name']] = queue
 
+    def load_all(self):
+        """
+            Loads exchanges and queues
+        """
+        self.run(self.load_exchanges, self.load_queues)
+
     def load_exchange_bindings(self, exchange):
-        resp_source = requests.get('{}/exchanges/{}/{}/bindings/source'.format(self.url, self.vhost_url, exchange), auth=self.auth)
-        resp_destination = requests.get('{}/exchanges/{}/{}/bindings/destination'.format(self.url, self.vhost_url, exchange), auth=self.auth)
+        def load():
+            resp_source, resp_destination = self.run(
+                lambda: self.request('GET', 'exchanges/{}/{}/bindings/source'.format(self.vhost_url, exchange)),
+                lambda: self.request('GET', 'exchanges/{}/{}/bindings/destination'.format(self.vhost_url, exchange))
+            )
+
+            source_bindings = resp_source.json() if resp_source.status_code == 200 else []
+            destination_bindings = resp_destination.json() if resp_destination.status_code == 200 else []
+            return source_bindings, destination_bindings
 
-        source_bindings = resp_source.json() if resp_source.status_code == 200 else []
-        destination_bindings = resp_destination.json() if resp_destination.status_code == 200 else []
+        source_bindings, destination_bindings = self.cached(('bindings', exchange), load)
         return chain(source_bindings, destination_bindings)
 
-    def cleanup(self, delete_all=False):
-        self.load_exchanges()
-        self.load_queues()
-        for exchange in self.exchanges:
-            matched_definition = False
-
-            for exchange_definition in self.client.resource_specs['exchanges']:
-                if not matched_definition and re.match(exchange_definition['spec'], exchange['name']):
-                    matched_definition = True
-                    exchange['native'] = exchange_definition.get('native', False)
-                    types_match = re.match(exchange_definition['type'], exchange['type'])
-                    autodelete_match = exchange_definition.get('auto_delete', False) == exchange['auto_delete']
-                    durable_match = exchange_definition.get('durable', True) == exchange['durable']
-                    if not types_match or not autodelete_match or not durable_match:
-                        print 'Deleting non matching exchange "{name}"'.format(**exchange)
-                        self.delete_exchange(exchange['name'])
-
-            if not matched_definition or (delete_all and not exchange.get('native', False)):
-                self.delete_exchange(exchange['name'])
+    def build_definitions(self, users=[], conversations={}, contexts={}):
+        """
+            Compiles a topology into a rabbitmq definitions document, with:
 
-        for queue in self.queues:
-            matched_definition = False
-            for queue_definition in self.client.resource_specs['queues']:
-                if not matched_definition and re.match(queue_definition['spec'], queue['name']):
-                    matched_definition = True
-                    queue['native'] = queue_definition.get('native', False)
-                    autodelete_match = queue_definition.get('auto_delete', False) == queue['auto_delete']
-                    durable_match = queue_definition.get('durable', True) == queue['durable']
-                    if not autodelete_match or not durable_match:
-                        if 'gen' in queue['name']:
-                            pass
-                        print 'Deleting non maching queue "{name}"'.format(**queue)
-                        self.delete_queue(queue['name'])
-
-            if not matched_definition or (delete_all and not exchange.get('native', False)):
-                self.delete_queue(queue['name'])
+            * The global exchanges, queues and their bindings from the client resource specs
+            * The exchanges and internal binding of each user in users
+            * The bindings of each conversation in conversations, a {conversation: [users]} dict
+            * The bindings of each context in contexts, a {context: [users]} dict
+        """
+        exchanges = []
+        queues = []
+        bindings = []
+
+        def exchange(name, type):
+            exchanges.append({
+                'name': name, 'vhost': self.vhost, 'type': type,
+                'durable': True, 'auto_delete': False, 'internal': False, 'arguments': {}
+            })
+
+        def binding(source, destination, routing_key, destination_type='exchange'):
+            bindings.append({
+                'source': source, 'vhost': self.vhost, 'destination': destination,
+                'destination_type': destination_type, 'routing_key': routing_key, 'arguments': {}
+            })
+
+        for spec in self.client.resource_specs['exchanges']:
+            if spec.get('global', True) and not spec.get('native', False):
+                exchange(spec['name'], spec['type'])
+                for exchange_binding in spec.get('bindings', []):
+                    binding(exchange_binding['source'], spec['name'], exchange_binding.get('routing_key', ''))
+
+        for spec in self.client.resource_specs['queues']:
+            if spec.get('global', True) and not spec.get('native', False):
+                queues.append({
+                    'name': spec['name'], 'vhost': self.vhost,
+                    'durable': True, 'auto_delete': False, 'arguments': {}
+                })
+                for queue_binding in spec.get('bindings', []):
+                    binding(queue_binding['exchange'], spec['name'], queue_binding.get('routing_key', ''), destination_type='queue')
+
+        publish_type = self.client.exchange_specs_by_name['user_publish']['type']
+        subscribe_type = self.client.exchange_specs_by_name['user_subscribe']['type']
+        for username in users:
+            exchange(self.client.user_publish_exchange(username), publish_type)
+            exchange(self.client.user_subscribe_exchange(username), subscribe_type)
+            binding(self.client.user_publish_exchange(username), self.client.user_subscribe_exchange(username), 'internal')
+
+        for conversation, usernames in conversations.items():
+            routing_key = '{}.*'.format(conversation)
+            for username in usernames:
+                binding(self.client.user_publish_exchange(username), 'conversations', routing_key)
+                binding('conversations', self.client.user_subscribe_exchange(username), routing_key)
+
+        for context, usernames in contexts.items():
+            for username in usernames:
+                binding('activity', self.client.user_subscribe_exchange(username), context)
+
+        return {'exchanges': exchanges, 'queues': queues, 'bindings': bindings}
+
+    def import_definitions(self, definitions):
+        """
+            Uploads a definitions document to the vhost in a single request.
+            Objects already defined are left as they are.
+        """
+        req = self.request(
+            'POST', 'definitions/{}'.format(self.vhost_url),
+            data=json.dumps(definitions),
+            headers={'content-type': 'application/json'})
+        self.invalidate()
+        req.raise_for_status()
+
+    def export_definitions(self):
+        """
+            Returns the current vhost topology as a definitions document
+        """
+        req = self.request('GET', 'definitions/{}'.format(self.vhost_url))
+        req.raise_for_status()
+        definitions = req.json()
+        return {key: definitions.get(key, []) for key in ['exchanges', 'queues', 'bindings']}
+
+    def matcher(self, type):
+        """
+            Returns the SpecMatcher of the exchanges or queues resource specs
+        """
+        if type not in self._matchers:
+            self._matchers[type] = SpecMatcher(self.client.resource_specs[type])
+        return self._matchers[type]
+
+    def plan_cleanup(self, delete_all=False, page_size=500):
+        """
+            Returns the exchanges and queues that cleanup would delete, as a
+            {'exchanges': [...], 'queues': [...]} dict of {'name', 'reason'} dicts.
+            The reason is one of:
+
+            * unmatched: the name doesn't match any spec
+            * mismatch: the type or flags don't match the spec
+            * delete_all: delete_all was requested and it's not a native resource
+
+            Exchanges and queues are streamed from the management api page by page.
+        """
+        plan = {'exchanges': [], 'queues': []}
+        columns = {
+            'exchanges': ['name', 'type', 'auto_delete', 'durable'],
+            'queues': ['name', 'auto_delete', 'durable']
+        }
+        resources = {
+            'exchanges': self.iter_exchanges,
+            'queues': self.iter_queues
+        }
+
+        for type in ['exchanges', 'queues']:
+            matcher = self.matcher(type)
+            for resource in resources[type](page_size=page_size, columns=columns[type]):
+                spec = matcher.match(resource['name'])
+                if spec is None:
+                    reason = 'unmatched'
+                elif matcher.mismatches(resource, spec):
+                    reason = 'mismatch'
+                elif delete_all and not spec.get('native', False):
+                    reason = 'delete_all'
+                else:
+                    continue
+                plan[type].append({'name': resource['name'], 'reason': reason})
+
+        return plan
+
+    def execute_cleanup(self, plan, channels=4, batch_size=500, progress_cb=None):
+        """
+            Deletes the exchanges and queues of a plan from plan_cleanup, in
+            pipelined batches over several channels. Returns a
+            {'exchanges': report, 'queues': report} dict of PipelineReports.
+
+            progress_cb is called with the type and report after each round of batches.
+        """
+        def delete_exchange(channel, name):
+            channel.exchange.delete(name)
+
+        def delete_queue(channel, name):
+            channel.queue.delete(name)
+
+        deletes = {'exchanges': delete_exchange, 'queues': delete_queue}
+        reports = {}
+        pipeline = ChannelPipeline(self.client, channels=channels, batch_size=batch_size)
+        try:
+            for type in ['exchanges', 'queues']:
+                names = [item['name'] for item in plan[type] if not item['name'].startswith('amq.gen')]
+                type_progress_cb = None
+                if progress_cb is not None:
+                    type_progress_cb = lambda report, type=type: progress_cb(type, report)
+                reports[type] = pipeline.run(names, deletes[type], progress_cb=type_progress_cb)
+        finally:
+            pipeline.close()
+            self.invalidate()
+        return reports
+
+    def cleanup(self, delete_all=False, page_size=500, progress_cb=None):
+        """
+            Deletes the exchanges and queues not matching the resource specs.
+            See plan_cleanup and execute_cleanup.
+        """
+        return self.execute_cleanup(self.plan_cleanup(delete_all, page_size), progress_cb=progress_cb)
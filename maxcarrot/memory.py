@@ -0,0 +1,1016 @@
+# -*- coding: utf-8 -*-
+"""
+    In-memory stand-in of a rabbitmq broker and its management api.
+
+    Use it with RabbitClient(url, transport='memory'): clients with the same
+    host and port in the url share the same broker, in the same process.
+    The broker implements the parts of AMQP 0-9-1 used by maxcarrot:
+
+    * direct, fanout and topic exchanges, exchange to exchange bindings
+      and the default exchange
+    * durable, auto_delete and exclusive queues, server named queues
+    * basic.publish, get, consume with prefetch, ack, reject and publisher confirms
+    * channel errors with the same reply codes as rabbitmq
+    * cluster nodes that can be stopped, closing the connections to them
+    * x-consistent-hash exchanges, as with the rabbitmq_consistent_hash_exchange plugin
+
+    Deliveries, consumer callbacks and confirms are processed when frames are
+    read from the connection, as with a socket connection.
+"""
+from collections import OrderedDict
+from collections import deque
+from haigha.exceptions import ChannelClosed
+from haigha.message import Message
+from itertools import count
+from uuid import uuid4
+
+import errno
+import io
+import json
+import re
+import requests
+import socket
+import threading
+import urllib
+import zlib
+import urlparse
+
+BROKERS = {}
+_brokers_lock = threading.Lock()
+
+NOT_FOUND = 404
+ACCESS_REFUSED = 403
+RESOURCE_LOCKED = 405
+PRECONDITION_FAILED = 406
+
+REPLY_TEXTS = {
+    NOT_FOUND: 'NOT_FOUND',
+    ACCESS_REFUSED: 'ACCESS_REFUSED',
+    RESOURCE_LOCKED: 'RESOURCE_LOCKED',
+    PRECONDITION_FAILED: 'PRECONDITION_FAILED'
+}
+
+
+def get_broker(host='localhost', port=5672):
+    """
+        Returns the broker for host and port, created on first use
+    """
+    key = (host, int(port or 5672))
+    with _brokers_lock:
+        if key not in BROKERS:
+            BROKERS[key] = MemoryBroker()
+        return BROKERS[key]
+
+
+_topic_patterns = {}
+
+
+def topic_matches(pattern, routing_key):
+    """
+        Returns True if a topic binding key matches a routing key.
+
+        Binding keys are compiled to a regex matched against the routing key
+        followed by a dot, so each word, wildcard or not, ends with a dot.
+    """
+    regex = _topic_patterns.get(pattern)
+    if regex is None:
+        words = []
+        for word in pattern.split('.'):
+            if word == '#':
+                words.append(r'(?:[^.]*\.)*')
+            elif word == '*':
+                words.append(r'[^.]*\.')
+            else:
+                words.append(re.escape(word) + r'\.')
+        if len(_topic_patterns) > 10000:
+            _topic_patterns.clear()
+        regex = _topic_patterns[pattern] = re.compile(''.join(words) + '$')
+    return regex.match(routing_key + '.') is not None
+
+
+def consistent_hash_binding(bindings, routing_key):
+    """
+        Returns the binding of a x-consistent-hash exchange a routing key goes to.
+
+        Each binding gets as many buckets as the weight in its routing key, and
+        the hash of the routing key picks a bucket with jump consistent hashing,
+        as the rabbitmq plugin does, so a routing key always goes to the same
+        destination while the bindings don't change.
+    """
+    buckets = []
+    for binding in sorted(bindings, key=lambda binding: (binding['destination_type'], binding['destination'])):
+        buckets.extend([binding] * int(binding['routing_key'] or 1))
+    if not buckets:
+        return None
+
+    key = zlib.crc32(routing_key) & 0xffffffff
+    bucket, jump = -1, 0
+    while jump < len(buckets):
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return buckets[bucket]
+
+
+class BrokerError(Exception):
+    """
+        Error that closes the channel where it happened
+    """
+
+    def __init__(self, reply_code, reply_text):
+        super(BrokerError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = '{} - {}'.format(REPLY_TEXTS[reply_code], reply_text)
+
+
+class MemoryQueue(object):
+
+    def __init__(self, vhost, name, durable, exclusive, auto_delete, arguments, owner, node=None):
+        self.vhost = vhost
+        self.name = name
+        self.node = node
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.owner = owner
+        self.messages = deque()
+        self.consumers = deque()
+        self.had_consumers = False
+
+    def info(self):
+        return {
+            'name': self.name, 'vhost': self.vhost.name,
+            'durable': self.durable, 'auto_delete': self.auto_delete,
+            'exclusive': self.exclusive, 'arguments': self.arguments,
+            'messages': len(self.messages), 'consumers': len(self.consumers),
+            'node': 'rabbit@{}'.format(self.node[0] if self.node else 'localhost')
+        }
+
+    def dispatch(self):
+        """
+            Delivers messages to the consumers with room for them, round robin
+        """
+        while self.messages and self.consumers:
+            for attempt in range(len(self.consumers)):
+                consumer = self.consumers[0]
+                self.consumers.rotate(-1)
+                if consumer.has_room():
+                    consumer.deliver(self.messages.popleft())
+                    break
+            else:
+                return
+
+
+class MemoryConsumer(object):
+
+    def __init__(self, channel, queue, tag, callback, no_ack, cancel_cb):
+        self.channel = channel
+        self.queue = queue
+        self.tag = tag
+        self.callback = callback
+        self.no_ack = no_ack
+        self.cancel_cb = cancel_cb
+        self.prefetch_count = channel.prefetch_count
+        self.unacked = 0
+
+    def has_room(self):
+        return self.no_ack or not self.prefetch_count or self.unacked < self.prefetch_count
+
+    def deliver(self, entry):
+        message = self.channel.delivery(entry, self.queue, self.no_ack, consumer=self)
+        self.channel.connection.schedule(self.callback, message)
+
+
+class VirtualHost(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = {}
+        self.bindings_by_destination = {}
+        for exchange, type in [('', 'direct'), ('amq.direct', 'direct'), ('amq.fanout', 'fanout'), ('amq.topic', 'topic')]:
+            self.exchanges[exchange] = {
+                'name': exchange, 'vhost': name, 'type': type, 'durable': True,
+                'auto_delete': False, 'internal': False, 'arguments': {}
+            }
+
+    def exchange(self, name):
+        if name not in self.exchanges:
+            raise BrokerError(NOT_FOUND, "no exchange '{}' in vhost '{}'".format(name, self.name))
+        return self.exchanges[name]
+
+    def queue(self, name, connection):
+        if name not in self.queues:
+            raise BrokerError(NOT_FOUND, "no queue '{}' in vhost '{}'".format(name, self.name))
+        queue = self.queues[name]
+        if queue.exclusive and queue.owner is not connection:
+            raise BrokerError(RESOURCE_LOCKED, "cannot obtain exclusive access to locked queue '{}' in vhost '{}'".format(name, self.name))
+        return queue
+
+    def declare_exchange(self, name, type, passive, durable, auto_delete, internal, arguments):
+        if passive:
+            return self.exchange(name)
+
+        if name in self.exchanges:
+            current = self.exchanges[name]
+            for arg, value in [('type', type), ('durable', durable), ('auto_delete', auto_delete), ('internal', internal)]:
+                if current[arg] != value:
+                    raise BrokerError(
+                        PRECONDITION_FAILED,
+                        "inequivalent arg '{}' for exchange '{}' in vhost '{}': received '{}' but current is '{}'".format(
+                            arg, name, self.name, value, current[arg]))
+            return current
+
+        if name.startswith('amq.'):
+            raise BrokerError(ACCESS_REFUSED, "exchange name '{}' contains reserved prefix 'amq.*'".format(name))
+        if type not in ('direct', 'fanout', 'topic', 'headers', 'x-consistent-hash'):
+            raise BrokerError(PRECONDITION_FAILED, "invalid exchange type '{}'".format(type))
+
+        self.exchanges[name] = {
+            'name': name, 'vhost': self.name, 'type': type, 'durable': durable,
+            'auto_delete': auto_delete, 'internal': internal, 'arguments': arguments or {}
+        }
+        return self.exchanges[name]
+
+    def delete_exchange(self, name, if_unused=False):
+        if name == '' or name.startswith('amq.'):
+            raise BrokerError(ACCESS_REFUSED, "operation not permitted on the default exchange")
+        if name not in self.exchanges:
+            return
+        if if_unused and (self.bindings.get(name) or self.destination_bindings(name, 'exchange')):
+            raise BrokerError(PRECONDITION_FAILED, "exchange '{}' in vhost '{}' in use".format(name, self.name))
+
+        del self.exchanges[name]
+        for binding in self.source_bindings(name) + self.destination_bindings(name, 'exchange'):
+            self._remove_binding(binding)
+
+    def declare_queue(self, name, passive, durable, exclusive, auto_delete, arguments, connection):
+        if passive:
+            return self.queue(name, connection)
+
+        if name in self.queues:
+            queue = self.queue(name, connection)
+            for arg, value in [('durable', durable), ('exclusive', exclusive), ('auto_delete', auto_delete)]:
+                if getattr(queue, arg) != value:
+                    raise BrokerError(
+                        PRECONDITION_FAILED,
+                        "inequivalent arg '{}' for queue '{}' in vhost '{}': received '{}' but current is '{}'".format(
+                            arg, name, self.name, value, getattr(queue, arg)))
+            return queue
+
+        if not name:
+            name = 'amq.gen-{}'.format(uuid4().hex)
+        elif name.startswith('amq.'):
+            raise BrokerError(ACCESS_REFUSED, "queue name '{}' contains reserved prefix 'amq.*'".format(name))
+
+        queue = MemoryQueue(
+            self, name, durable, exclusive, auto_delete, arguments,
+            connection if exclusive else None, connection.node if connection is not None else None)
+        self.queues[name] = queue
+        self.bind('', name, 'queue', name, {}, default=True)
+        return queue
+
+    def delete_queue(self, name, if_unused, if_empty, connection):
+        if name not in self.queues:
+            return 0
+        queue = self.queue(name, connection)
+        if if_unused and queue.consumers:
+            raise BrokerError(PRECONDITION_FAILED, "queue '{}' in vhost '{}' in use".format(name, self.name))
+        if if_empty and queue.messages:
+            raise BrokerError(PRECONDITION_FAILED, "queue '{}' in vhost '{}' not empty".format(name, self.name))
+
+        del self.queues[name]
+        for consumer in list(queue.consumers):
+            consumer.channel.cancelled(consumer)
+        for binding in self.destination_bindings(name, 'queue'):
+            self._remove_binding(binding)
+        return len(queue.messages)
+
+    def source_bindings(self, source):
+        return list(self.bindings.get(source, {}).values())
+
+    def destination_bindings(self, destination, destination_type):
+        return list(self.bindings_by_destination.get((destination_type, destination), {}).values())
+
+    def binding_key(self, binding):
+        return (
+            binding['source'], binding['destination_type'], binding['destination'],
+            binding['routing_key'], json.dumps(binding['arguments'], sort_keys=True))
+
+    def bind(self, source, destination, destination_type, routing_key, arguments, default=False):
+        if source == '' and not default:
+            raise BrokerError(ACCESS_REFUSED, "operation not permitted on the default exchange")
+        self.exchange(source)
+        if destination_type == 'exchange':
+            self.exchange(destination)
+
+        binding = {
+            'source': source, 'vhost': self.name, 'destination': destination,
+            'destination_type': destination_type, 'routing_key': routing_key, 'arguments': arguments or {}
+        }
+        key = self.binding_key(binding)
+        bindings = self.bindings.setdefault(source, OrderedDict())
+        if key not in bindings:
+            bindings[key] = binding
+            self.bindings_by_destination.setdefault((destination_type, destination), OrderedDict())[key] = binding
+
+    def unbind(self, source, destination, destination_type, routing_key, arguments):
+        if source == '':
+            raise BrokerError(ACCESS_REFUSED, "operation not permitted on the default exchange")
+        self.exchange(source)
+        if destination_type == 'exchange':
+            self.exchange(destination)
+
+        self._remove_binding({
+            'source': source, 'vhost': self.name, 'destination': destination,
+            'destination_type': destination_type, 'routing_key': routing_key, 'arguments': arguments or {}
+        })
+
+    def _remove_binding(self, binding):
+        key = self.binding_key(binding)
+        bindings = self.bindings.get(binding['source'], {})
+        if key in bindings:
+            del bindings[key]
+            destination = (binding['destination_type'], binding['destination'])
+            del self.bindings_by_destination[destination][key]
+            if not self.bindings_by_destination[destination]:
+                del self.bindings_by_destination[destination]
+            if not bindings:
+                del self.bindings[binding['source']]
+                self._check_auto_delete(binding['source'])
+
+    def _check_auto_delete(self, name):
+        exchange = self.exchanges.get(name)
+        if exchange is not None and exchange['auto_delete'] and not self.bindings.get(name):
+            self.delete_exchange(name)
+
+    def route(self, exchange, routing_key):
+        """
+            Returns the names of the queues a message published to exchange
+            with routing_key is delivered to, following exchange to exchange bindings
+        """
+        queues = set()
+        visited = set()
+        pending = [exchange]
+        while pending:
+            name = pending.pop()
+            if name in visited:
+                continue
+            visited.add(name)
+            type = self.exchanges[name]['type']
+            bindings = self.bindings.get(name, {}).values()
+            if type == 'x-consistent-hash':
+                bindings = [consistent_hash_binding(bindings, routing_key)] if bindings else []
+            for binding in bindings:
+                if type in ('fanout', 'x-consistent-hash'):
+                    matches = True
+                elif type == 'direct':
+                    matches = binding['routing_key'] == routing_key
+                elif type == 'topic':
+                    matches = topic_matches(binding['routing_key'], routing_key)
+                else:
+                    matches = False
+                if not matches:
+                    continue
+                if binding['destination_type'] == 'queue':
+                    queues.add(binding['destination'])
+                elif binding['destination'] in self.exchanges:
+                    pending.append(binding['destination'])
+        return queues
+
+    def publish(self, exchange, routing_key, body, properties):
+        if self.exchange(exchange)['internal']:
+            raise BrokerError(ACCESS_REFUSED, "cannot publish to internal exchange '{}' in vhost '{}'".format(exchange, self.name))
+        for name in self.route(exchange, routing_key):
+            queue = self.queues[name]
+            queue.messages.append({
+                'body': body, 'properties': properties, 'exchange': exchange,
+                'routing_key': routing_key, 'redelivered': False
+            })
+            queue.dispatch()
+
+
+class MemoryBroker(object):
+    """
+        Broker holding the virtual hosts and open connections.
+        All the operations are serialized with a lock.
+    """
+
+    def __init__(self):
+        self.vhosts = {}
+        self.connections = {}
+        self.stopped_nodes = set()
+        self.lock = threading.RLock()
+        self.connection_ids = count(1)
+
+    def vhost(self, name):
+        if name not in self.vhosts:
+            self.vhosts[name] = VirtualHost(name)
+        return self.vhosts[name]
+
+    def connect(self, vhost='/', synchronous=True, node=None, close_cb=None):
+        """
+            Opens a connection to vhost, through a (host, port) node of the cluster.
+            With synchronous=False, errors close the channel without raising,
+            as with nowait methods. close_cb is called when the connection closes.
+        """
+        with self.lock:
+            if node in self.stopped_nodes:
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+            connection = MemoryConnection(self, self.vhost(vhost), next(self.connection_ids), synchronous, node, close_cb)
+            self.connections[connection.name] = connection
+            return connection
+
+    def stop_node(self, node):
+        """
+            Closes the connections to a node, and refuses new ones until start_node
+        """
+        with self.lock:
+            self.stopped_nodes.add(node)
+            connections = [connection for connection in self.connections.values() if connection.node == node]
+        for connection in connections:
+            connection.close(320, "CONNECTION_FORCED - broker forced connection closure with reason 'shutdown'")
+
+    def start_node(self, node):
+        self.stopped_nodes.discard(node)
+
+    def reset(self):
+        """
+            Closes all connections and drops all virtual hosts
+        """
+        for connection in list(self.connections.values()):
+            connection.close()
+        self.vhosts.clear()
+        self.stopped_nodes.clear()
+
+
+class MemoryConnection(object):
+    """
+        Connection to a MemoryBroker, with the interface of a haigha connection
+    """
+
+    def __init__(self, broker, vhost, id, synchronous, node=None, close_cb=None):
+        self.broker = broker
+        self.vhost = vhost
+        self.id = id
+        self.name = 'memory:{}'.format(id)
+        self.synchronous = synchronous
+        self.node = node
+        self.close_cb = close_cb
+        self.channels = {}
+        self.channel_ids = count(1)
+        self.closed = False
+        self.close_info = None
+        self.transport = None
+        self._frames = deque()
+        self._readable = threading.Event()
+
+    def channel(self):
+        channel = MemoryChannel(self, next(self.channel_ids))
+        self.channels[channel.channel_id] = channel
+        return channel
+
+    def schedule(self, callback, *args):
+        """
+            Queues a callback to run when frames are read, as a frame from the broker
+        """
+        self._frames.append((callback, args))
+        self._readable.set()
+
+    def read_frames(self):
+        """
+            Processes the frames received so far
+        """
+        self._readable.clear()
+        while self._frames:
+            callback, args = self._frames.popleft()
+            if callback is not None:
+                callback(*args)
+
+    def wait(self, timeout=None):
+        """
+            Waits for frames, for timeout seconds or forever if timeout is None,
+            and processes them. Returns False if timeout expired with nothing read.
+        """
+        if not self._frames and not self._readable.wait(timeout):
+            return False
+        self.read_frames()
+        return True
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0, disconnect=False):
+        if self.closed:
+            return
+        with self.broker.lock:
+            for channel in list(self.channels.values()):
+                channel.closed_by(reply_code, reply_text)
+            for name, queue in list(self.vhost.queues.items()):
+                if queue.owner is self:
+                    self.vhost.delete_queue(name, False, False, self)
+            self.broker.connections.pop(self.name, None)
+        self.closed = True
+        self.close_info = {'reply_code': reply_code, 'reply_text': reply_text, 'class_id': class_id, 'method_id': method_id}
+        if self.close_cb is not None:
+            self.close_cb()
+
+
+class MemoryChannel(object):
+    """
+        Channel of a MemoryConnection, with the interface of a haigha channel
+    """
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.channel_id = channel_id
+        self.closed = False
+        self.close_info = None
+        self.prefetch_count = 0
+        self.consumers = {}
+        self.unacked = {}
+        self.delivery_tags = count(1)
+        self.confirming = False
+        self.published = 0
+        self.ack_listener = None
+        self.nack_listener = None
+        self._close_listeners = []
+
+        self.exchange = MemoryExchangeClass(self)
+        self.queue = MemoryQueueClass(self)
+        self.basic = MemoryBasicClass(self)
+        self.confirm = MemoryConfirmClass(self)
+
+    @property
+    def vhost(self):
+        return self.connection.vhost
+
+    def add_close_listener(self, listener):
+        self._close_listeners.append(listener)
+
+    def remove_close_listener(self, listener):
+        self._close_listeners.remove(listener)
+
+    def call(self, operation, cb=None):
+        """
+            Runs an operation on the broker, and calls cb with its results.
+            Broker errors close the channel, and raise ChannelClosed on
+            synchronous connections.
+        """
+        if not self.closed:
+            try:
+                with self.connection.broker.lock:
+                    result = operation()
+            except BrokerError as error:
+                self.closed_by(error.reply_code, error.reply_text)
+            else:
+                if cb is not None and isinstance(result, tuple):
+                    cb(*result)
+                elif cb is not None:
+                    cb()
+                return result
+
+        if self.connection.synchronous:
+            raise ChannelClosed('channel {} is closed: {} : {}'.format(
+                self.channel_id, self.close_info['reply_code'], self.close_info['reply_text']))
+
+    def closed_by(self, reply_code, reply_text):
+        """
+            Closes the channel, requeueing its unacked messages
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.close_info = {'reply_code': reply_code, 'reply_text': reply_text, 'class_id': 0, 'method_id': 0}
+        with self.connection.broker.lock:
+            for consumer in list(self.consumers.values()):
+                self._remove_consumer(consumer)
+            self._requeue(sorted(self.unacked))
+        self.connection.channels.pop(self.channel_id, None)
+        for listener in self._close_listeners:
+            listener(self)
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0):
+        self.closed_by(reply_code, reply_text)
+
+    def publish(self, *args, **kwargs):
+        self.basic.publish(*args, **kwargs)
+
+    def delivery(self, entry, queue, no_ack, consumer=None):
+        """
+            Returns the haigha Message for a queue entry, tracking it until acked if needed
+        """
+        delivery_tag = next(self.delivery_tags)
+        if not no_ack:
+            self.unacked[delivery_tag] = (queue, entry, consumer)
+            if consumer is not None:
+                consumer.unacked += 1
+        return Message(
+            entry['body'],
+            delivery_info={
+                'channel': self,
+                'consumer_tag': consumer.tag if consumer is not None else None,
+                'delivery_tag': delivery_tag,
+                'redelivered': entry['redelivered'],
+                'exchange': entry['exchange'],
+                'routing_key': entry['routing_key'],
+                'message_count': len(queue.messages)
+            },
+            **entry['properties'])
+
+    def settle(self, delivery_tag, multiple):
+        """
+            Forgets acked or rejected deliveries, and returns them
+        """
+        # Multiple with delivery tag 0 settles all the unacked deliveries
+        if delivery_tag not in self.unacked and (delivery_tag or not multiple):
+            raise BrokerError(PRECONDITION_FAILED, 'unknown delivery tag {}'.format(delivery_tag))
+        if multiple:
+            tags = sorted(tag for tag in self.unacked if tag <= delivery_tag or not delivery_tag)
+        else:
+            tags = [delivery_tag]
+
+        settled = []
+        for tag in tags:
+            queue, entry, consumer = self.unacked.pop(tag)
+            if consumer is not None:
+                consumer.unacked -= 1
+            settled.append((queue, entry))
+        return settled
+
+    def _requeue(self, delivery_tags):
+        queues = set()
+        for queue, entry in reversed(self.settle(delivery_tags[-1], True) if delivery_tags else []):
+            entry = dict(entry, redelivered=True)
+            queue.messages.appendleft(entry)
+            queues.add(queue)
+        for queue in queues:
+            if queue.name in self.vhost.queues:
+                queue.dispatch()
+
+    def _remove_consumer(self, consumer):
+        self.consumers.pop(consumer.tag, None)
+        if consumer in consumer.queue.consumers:
+            consumer.queue.consumers.remove(consumer)
+        if consumer.queue.auto_delete and consumer.queue.had_consumers and not consumer.queue.consumers:
+            if consumer.queue.name in self.vhost.queues:
+                self.vhost.delete_queue(consumer.queue.name, False, False, self.connection)
+
+    def cancelled(self, consumer):
+        """
+            Cancels a consumer from the broker side, as when its queue is deleted
+        """
+        self._remove_consumer(consumer)
+        if consumer.cancel_cb is not None:
+            self.connection.schedule(consumer.cancel_cb, consumer.tag)
+
+
+class MemoryExchangeClass(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def declare(self, exchange, type, passive=False, durable=False, auto_delete=True,
+                internal=False, nowait=True, arguments=None, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        self.channel.call(lambda: vhost.declare_exchange(exchange, type, passive, durable, auto_delete, internal, arguments), cb)
+
+    def delete(self, exchange, if_unused=False, nowait=True, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        self.channel.call(lambda: vhost.delete_exchange(exchange, if_unused), cb)
+
+    def bind(self, exchange, source, routing_key='', nowait=True, arguments={}, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        self.channel.call(lambda: vhost.bind(source, exchange, 'exchange', routing_key, arguments), cb)
+
+    def unbind(self, exchange, source, routing_key='', nowait=True, arguments={}, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        self.channel.call(lambda: vhost.unbind(source, exchange, 'exchange', routing_key, arguments), cb)
+
+
+class MemoryQueueClass(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def declare(self, queue='', passive=False, durable=False, exclusive=False, auto_delete=True,
+                nowait=True, arguments={}, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        connection = self.channel.connection
+
+        def declare():
+            declared = vhost.declare_queue(queue, passive, durable, exclusive, auto_delete, arguments, connection)
+            return declared.name, len(declared.messages), len(declared.consumers)
+
+        return self.channel.call(declare, cb)
+
+    def bind(self, queue, exchange, routing_key='', nowait=True, arguments={}, ticket=None, cb=None):
+        vhost = self.channel.vhost
+
+        def bind():
+            vhost.queue(queue, self.channel.connection)
+            vhost.bind(exchange, queue, 'queue', routing_key, arguments)
+
+        self.channel.call(bind, cb)
+
+    def unbind(self, queue, exchange, routing_key='', arguments={}, ticket=None, cb=None):
+        vhost = self.channel.vhost
+
+        def unbind():
+            vhost.queue(queue, self.channel.connection)
+            vhost.unbind(exchange, queue, 'queue', routing_key, arguments)
+
+        self.channel.call(unbind, cb)
+
+    def purge(self, queue, nowait=True, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        connection = self.channel.connection
+
+        def purge():
+            purged = vhost.queue(queue, connection)
+            message_count = len(purged.messages)
+            purged.messages.clear()
+            return (message_count,)
+
+        result = self.channel.call(purge, cb)
+        return result[0] if result else None
+
+    def delete(self, queue, if_unused=False, if_empty=False, nowait=True, ticket=None, cb=None):
+        vhost = self.channel.vhost
+        connection = self.channel.connection
+        result = self.channel.call(lambda: (vhost.delete_queue(queue, if_unused, if_empty, connection),), cb)
+        return result[0] if result else None
+
+
+class MemoryBasicClass(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def qos(self, prefetch_size=0, prefetch_count=0, is_global=False):
+        self.channel.prefetch_count = prefetch_count
+
+    def consume(self, queue, consumer, consumer_tag='', no_local=False, no_ack=True,
+                exclusive=False, nowait=True, ticket=None, cb=None, cancel_cb=None):
+        channel = self.channel
+        consumer_tag = consumer_tag or 'amq.ctag-{}'.format(uuid4().hex)
+
+        def consume():
+            consumed = channel.vhost.queue(queue, channel.connection)
+            if consumer_tag in channel.consumers:
+                raise BrokerError(PRECONDITION_FAILED, "attempt to reuse consumer tag '{}'".format(consumer_tag))
+            memory_consumer = MemoryConsumer(channel, consumed, consumer_tag, consumer, no_ack, cancel_cb)
+            channel.consumers[consumer_tag] = memory_consumer
+            consumed.consumers.append(memory_consumer)
+            consumed.had_consumers = True
+            consumed.dispatch()
+
+        channel.call(consume, cb)
+
+    def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
+        channel = self.channel
+
+        def cancel():
+            cancelled = channel.consumers.get(consumer_tag)
+            if cancelled is not None:
+                channel._remove_consumer(cancelled)
+
+        channel.call(cancel, cb)
+
+    def publish(self, msg, exchange, routing_key, mandatory=False, immediate=False, ticket=None):
+        channel = self.channel
+        channel.call(lambda: channel.vhost.publish(exchange, routing_key, msg.body, dict(msg.properties)))
+        if channel.confirming and not channel.closed:
+            channel.published += 1
+            channel.connection.schedule(channel.ack_listener, channel.published)
+            return channel.published
+
+    def get(self, queue, consumer=None, no_ack=True, ticket=None):
+        channel = self.channel
+
+        def get():
+            source = channel.vhost.queue(queue, channel.connection)
+            if not source.messages:
+                return (None,)
+            return (channel.delivery(source.messages.popleft(), source, no_ack),)
+
+        result = channel.call(get)
+        message = result[0] if result else None
+        if consumer is not None:
+            consumer(message)
+        return message
+
+    def ack(self, delivery_tag, multiple=False):
+        channel = self.channel
+
+        def ack():
+            for queue, entry in channel.settle(delivery_tag, multiple):
+                queue.dispatch()
+
+        channel.call(ack)
+
+    def reject(self, delivery_tag, requeue=False):
+        channel = self.channel
+
+        def reject():
+            for queue, entry in channel.settle(delivery_tag, False):
+                if requeue:
+                    queue.messages.appendleft(dict(entry, redelivered=True))
+                queue.dispatch()
+
+        channel.call(reject)
+
+    def set_ack_listener(self, cb):
+        self.channel.ack_listener = cb
+
+    def set_nack_listener(self, cb):
+        self.channel.nack_listener = cb
+
+
+class MemoryConfirmClass(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def select(self, nowait=True, cb=None):
+        self.channel.confirming = True
+        if cb is not None:
+            cb()
+
+
+class RawBody(io.BytesIO):
+    """
+        Response body stream, as response.raw of requests
+    """
+    decode_content = False
+
+
+class MemoryResponse(object):
+    """
+        Response of the management stand-in, with the interface of a requests response
+    """
+
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload) if payload is not None else ''
+
+    @property
+    def text(self):
+        return self.content
+
+    @property
+    def raw(self):
+        return RawBody(self.content)
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Error'.format(self.status_code), response=self)
+
+
+class MemoryManagementSession(object):
+    """
+        Stand-in of the requests session used by RabbitManagement,
+        answering the management api endpoints from a MemoryBroker
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.auth = None
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def close(self):
+        pass
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        path = urlparse.urlparse(url).path
+        parts = [urllib.unquote(part) for part in path.split('/api/', 1)[-1].split('/')]
+        params = params or {}
+
+        with self.broker.lock:
+            try:
+                return self.dispatch(method, parts, params, data)
+            except KeyError:
+                return MemoryResponse(404, {'error': 'Object Not Found', 'reason': 'Not Found'})
+            except BrokerError as error:
+                return MemoryResponse(400, {'error': 'bad_request', 'reason': error.reply_text})
+
+    def dispatch(self, method, parts, params, data):
+        resource = parts[0]
+        vhost = self.broker.vhosts[parts[1]] if len(parts) > 1 and resource != 'connections' else None
+
+        if resource == 'exchanges' and len(parts) == 2 and method == 'GET':
+            return self.listing(sorted(vhost.exchanges.values(), key=lambda exchange: exchange['name']), params)
+
+        if resource == 'exchanges' and len(parts) == 5 and method == 'GET':
+            if parts[2] not in vhost.exchanges:
+                raise KeyError(parts[2])
+            if parts[4] == 'source':
+                bindings = vhost.source_bindings(parts[2])
+            else:
+                bindings = vhost.destination_bindings(parts[2], 'exchange')
+            return self.listing([self.binding_info(binding) for binding in bindings], params)
+
+        if resource == 'exchanges' and len(parts) == 3 and method == 'DELETE':
+            if parts[2] not in vhost.exchanges:
+                raise KeyError(parts[2])
+            vhost.delete_exchange(parts[2])
+            return MemoryResponse(204)
+
+        if resource == 'queues' and len(parts) == 2 and method == 'GET':
+            return self.listing([queue.info() for name, queue in sorted(vhost.queues.items())], params)
+
+        if resource == 'queues' and len(parts) == 3 and method == 'GET':
+            info = vhost.queues[parts[2]].info()
+            return MemoryResponse(200, self.listing([info], params).json()[0])
+
+        if resource == 'queues' and len(parts) == 3 and method == 'DELETE':
+            queue = vhost.queues[parts[2]]
+            vhost.delete_queue(parts[2], False, False, queue.owner)
+            return MemoryResponse(204)
+
+        if resource == 'bindings' and len(parts) == 7 and method == 'DELETE':
+            source, destination_type, destination, routing_key = parts[3], parts[4], parts[5], parts[6]
+            destination_type = 'queue' if destination_type == 'q' else 'exchange'
+            routing_key = '' if routing_key == '~' else routing_key
+            bindings = [
+                binding for binding in vhost.source_bindings(source)
+                if binding['destination'] == destination and binding['destination_type'] == destination_type and
+                binding['routing_key'] == routing_key
+            ]
+            if not bindings:
+                raise KeyError(parts)
+            vhost._remove_binding(bindings[0])
+            return MemoryResponse(204)
+
+        if resource == 'connections' and len(parts) == 2 and method == 'DELETE':
+            self.broker.connections[parts[1]].close(320, 'CONNECTION_FORCED - Closed via management plugin')
+            return MemoryResponse(204)
+
+        if resource == 'definitions' and len(parts) == 2 and method == 'GET':
+            return MemoryResponse(200, {
+                'exchanges': [
+                    exchange for name, exchange in sorted(vhost.exchanges.items())
+                    if name and not name.startswith('amq.')],
+                'queues': [queue.info() for name, queue in sorted(vhost.queues.items()) if not queue.exclusive],
+                'bindings': [
+                    self.binding_info(binding) for source, bindings in sorted(vhost.bindings.items())
+                    for binding in bindings.values() if source]
+            })
+
+        if resource == 'definitions' and len(parts) == 2 and method == 'POST':
+            self.import_definitions(self.broker.vhost(parts[1]), json.loads(data))
+            return MemoryResponse(204)
+
+        raise KeyError(parts)
+
+    def binding_info(self, binding):
+        info = dict(binding)
+        info['properties_key'] = binding['routing_key'] or '~'
+        return info
+
+    def listing(self, items, params):
+        """
+            Returns a list response, paginated and with the requested columns
+        """
+        if params.get('columns'):
+            columns = params['columns'].split(',')
+            items = [{column: item[column] for column in columns if column in item} for item in items]
+
+        if 'page' not in params:
+            return MemoryResponse(200, items)
+
+        page = int(params['page'])
+        page_size = int(params.get('page_size', 100))
+        page_count = max(1, (len(items) + page_size - 1) // page_size)
+        if page < 1 or page > page_count:
+            # As rabbitmq, pages out of range are a bad request
+            return MemoryResponse(400, {'error': 'bad_request', 'reason': 'page_out_of_range'})
+        return MemoryResponse(200, {
+            'items': items[(page - 1) * page_size:page * page_size],
+            'page': page,
+            'page_size': page_size,
+            'page_count': page_count,
+            'item_count': len(items[(page - 1) * page_size:page * page_size]),
+            'filtered_count': len(items),
+            'total_count': len(items)
+        })
+
+    def import_definitions(self, vhost, definitions):
+        for exchange in definitions.get('exchanges', []):
+            if exchange['name'] not in vhost.exchanges:
+                vhost.declare_exchange(
+                    exchange['name'], exchange['type'], False, exchange.get('durable', True),
+                    exchange.get('auto_delete', False), exchange.get('internal', False), exchange.get('arguments'))
+        for queue in definitions.get('queues', []):
+            if queue['name'] not in vhost.queues:
+                vhost.declare_queue(
+                    queue['name'], False, queue.get('durable', True), False,
+                    queue.get('auto_delete', False), queue.get('arguments'), None)
+        for binding in definitions.get('bindings', []):
+            vhost.bind(
+                binding['source'], binding['destination'], binding.get('destination_type', 'exchange'),
+                binding.get('routing_key', ''), binding.get('arguments'))
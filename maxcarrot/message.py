@@ -1,31 +1,84 @@
-import pkg_resources
 import json
+from collections import Mapping
 from copy import deepcopy
-import datetime
-from rfc3339 import rfc3339
 from pprint import pformat
-from uuid import uuid1
-import re
+from uuid import getnode
+import pkgutil
+import random
+import threading
+import time
+from maxcarrot.codec import LazySpecCodec
+from maxcarrot.decoder import DECODER
+from maxcarrot.decoder import normalize_json
 
-# Load specification and make an inverted copy
-SPECIFICATION = json.loads(open(pkg_resources.resource_filename(__name__, 'specification.json')).read())
-_SPECIFICATION = {}
+_specification = None
+_inverted_specification = None
 
-for k, v in SPECIFICATION.items():
-    spec_id = v['id']
-    spec_value = {
-        'name': k,
-        'type': v['type']
-    }
-    for kk, vv in v.get('values', {}).items():
-        spec_value.setdefault('values', {})
-        spec_value['values'][vv['id']] = {'name': kk}
 
-    for kk, vv in v.get('fields', {}).items():
-        spec_value.setdefault('fields', {})
-        spec_value['fields'][vv['id']] = {'name': kk}
+def load_specification():
+    """
+        Returns the message specification, read on first use
+    """
+    global _specification
+    if _specification is None:
+        # Read through the package loader, as the package may be installed zipped
+        _specification = json.loads(pkgutil.get_data('maxcarrot', 'specification.json'))
+    return _specification
+
+
+def inverted_specification():
+    """
+        Returns the specification indexed by ids, with the names of fields and values
+    """
+    global _inverted_specification
+    if _inverted_specification is None:
+        inverted = {}
+        for k, v in load_specification().items():
+            spec_value = {
+                'name': k,
+                'type': v['type']
+            }
+            for kk, vv in v.get('values', {}).items():
+                spec_value.setdefault('values', {})
+                spec_value['values'][vv['id']] = {'name': kk}
+
+            for kk, vv in v.get('fields', {}).items():
+                spec_value.setdefault('fields', {})
+                spec_value['fields'][vv['id']] = {'name': kk}
+
+            inverted[v['id']] = spec_value
+        _inverted_specification = inverted
+    return _inverted_specification
+
+
+class LazySpecification(Mapping):
+    """
+        Read-only mapping over the result of load, called on first access
+    """
 
-    _SPECIFICATION[v['id']] = spec_value
+    def __init__(self, load):
+        self._load = load
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+# The specification by names, and indexed by ids, read on first access
+SPECIFICATION = LazySpecification(load_specification)
+_SPECIFICATION = LazySpecification(inverted_specification)
+
+# Compiled codec used to pack and unpack messages, on first use.
+# Set CODEC.metrics to a registry to time them.
+CODEC = LazySpecCodec(load_specification)
 
 
 class MaxCarrotParsingError(Exception):
@@ -33,13 +86,88 @@ class MaxCarrotParsingError(Exception):
     """
 
 
+# 100-ns intervals between the uuid epoch, 1582-10-15, and the unix epoch
+UUID_EPOCH_OFFSET = 0x01b21dd213814000
+
+
+class MessagePreparer(object):
+    """
+        Sets the published date and uuid of messages.
+
+        Produces the same formats as rfc3339(utcnow()) and str(uuid1()), but
+        the date is formatted once per second, and uuids are version 1 uuids
+        built from consecutive timestamps, with the node and a random clock
+        sequence formatted once per batch.
+    """
+
+    def __init__(self):
+        self.node = None
+        self._published = (None, None)
+        self._last_timestamp = 0
+        self._lock = threading.Lock()
+
+    def published(self, now=None):
+        """
+            Returns the rfc3339 utc date of now, or the current time, to the second
+        """
+        second = int(time.time() if now is None else now)
+        # The second and its date are cached and read as one tuple, so concurrent
+        # calls for other seconds never pair a second with another's date
+        published = self._published
+        if published[0] != second:
+            published = (second, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(second)))
+            self._published = published
+        return published[1]
+
+    def uuids(self, count, now=None):
+        """
+            Returns count version 1 uuid strings
+        """
+        timestamp = int((time.time() if now is None else now) * 1e7) + UUID_EPOCH_OFFSET
+        with self._lock:
+            timestamp = max(timestamp, self._last_timestamp + 1)
+            self._last_timestamp = timestamp + count - 1
+
+        if self.node is None:
+            self.node = getnode()
+        clock_seq = random.randrange(1 << 14)
+        suffix = '-{:02x}{:02x}-{:012x}'.format(0x80 | (clock_seq >> 8), clock_seq & 0xff, self.node)
+        return [
+            '%08x-%04x-%04x%s' % (ts & 0xffffffff, (ts >> 32) & 0xffff, 0x1000 | ((ts >> 48) & 0x0fff), suffix)
+            for ts in xrange(timestamp, timestamp + count)
+        ]
+
+    def prepare_many(self, messages, params={}):
+        """
+            Sets the published date, uuid and params of each message,
+            reading the clock once for all of them. Returns the messages.
+        """
+        messages = messages if isinstance(messages, list) else list(messages)
+        now = time.time()
+        published = self.published(now)
+        for message, uuid in zip(messages, self.uuids(len(messages), now)):
+            message['published'] = published
+            message['uuid'] = uuid
+            if params:
+                message.update(params)
+        return messages
+
+
+PREPARER = MessagePreparer()
+
+
 class RabbitMessage(dict):
-    def __init__(self, message=None):
+    def __init__(self, message=None, copy=True):
         """
+            Creates a message from an unpacked message dict.
+
+            By default the message is deep-copied. With copy=False
+            the message takes ownership of the given dict contents
+            and no copy is made, so the caller must not mutate it afterwards.
         """
         if message is not None:
             self.clear()
-            self.update(deepcopy(message))
+            self.update(deepcopy(message) if copy else message)
 
     def __repr__(self):
         return pformat(dict(self))
@@ -48,85 +176,188 @@ class RabbitMessage(dict):
         return self[key]
 
     def prepare(self, params={}):
-        now = datetime.datetime.utcnow()
-        self['published'] = rfc3339(now, utc=True, use_system_timezone=False)
-        # self['published'] = self['published'].replace('Z', '.{}Z'.format(now.microsecond))
-        self['uuid'] = str(uuid1())
-        self.update(params)
+        PREPARER.prepare_many([self], params)
+
+    @staticmethod
+    def prepare_many(messages, params={}):
+        """
+            Prepares a batch of messages, see MessagePreparer.prepare_many
+        """
+        return PREPARER.prepare_many(messages, params)
 
     def is_packed(self, message):
         return sum([len(k) for k in message.keys()]) == len(message.keys())
 
     @property
     def packed(self):
-        packed = {}
-
-        for field, value in self.items():
-            if field in SPECIFICATION:
-                spec = SPECIFICATION[field]
-                if spec.get('values', {}):
-                    packed_value = spec['values'].get(value, None)
-                    if packed_value is not None:
-                        packed[spec['id']] = packed_value['id']
-                else:
-                    packed[spec['id']] = value
-                    if spec.get('fields', {}) and spec['type'] == 'object' and isinstance(value, dict):
-                        packed_inner = {}
-                        for inner_field, inner_value in value.items():
-                            if spec['fields'].get(inner_field, None):
-                                packed_key = spec['fields'][inner_field]['id']
-                            else:
-                                packed_key = inner_field
-                            packed_inner[packed_key] = inner_value
-                        packed[spec['id']] = packed_inner
-        return packed
+        return CODEC.pack(self)
 
     @staticmethod
     def normalize_json(message):
-        def control_char_replace(matchobj):
-            return matchobj.group()[0].encode('string_escape')
-        normalized = re.sub(r'[\n\t\r\f\b\/\\]', control_char_replace, message)
-        return normalized
+        return normalize_json(message)
 
     @classmethod
-    def unpack(cls, packed):
-        unpacked = {}
-
+    def decode(cls, packed):
+        """
+            Returns the packed message dict from a packed dict or a json body.
+            Bodies are decoded with the shared DECODER, that only normalizes
+            the bodies that cannot be parsed as they are.
+        """
         if isinstance(packed, dict):
             _packed = packed
         else:
             try:
-                _packed = json.loads(cls.normalize_json(packed))
+                _packed = DECODER.loads(packed)
             except:
                 raise MaxCarrotParsingError('JSON decoding error')
 
         if not isinstance(_packed, dict):
             raise MaxCarrotParsingError('Packed message is not json')
 
+        return _packed
+
+    @classmethod
+    def unpack(cls, packed, copy=True):
+        """
+            Creates a message from a packed dict or a json body.
+
+            Messages decoded from a json body are never copied, as nobody else
+            holds a reference to them. Messages unpacked from a dict are copied
+            unless copy=False is given.
+        """
+        _packed = cls.decode(packed)
+
         try:
-            for field, value in _packed.items():
-                if field in _SPECIFICATION:
-                    spec = _SPECIFICATION[field]
-                    if spec.get('values', {}):
-                        packed_value = None
-                        if isinstance(value, str) or isinstance(value, unicode):
-                            packed_value = spec['values'].get(value, None)
-                        if packed_value is not None:
-                            unpacked[spec['name']] = packed_value['name']
-                    else:
-                        unpacked[spec['name']] = value
-
-                        if spec.get('fields', {}) and spec['type'] == 'object' and isinstance(value, dict):
-                            unpacked_inner = {}
-                            for inner_field, inner_value in value.items():
-                                if spec['fields'].get(inner_field, None):
-                                    packed_key = spec['fields'][inner_field]['name']
-                                else:
-                                    packed_key = inner_field
-                                unpacked_inner[packed_key] = inner_value
-                            unpacked[spec['name']] = unpacked_inner
+            unpacked = CODEC.unpack(_packed)
         except:
             raise MaxCarrotParsingError('Spec parsing error')
 
-        message = cls(unpacked)
+        message = cls(unpacked, copy=copy and _packed is packed)
         return message
+
+    @classmethod
+    def view(cls, packed):
+        """
+            Returns a lazy message over a packed dict or a json body.
+            See LazyRabbitMessage.
+        """
+        return LazyRabbitMessage(packed)
+
+
+class LazyRabbitMessage(RabbitMessage):
+    """
+        Lazy view of a packed message.
+
+        The body is not decoded until a field is first accessed, and then
+        only the accessed fields are unpacked. Operations that need the whole
+        message (iteration, len, repr, dict(message), json.dumps ...) unpack all
+        the remaining fields. C code that reads the underlying dict without
+        looking up any method, as f(**message), must call materialize() first.
+        Unpacked values are not copied, they are shared with the packed source.
+    """
+
+    def __init__(self, packed):
+        dict.__init__(self)
+        self._source = packed
+        self._packed = None
+        self._materialized = False
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return self[key]
+
+    @property
+    def packed_source(self):
+        """
+            The packed message dict, decoded on first access
+        """
+        if self._packed is None:
+            self._packed = self.decode(self._source)
+            self._source = None
+        return self._packed
+
+    def __missing__(self, key):
+        if self._materialized:
+            raise KeyError(key)
+        try:
+            value = CODEC.unpack_field(self.packed_source, key)
+        except KeyError:
+            raise KeyError(key)
+        except MaxCarrotParsingError:
+            raise
+        except:
+            raise MaxCarrotParsingError('Spec parsing error')
+        dict.__setitem__(self, key, value)
+        return value
+
+    def materialize(self):
+        """
+            Unpacks all the fields not yet accessed
+        """
+        if not self._materialized:
+            try:
+                unpacked = CODEC.unpack(self.packed_source)
+            except:
+                raise MaxCarrotParsingError('Spec parsing error')
+            for key, value in unpacked.items():
+                if not dict.__contains__(self, key):
+                    dict.__setitem__(self, key, value)
+            self._materialized = True
+        return self
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    class _materializing(object):
+        """
+            Method that unpacks the whole message when it's looked up, not when
+            it's called. dict(message) and dict.update(message) look up keys
+            and then copy the underlying dict directly, so they see all the fields.
+        """
+
+        def __init__(self, method):
+            self.method = method
+
+        def __get__(self, instance, owner):
+            if instance is not None:
+                instance.materialize()
+            return self.method.__get__(instance, owner)
+
+    keys = _materializing(dict.keys)
+    values = _materializing(dict.values)
+    items = _materializing(dict.items)
+    iterkeys = _materializing(dict.iterkeys)
+    itervalues = _materializing(dict.itervalues)
+    iteritems = _materializing(dict.iteritems)
+    __iter__ = _materializing(dict.__iter__)
+    __len__ = _materializing(dict.__len__)
+    __eq__ = _materializing(dict.__eq__)
+    __ne__ = _materializing(dict.__ne__)
+    __delitem__ = _materializing(dict.__delitem__)
+    pop = _materializing(dict.pop)
+    popitem = _materializing(dict.popitem)
+    clear = _materializing(dict.clear)
+    copy = _materializing(dict.copy)
+    __repr__ = _materializing(RabbitMessage.__repr__.im_func)
+
+    del _materializing
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+import threading
+import time
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Metrics(object):
+    """
+        Registry of counters and latency histograms.
+
+        Each value is identified by a name and a set of labels. Every record is
+        also passed to the registered sinks, callables receiving
+        (kind, name, labels, value), with kind 'counter' or 'histogram'.
+
+        Set enabled to False to skip all the recording.
+    """
+
+    def __init__(self, buckets=BUCKETS, enabled=True):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.sinks = []
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def inc(self, name, value=1, **labels):
+        """
+            Increments a counter
+        """
+        if self.enabled:
+            self._inc((name, tuple(sorted(labels.items()))), value)
+
+    def _inc(self, key, value):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink('counter', key[0], dict(key[1]), value)
+
+    def observe(self, name, value, **labels):
+        """
+            Records a value, usually a duration in seconds, in a histogram
+        """
+        if self.enabled:
+            self._observe((name, tuple(sorted(labels.items()))), value)
+
+    def _observe(self, key, value):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        for sink in self.sinks:
+            sink('histogram', key[0], dict(key[1]), value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+            Records the duration of the with block in a histogram
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def timed(self, name, **labels):
+        """
+            Decorator recording the duration of each call in a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._observe(key, time.time() - start)
+            return wrapper
+        return decorator
+
+    def value(self, name, **labels):
+        """
+            Returns the value of a counter, or the count of a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        if key in self.histograms:
+            return self.histograms[key]['count']
+        return self.counters.get(key, 0)
+
+    def exposition(self):
+        """
+            Returns all the values in the prometheus text exposition format
+        """
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value['buckets']))) for key, value in self.histograms.items())
+
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), repr(histogram['sum'])))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+            Serves the text exposition over http on a background thread,
+            returns the server, call shutdown() on it to stop.
+        """
+        # Imported here, most processes never serve their metrics
+        import BaseHTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class MeteredClass(object):
+    """
+        Wraps a haigha channel class (exchange, queue, basic) to time its
+        methods in the maxcarrot_rpc_seconds histogram, labeled by method.
+        On synchronous channels this is the full round trip to rabbitmq.
+    """
+
+    def __init__(self, wrapped, name, metrics):
+        self._wrapped = wrapped
+        self._name = name
+        self._metrics = metrics
+
+    def __getattr__(self, attr):
+        method = getattr(self._wrapped, attr)
+        if attr.startswith('_') or not callable(method):
+            return method
+        metered = self._metrics.timed('maxcarrot_rpc_seconds', method='{}.{}'.format(self._name, attr))(method)
+        setattr(self, attr, metered)
+        return metered
+
+
+class MeteredChannel(object):
+    """
+        Proxy of a haigha channel timing the methods of its exchange,
+        queue and basic classes, see MeteredClass.
+    """
+
+    metered_classes = ('exchange', 'queue', 'basic')
+
+    def __init__(self, channel, metrics):
+        self.channel = channel
+        for name in self.metered_classes:
+            setattr(self, name, MeteredClass(getattr(channel, name), name, metrics))
+
+    def __getattr__(self, attr):
+        return getattr(self.channel, attr)
+
+    def publish(self, *args, **kwargs):
+        return self.basic.publish(*args, **kwargs)
+
+
+METRICS = Metrics()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from haigha.connections.rabbit_connection import RabbitConnection
+from haigha.transports.socket_transport import SocketTransport
+
+import threading
+import time
+
+
+class PipelinedSocketTransport(SocketTransport):
+    """
+        Blocking socket transport flagged as asynchronous, so haigha sends
+        methods with nowait and doesn't wait for each reply. Frames are only
+        read when explicitly calling read_frames on the connection.
+    """
+
+    def __init__(self, *args):
+        super(PipelinedSocketTransport, self).__init__(*args)
+        self._synchronous = False
+
+
+class PipelinedRabbitConnection(RabbitConnection):
+    """
+        RabbitConnection over a PipelinedSocketTransport
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['transport'] = PipelinedSocketTransport(self)
+        kwargs['synchronous_connect'] = True
+        super(PipelinedRabbitConnection, self).__init__(**kwargs)
+
+
+class PipelineReport(object):
+    """
+        Progress and result of a pipelined run
+    """
+
+    def __init__(self, items, start=0):
+        self.items = items
+        self.start = start
+        self.processed = 0
+        self.failed_batches = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def per_second(self):
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def failed_items(self):
+        """
+            Items in the failed batches, to retry them
+        """
+        return [item for batch in self.failed_batches for item in self.items[batch['start']:batch['end']]]
+
+    @property
+    def resume_from(self):
+        """
+            Index of the first item of the first failed batch, None if nothing failed
+        """
+        return self.failed_batches[0]['start'] if self.failed_batches else None
+
+    def __repr__(self):
+        return '<{} {} processed, {} batches failed, {:.1f}/sec>'.format(
+            self.__class__.__name__, self.processed, len(self.failed_batches), self.per_second)
+
+
+class ChannelPipeline(object):
+    """
+        Runs channel operations in bulk.
+
+        Items are split in batches, spread over several channels of a dedicated
+        connection. The operations of a batch are sent back to back with nowait,
+        and a passive declare at the end of each batch acts as a barrier to check
+        if the channel failed on any of them.
+    """
+
+    report_class = PipelineReport
+
+    def __init__(self, client, channels=4, batch_size=500):
+        self.client = client
+        self.batch_size = batch_size
+        if client.broker is not None:
+            self.connection = client.broker.connect(client.vhost, synchronous=False, node=client.node)
+        else:
+            self.connection = PipelinedRabbitConnection(
+                user=client.login[0], password=client.login[1],
+                vhost=client.vhost, host=client.host, port=client.port
+            )
+        self.channels = [self.connection.channel() for num in range(channels)]
+        self._lock = threading.Lock()
+
+    @property
+    def lost(self):
+        """
+            True if the connection was closed, or its transport dropped by the broker.
+            Memory connections have no transport.
+        """
+        if self.connection.closed:
+            return True
+        return self.client.broker is None and self.connection.transport is None
+
+    def close(self):
+        self.connection.close()
+        while not self.connection.closed and self.connection.transport is not None:
+            self.connection.read_frames()
+
+    def _send_batch(self, channel, batch, send):
+        for item in batch:
+            send(channel, item)
+
+        confirmed = []
+        channel.exchange.declare(
+            exchange='amq.direct',
+            type='direct',
+            passive=True,
+            cb=lambda: confirmed.append(True)
+        )
+        return confirmed
+
+    def run(self, items, send, start=0, progress_cb=None):
+        """
+            Calls send(channel, item) for each item, starting at index start,
+            and returns a report. To resume a failed run, call again with
+            start=report.resume_from, or run again report.failed_items.
+
+            progress_cb is called with the report after each round of batches.
+            If the connection is lost, the pending batches and the items not
+            sent yet are reported as failed.
+        """
+        with self._lock:
+            items = list(items)
+            report = self.report_class(items, start)
+
+            for round_start in range(start, len(items), self.batch_size * len(self.channels)):
+                if self.lost:
+                    report.failed_batches.append({'start': round_start, 'end': len(items), 'error': 'connection lost'})
+                    break
+
+                pending = []
+                for index, channel in enumerate(self.channels):
+                    batch_start = round_start + index * self.batch_size
+                    batch = items[batch_start:batch_start + self.batch_size]
+                    if batch:
+                        pending.append((index, batch_start, len(batch), self._send_batch(channel, batch, send)))
+
+                # Wait until all the batches are confirmed or their channels failed
+                while [batch for batch in pending if not batch[3] and not self.channels[batch[0]].closed]:
+                    if self.lost:
+                        break
+                    self.connection.read_frames()
+
+                for index, batch_start, batch_length, confirmed in pending:
+                    channel = self.channels[index]
+                    if confirmed and not channel.closed:
+                        report.processed += batch_length
+                    else:
+                        close_info = channel.close_info or {}
+                        report.failed_batches.append({
+                            'start': batch_start,
+                            'end': batch_start + batch_length,
+                            'error': close_info.get('reply_text') or ('connection lost' if self.lost else 'unknown error')
+                        })
+                        if not self.lost:
+                            self.channels[index] = self.connection.channel()
+
+                if progress_cb is not None:
+                    progress_cb(report)
+
+        report.finished = time.time()
+        return report
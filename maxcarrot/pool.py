@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from haigha.connections.rabbit_connection import RabbitConnection
+from maxcarrot.client import RabbitClient
+from maxcarrot.index import BindingIndex
+from maxcarrot.metrics import METRICS
+from maxcarrot.pump import PUMP
+from maxcarrot.pump import load_gevent
+
+import socket
+import threading
+
+
+class RabbitConnectionPool(object):
+    """
+        Pool of rabbitmq connections shared by many user sessions
+
+        Each RabbitClient created with pool=... gets its own channel, opened on the
+        least busy connection of the pool, instead of opening its own connection.
+        Connections are opened on demand, up to size connections.
+
+        With the socket transport, reading frames on behalf of a session processes
+        the frames of all the sessions on the same connection, so pooled sessions
+        must be used from a single thread. Use the gevent transport for concurrency,
+        the frames of all the connections are then read by pump, see MessagePump.
+
+        With a cluster url, connections are balanced over the nodes, see RabbitCluster.
+        Connections lost are discarded, and opened again on another node on demand.
+
+        Pooled clients share the binding indexes, expiring after index_ttl seconds,
+        and the management api client and pipeline of shared_client, created with
+        management_options and metrics.
+        The user queue of a pooled client is deleted when it disconnects.
+    """
+
+    def __init__(self, url, size=4, transport='socket', pump=PUMP, management_options={}, metrics=METRICS, index_ttl=30):
+        self.url = url
+        self.size = size
+        self.transport = transport
+        self.pump = pump
+        self.management_options = management_options
+        self.metrics = metrics
+        self.index_ttl = index_ttl
+
+        # Fallback to socket transport if gevent not available
+        if self.transport == 'gevent' and load_gevent() is None:
+            self.transport = 'socket'
+
+        from maxcarrot.cluster import get_cluster
+        from maxcarrot.cluster import parse_nodes
+        self.user, self.password, self.nodes, self.vhost_url = parse_nodes(url)
+        self.vhost = self.vhost_url.replace('%2F', '/')
+        self.cluster = get_cluster(self.nodes)
+
+        self.connections = []
+        self.connection_nodes = {}
+        self.occupancy = {}
+        self.lost = set()
+        self.acquired = 0
+        self.released = 0
+        self.indexes = {}
+        self._lock = threading.Lock()
+        self._shared_client = None
+        self._shared_lock = threading.Lock()
+
+    def client(self, user=None, declare=False, **kwargs):
+        """
+            Returns a RabbitClient using a channel from this pool
+        """
+        return RabbitClient(self.url, declare=declare, user=user, pool=self, **kwargs)
+
+    def shared_client(self):
+        """
+            Returns the client without user that owns the management api client
+            and the pipeline shared by the pooled clients, created on first use
+        """
+        with self._shared_lock:
+            if self._shared_client is None:
+                self._shared_client = RabbitClient(
+                    self.url, pool=self, pump=self.pump,
+                    management_options=self.management_options, metrics=self.metrics)
+            return self._shared_client
+
+    def binding_index(self, exchange):
+        """
+            Returns the binding index of an exchange shared by the pooled clients
+        """
+        with self._lock:
+            if exchange not in self.indexes:
+                self.indexes[exchange] = BindingIndex(self.index_ttl)
+            return self.indexes[exchange]
+
+    def _connect(self):
+        node = self.cluster.choose()
+        host, port = node
+
+        # haigha doesn't set closed when the transport is lost, it only calls
+        # close_cb, so lost connections are recorded to be discarded
+        opened = []
+        close_cb = lambda: opened and self._connection_lost(opened[0])
+        try:
+            if self.transport == 'memory':
+                from maxcarrot.memory import get_broker
+                connection = get_broker(*self.nodes[0]).connect(self.vhost, node=node, close_cb=close_cb)
+            else:
+                connection = RabbitConnection(
+                    user=self.user, password=self.password,
+                    vhost=self.vhost, host=host, port=port, transport=self.transport,
+                    close_cb=close_cb
+                )
+        except socket.error:
+            self.cluster.failed(node)
+            raise
+        opened.append(connection)
+        self.cluster.connected(node)
+        self.connection_nodes[connection] = node
+        if self.transport == 'gevent':
+            self.pump.register(connection)
+        self.connections.append(connection)
+        self.occupancy[connection] = 0
+        return connection
+
+    def acquire(self):
+        """
+            Returns a (connection, channel) tuple, with a new channel
+            on the least busy connection
+        """
+        with self._lock:
+            self._discard_closed()
+            if len(self.connections) < self.size:
+                connection = self._connect()
+            else:
+                connection = min(self.connections, key=self.occupancy.get)
+            self.occupancy[connection] += 1
+            self.acquired += 1
+
+        return connection, connection.channel()
+
+    def release(self, connection, channel):
+        """
+            Closes a channel obtained with acquire
+        """
+        if channel is not None and not channel.closed:
+            channel.close()
+
+        with self._lock:
+            if connection in self.occupancy:
+                self.occupancy[connection] -= 1
+            self.released += 1
+
+    def _connection_lost(self, connection):
+        if connection in self.connection_nodes:
+            self.lost.add(connection)
+
+    def _discard_closed(self):
+        for connection in [connection for connection in self.connections if connection.closed or connection in self.lost]:
+            self.lost.discard(connection)
+            self.connections.remove(connection)
+            del self.occupancy[connection]
+            self.cluster.disconnected(self.connection_nodes.pop(connection))
+
+    def close(self):
+        """
+            Closes all the connections of the pool
+        """
+        with self._shared_lock:
+            shared_client, self._shared_client = self._shared_client, None
+        if shared_client is not None:
+            shared_client.disconnect()
+
+        with self._lock:
+            connections = self.connections
+            self.connections = []
+            self.occupancy = {}
+            self.lost.clear()
+
+        for connection in connections:
+            self.cluster.disconnected(self.connection_nodes.pop(connection))
+            connection.close()
+
+    @property
+    def stats(self):
+        """
+            Pool occupancy: open connections and channels in use by each of them
+        """
+        with self._lock:
+            channels = [self.occupancy[connection] for connection in self.connections]
+            return {
+                'size': self.size,
+                'connections': len(self.connections),
+                'channels': sum(channels),
+                'channels_by_connection': channels,
+                'acquired': self.acquired,
+                'released': self.released
+            }
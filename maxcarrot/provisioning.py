@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from maxcarrot.pipeline import ChannelPipeline
+from maxcarrot.pipeline import PipelineReport
+
+
+class ProvisioningReport(PipelineReport):
+    """
+        Progress and result of a bulk user provisioning
+    """
+
+    @property
+    def usernames(self):
+        return self.items
+
+    @property
+    def provisioned(self):
+        return self.processed
+
+    @property
+    def users_per_second(self):
+        return self.per_second
+
+    @property
+    def failed_users(self):
+        """
+            Usernames in the failed batches, to retry them
+        """
+        return self.failed_items
+
+
+class UserProvisioner(ChannelPipeline):
+    """
+        Creates user exchanges and bindings in bulk, see ChannelPipeline.
+    """
+
+    report_class = ProvisioningReport
+
+    def provision(self, usernames, start=0, create_exchanges=True, progress_cb=None):
+        """
+            Provisions usernames, starting at index start, and returns a ProvisioningReport.
+            To resume a failed provisioning, call again with start=report.resume_from,
+            or provision report.failed_users.
+
+            progress_cb is called with the report after each round of batches.
+        """
+        publish_type = self.client.exchange_specs_by_name['user_publish']['type']
+        subscribe_type = self.client.exchange_specs_by_name['user_subscribe']['type']
+
+        def send(channel, username):
+            if create_exchanges:
+                channel.exchange.declare(
+                    exchange=self.client.user_publish_exchange(username),
+                    type=publish_type,
+                    durable=True,
+                    auto_delete=False
+                )
+                channel.exchange.declare(
+                    exchange=self.client.user_subscribe_exchange(username),
+                    type=subscribe_type,
+                    durable=True,
+                    auto_delete=False
+                )
+
+            channel.exchange.bind(
+                exchange=self.client.user_subscribe_exchange(username),
+                source=self.client.user_publish_exchange(username),
+                routing_key='internal',
+            )
+
+        return self.run(usernames, send, start=start, progress_cb=progress_cb)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from maxcarrot.metrics import METRICS
+
+import time
+
+
+def load_gevent():
+    """
+        Returns the gevent module, or None if it's not installed. Imported
+        on first use, as only the gevent transport needs it.
+    """
+    try:
+        import gevent
+        import gevent.event
+    except ImportError:
+        return None
+    return gevent
+
+
+class MessagePump(object):
+    """
+        Reads the frames of gevent connections as they arrive.
+
+        Registered connection sockets are watched by the gevent hub, and a
+        single greenlet reads the frames of the connections whose socket became
+        readable. The greenlet only wakes up when there are frames to read or
+        heartbeats to send, so idle connections cost nothing. Connections are
+        unregistered once closed.
+
+        One pump can serve any number of connections, by default all the gevent
+        clients and pools share PUMP. Wakeups and frames read are counted in
+        stats, and in the maxcarrot_pump_wakeups_total and
+        maxcarrot_pump_frames_total metrics.
+    """
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self.watchers = {}
+        self.last_read = {}
+        self.ready = []
+        self.wakeups = 0
+        self.frames = 0
+        self.heartbeat_interval = None
+        self._next_heartbeat = None
+        self._wakeup = None
+        self._greenlet = None
+
+    def register(self, connection):
+        """
+            Starts reading the frames of a connection
+        """
+        if connection in self.watchers:
+            return
+        gevent = load_gevent()
+        if self._wakeup is None:
+            self._wakeup = gevent.event.Event()
+
+        watcher = gevent.get_hub().loop.io(connection.transport._sock.fileno(), 1)
+        self.watchers[connection] = watcher
+        self.last_read[connection] = time.time()
+        watcher.start(self._readable, connection)
+
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+    def unregister(self, connection):
+        """
+            Stops reading the frames of a connection
+        """
+        watcher = self.watchers.pop(connection, None)
+        if watcher is not None:
+            watcher.stop()
+        self.last_read.pop(connection, None)
+
+    def _readable(self, connection):
+        # Called by the hub, the watcher is stopped until the frames are read,
+        # so a socket with pending data doesn't wake up the pump again
+        self.watchers[connection].stop()
+        self.ready.append(connection)
+        self._wakeup.set()
+
+    def _read(self, connection):
+        frames_read = connection.frames_read
+        try:
+            connection.read_frames()
+        except Exception:
+            # Errors of a connection can't stop the pump for all the others,
+            # a connection error closes the connection
+            pass
+        self.last_read[connection] = time.time()
+
+        # The heartbeat is negotiated after the connection is registered
+        if connection._heartbeat and (self.heartbeat_interval is None or connection._heartbeat / 2.0 < self.heartbeat_interval):
+            self.heartbeat_interval = connection._heartbeat / 2.0
+            self._next_heartbeat = time.time() + self.heartbeat_interval
+
+        if connection.closed or connection.transport is None:
+            self.unregister(connection)
+        else:
+            self.watchers[connection].start(self._readable, connection)
+        return connection.frames_read - frames_read
+
+    def _heartbeats(self):
+        """
+            Sends the heartbeats due, and closes the connections without
+            any traffic from the broker for two heartbeat intervals
+        """
+        now = time.time()
+        for connection in list(self.watchers):
+            if not connection._heartbeat:
+                continue
+            if now - self.last_read[connection] > 2 * connection._heartbeat:
+                self.unregister(connection)
+                connection.transport_closed(
+                    msg='Heartbeats not received for {} seconds'.format(2 * connection._heartbeat))
+            else:
+                connection.channel(0).send_heartbeat()
+
+    def _run(self):
+        while self.watchers:
+            timeout = None
+            if self._next_heartbeat is not None:
+                timeout = max(self._next_heartbeat - time.time(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+            ready, self.ready = self.ready, []
+            frames = 0
+            for connection in ready:
+                if connection in self.watchers:
+                    frames += self._read(connection)
+
+            if self._next_heartbeat is not None and time.time() >= self._next_heartbeat:
+                self._heartbeats()
+                self._next_heartbeat = time.time() + self.heartbeat_interval
+
+            self.wakeups += 1
+            self.frames += frames
+            self.metrics.inc('maxcarrot_pump_wakeups_total')
+            if frames:
+                self.metrics.inc('maxcarrot_pump_frames_total', frames)
+
+    @property
+    def stats(self):
+        """
+            Connections served, wakeups of the pump greenlet and frames read
+        """
+        return {
+            'connections': len(self.watchers),
+            'wakeups': self.wakeups,
+            'frames': self.frames,
+            'frames_per_wakeup': float(self.frames) / self.wakeups if self.wakeups else 0.0
+        }
+
+
+PUMP = MessagePump()
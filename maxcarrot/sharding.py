@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import re
+
+SHARDED_QUEUES = ('messages', 'push')
+
+
+def shard_exchange(queue):
+    """
+        Returns the name of the x-consistent-hash exchange spreading
+        the messages of a sharded queue over its shards
+    """
+    return '{}.shards'.format(queue)
+
+
+def shard_queues(queue, shards):
+    """
+        Returns the names of the shards of a queue, as messages.0, messages.1 ...
+    """
+    return ['{}.{}'.format(queue, shard) for shard in range(shards)]
+
+
+def sharded_specs(resource_specs, shards, queues=SHARDED_QUEUES):
+    """
+        Returns a copy of resource_specs with queues split in shards.
+
+        Each sharded queue is replaced by shards queues, bound to a new
+        x-consistent-hash exchange that gets the bindings of the original queue.
+        The exchange hashes the routing key of each message to pick its shard,
+        so all the messages of a conversation go to the same shard, in order.
+
+        Shard queues are matched by their exact names, so cleanup deletes the
+        unsharded queue and the shards beyond the current number of shards.
+    """
+    exchanges = []
+    sharded = []
+    for spec in resource_specs['queues']:
+        if spec['name'] not in queues:
+            sharded.append(spec)
+            continue
+
+        exchange = shard_exchange(spec['name'])
+        exchanges.append({
+            'name': exchange, 'spec': re.escape(exchange) + '$', 'type': 'x-consistent-hash',
+            'bindings': [
+                {'source': binding['exchange'], 'routing_key': binding.get('routing_key', '')}
+                for binding in spec.get('bindings', [])
+            ]
+        })
+        for name in shard_queues(spec['name'], shards):
+            sharded.append({
+                'name': name, 'spec': re.escape(name) + '$', 'shard_of': spec['name'],
+                'bindings': [{'exchange': exchange, 'routing_key': '1'}]
+            })
+
+    return {
+        'exchanges': list(resource_specs['exchanges']) + exchanges,
+        'queues': sharded
+    }
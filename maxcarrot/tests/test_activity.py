@@ -104,3 +104,40 @@ class FunctionalTests(RabbitTests):
 
         context_bindings = [binding for binding in bindings if binding['routing_key'].startswith('context')]
         self.assertEqual(len(context_bindings), 2)
+
+    def test_delete_context_failed_batch(self):
+        """
+        Given a client with its context bindings index loaded
+        When the context is removed but some of its unbinds fail
+        Then the index is loaded again on next use
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.activity.create('context1', users=['sheldon', 'leonard'])
+        self.server.activity.rebuild_index()
+        self.server.ch.exchange.delete('sheldon.subscribe')
+
+        report = self.server.activity.delete('context1')
+
+        self.assertEqual(len(report.failed_batches), 1)
+        self.assertFalse(self.server.activity.index.loaded)
+
+    def test_sync_context(self):
+        """
+        Given two users subscribed to a context
+        When the context subscribers are synced to one of them and a new user
+        Then only the changed users are bound and unbound
+        And the context bindings match the new subscribers
+        """
+        self.server.create_users(['sheldon', 'leonard', 'penny'])
+        self.server.activity.create('context1', users=['sheldon', 'leonard'])
+
+        result = self.server.activity.sync('context1', ['sheldon', 'penny'])
+
+        bindings = self.server.management.load_exchange_bindings('activity')
+        context_bindings = sorted([binding['destination'] for binding in bindings if binding['routing_key'] == 'context1'])
+
+        self.assertEqual(result['added'], ['penny'])
+        self.assertEqual(result['removed'], ['leonard'])
+        self.assertEqual(result['bound'].processed, 1)
+        self.assertEqual(result['unbound'].processed, 1)
+        self.assertEqual(context_bindings, ['penny.subscribe', 'sheldon.subscribe'])
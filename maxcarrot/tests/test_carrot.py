@@ -1,4 +1,12 @@
+from maxcarrot import RabbitClient
+from maxcarrot import RabbitConnectionPool
+from maxcarrot.metrics import METRICS
+from maxcarrot.metrics import Metrics
 from maxcarrot.tests import RabbitTests
+from maxcarrot.tests import TEST_VHOST_URL
+from maxcarrot.tests import TEST_TRANSPORT
+from time import sleep
+from time import time
 
 
 class FunctionalTests(RabbitTests):
@@ -30,3 +38,277 @@ class FunctionalTests(RabbitTests):
         self.server.management.load_exchanges()
         self.assertNotIn('sheldon.publish', self.server.management.exchanges_by_name)
         self.assertNotIn('sheldon.subscribe', self.server.management.exchanges_by_name)
+
+    def test_consume_user_queue(self):
+        """
+        Given a user consuming its queue
+        When two internal messages are sent
+        Then the consumer yields both messages
+        """
+        self.server.create_users(['sheldon'])
+        sheldon = self.getClient('sheldon')
+        consumer = sheldon.consume(timeout=1)
+
+        sheldon.send_internal({'text': 'Hello!'})
+        sheldon.send_internal({'text': 'Hello again!'})
+
+        payloads = [payload for payload, message in consumer]
+        self.assertEqual(payloads, [{'text': 'Hello!'}, {'text': 'Hello again!'}])
+
+    def test_consume_named_queue_in_batches(self):
+        """
+        Given a consumer on the messages queue
+        When three messages are posted to a conversation
+        Then the callback receives all the messages in batches
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+        sheldon = self.getClient('sheldon')
+        for num in range(3):
+            sheldon.conversations.send('conversation1', 'Hello {}'.format(num))
+
+        batches = []
+        consumer = self.server.consume('messages', prefetch_count=2, no_ack=False, timeout=1)
+        consumer.run(batches.append, batch_size=2)
+
+        self.assertEqual(sum([len(batch) for batch in batches]), 3)
+        self.assertTrue(all([len(batch) <= 2 for batch in batches]))
+
+    def test_get_all_limits(self):
+        """
+        Given a user with five messages queued
+        When messages are retrieved with a limit of two
+        Then only two messages are retrieved
+        And the remaining messages stay in the queue
+        """
+        self.server.create_users(['sheldon'])
+        sheldon = self.getClient('sheldon')
+        for num in range(5):
+            sheldon.send_internal('Hello {}'.format(num))
+
+        sleep(0.3)  # give a minum time to mail to be sent
+
+        self.assertEqual(len(sheldon.get_all(max_messages=2)), 2)
+        self.assertEqual(len(sheldon.get_all()), 3)
+
+    def test_get_all_retry_timeout(self):
+        """
+        Given a user without messages
+        When messages are retrieved waiting for them
+        Then the wait gives up after the timeout
+        """
+        self.server.create_users(['sheldon'])
+        sheldon = self.getClient('sheldon')
+
+        start = time()
+        messages = sheldon.get_all(retry=True, timeout=0.5)
+
+        self.assertEqual(len(messages), 0)
+        self.assertTrue(time() - start < 5)
+
+    def test_pooled_clients(self):
+        """
+        Given a pool of two connections
+        When three users connect through the pool
+        Then they share the two connections
+        And each of them still receives its own messages
+        """
+        self.server.create_users(['sheldon', 'leonard', 'penny'])
+        pool = RabbitConnectionPool(TEST_VHOST_URL, size=2, transport=TEST_TRANSPORT)
+        clients = [pool.client(user=username) for username in ['sheldon', 'leonard', 'penny']]
+
+        self.assertEqual(pool.stats['connections'], 2)
+        self.assertEqual(pool.stats['channels'], 3)
+
+        clients[0].send_internal('Hello!')
+        self.assertEqual(len(clients[0].get_all(retry=True, timeout=1)), 1)
+        self.assertEqual(len(clients[1].get_all()), 0)
+
+        for client in clients:
+            client.disconnect()
+        self.assertEqual(pool.stats['channels'], 0)
+        pool.close()
+
+    def test_pooled_clients_cleanup(self):
+        """
+        Given a pool of one connection
+        When two users connect through the pool and disconnect
+        Then they share the management api client, the pipeline and the indexes
+        And their session queues are deleted while the connection stays open
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        pool = RabbitConnectionPool(TEST_VHOST_URL, size=1, transport=TEST_TRANSPORT)
+        clients = [pool.client(user=username) for username in ['sheldon', 'leonard']]
+        queues = [client.queue for client in clients]
+
+        self.assertIs(clients[0].management, clients[1].management)
+        self.assertIs(clients[0].pipeline, clients[1].pipeline)
+        self.assertIs(clients[0].conversations.index, clients[1].conversations.index)
+
+        for client in clients:
+            client.disconnect()
+
+        # Before the pool closes the connection that owns them
+        self.server.management.invalidate()
+        self.server.management.load_queues()
+        for queue in queues:
+            self.assertNotIn(queue, self.server.management.queues_by_name)
+        pool.close()
+
+    def test_provision_users(self):
+        """
+        Given a list of users to create
+        When they are provisioned in bulk
+        Then all their exchanges are created
+        """
+        usernames = ['user{}'.format(num) for num in range(25)]
+        report = self.server.provision_users(usernames, batch_size=4, channels=3)
+
+        self.server.management.load_exchanges()
+        self.assertEqual(report.provisioned, 25)
+        self.assertEqual(report.failed_batches, [])
+        for username in usernames:
+            self.assertIn('{}.publish'.format(username), self.server.management.exchanges_by_name)
+            self.assertIn('{}.subscribe'.format(username), self.server.management.exchanges_by_name)
+
+    def test_provision_users_failed_batch(self):
+        """
+        Given an existing exchange with the name of a user exchange but a different type
+        When users are provisioned in bulk
+        Then the batch with that user fails
+        And the other batches succeed
+        """
+        self.server.ch.exchange.declare(exchange='user5.publish', type='fanout', durable=True, auto_delete=False)
+        usernames = ['user{}'.format(num) for num in range(10)]
+        report = self.server.provision_users(usernames, batch_size=4, channels=2)
+
+        self.assertEqual(report.provisioned, 6)
+        self.assertEqual(report.resume_from, 4)
+        self.assertEqual(report.failed_users, ['user4', 'user5', 'user6', 'user7'])
+
+    def test_import_definitions(self):
+        """
+        Given a topology with two users in a conversation and a context
+        When it's imported as definitions
+        Then the users exchanges and bindings are created
+        And the topology can be exported back
+        """
+        definitions = self.server.management.build_definitions(
+            users=['sheldon', 'leonard'],
+            conversations={'conversation1': ['sheldon', 'leonard']},
+            contexts={'context1': ['sheldon']})
+        self.server.management.import_definitions(definitions)
+
+        self.server.management.load_exchanges()
+        self.assertIn('sheldon.publish', self.server.management.exchanges_by_name)
+        self.assertIn('leonard.subscribe', self.server.management.exchanges_by_name)
+
+        exported = self.server.management.export_definitions()
+        bindings = [(binding['source'], binding['destination'], binding['routing_key']) for binding in exported['bindings']]
+        self.assertIn(('sheldon.publish', 'conversations', 'conversation1.*'), bindings)
+        self.assertIn(('conversations', 'leonard.subscribe', 'conversation1.*'), bindings)
+        self.assertIn(('activity', 'sheldon.subscribe', 'context1'), bindings)
+
+    def test_concurrent_management(self):
+        """
+        Given two users in a conversation
+        When the management api is used with concurrent requests
+        Then exchanges, queues and bindings are loaded as with serial requests
+        And bindings are deleted in bulk
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+
+        management = self.server.management
+        management.concurrency = 4
+        management.load_all()
+        bindings = list(management.load_exchange_bindings('conversations'))
+
+        self.assertIn('sheldon.publish', management.exchanges_by_name)
+        self.assertIn('messages', management.queues_by_name)
+        self.assertEqual(len([binding for binding in bindings if binding['routing_key'] == 'conversation1.*']), 4)
+
+        management.delete_bindings([binding for binding in bindings if binding['routing_key'] == 'conversation1.*'])
+        bindings = list(management.load_exchange_bindings('conversations'))
+        self.assertEqual(len([binding for binding in bindings if binding['routing_key'] == 'conversation1.*']), 0)
+
+    def test_paginated_loads(self):
+        """
+        Given a bunch of users
+        When exchanges are loaded in small pages with a few columns
+        Then all the exchanges are returned with only those columns
+        """
+        usernames = ['user{}'.format(num) for num in range(10)]
+        self.server.create_users(usernames)
+
+        exchanges = list(self.server.management.iter_exchanges(page_size=3, columns=['name', 'type']))
+        names = [exchange['name'] for exchange in exchanges]
+
+        self.assertEqual(len(names), len(set(names)))
+        for username in usernames:
+            self.assertIn('{}.publish'.format(username), names)
+        self.assertEqual(set(exchanges[0].keys()), set(['name', 'type']))
+
+    def test_cleanup_plan(self):
+        """
+        Given a user and an exchange not matching any spec
+        When a cleanup is planned
+        Then the unknown exchange is planned for deletion
+        And the user exchanges are only planned when deleting all
+        And executing the plan deletes them
+        """
+        self.server.create_users(['sheldon'])
+        self.server.ch.exchange.declare(exchange='unknown', type='topic', durable=True, auto_delete=False)
+
+        plan = self.server.management.plan_cleanup()
+        self.assertEqual(plan['exchanges'], [{'name': 'unknown', 'reason': 'unmatched'}])
+
+        plan = self.server.management.plan_cleanup(delete_all=True)
+        planned = [item['name'] for item in plan['exchanges']]
+        self.assertIn('sheldon.publish', planned)
+        self.assertNotIn('amq.direct', planned)
+
+        progress = []
+        reports = self.server.management.execute_cleanup(plan, progress_cb=lambda type, report: progress.append(type))
+        self.assertEqual(reports['exchanges'].processed, len(planned))
+        self.assertIn('exchanges', progress)
+
+        self.server.management.load_exchanges()
+        self.assertNotIn('sheldon.publish', self.server.management.exchanges_by_name)
+        self.assertNotIn('unknown', self.server.management.exchanges_by_name)
+
+    def test_metrics(self):
+        """
+        Given a client with its own metrics
+        When a user is created and the management api is used
+        Then the rpcs and the management requests are timed
+        """
+        metrics = Metrics()
+        client = RabbitClient(TEST_VHOST_URL, metrics=metrics, transport=TEST_TRANSPORT)
+        client.create_user('sheldon')
+        client.management.load_exchanges()
+        client.disconnect()
+
+        self.assertEqual(metrics.value('maxcarrot_rpc_seconds', method='exchange.declare'), 2)
+        self.assertEqual(metrics.value('maxcarrot_rpc_seconds', method='exchange.bind'), 1)
+        self.assertEqual(metrics.value('maxcarrot_management_seconds', method='GET', endpoint='exchanges'), 1)
+        self.assertIn('maxcarrot_rpc_seconds_count{method="exchange.declare"} 2', metrics.exposition())
+
+    def test_codec_metrics(self):
+        """
+        Given a client with its own metrics
+        When it sends and receives messages
+        Then encoding and decoding are timed in its metrics only
+        """
+        metrics = Metrics()
+        client = RabbitClient(TEST_VHOST_URL, metrics=metrics, transport=TEST_TRANSPORT)
+        client.ch.queue.declare('codec', auto_delete=True)
+        shared = METRICS.value('maxcarrot_codec_seconds', operation='encode')
+
+        client.send('', {'text': 'Hello!'}, routing_key='codec')
+        client.get_all('codec')
+        client.disconnect()
+
+        self.assertEqual(metrics.value('maxcarrot_codec_seconds', operation='encode'), 1)
+        self.assertEqual(metrics.value('maxcarrot_codec_seconds', operation='decode'), 1)
+        self.assertEqual(METRICS.value('maxcarrot_codec_seconds', operation='encode'), shared)
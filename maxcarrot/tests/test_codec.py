@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import unittest
+from maxcarrot.codec import LazySpecCodec
+from maxcarrot.codec import SpecCodec
+from maxcarrot.message import SPECIFICATION
+from maxcarrot.message import _SPECIFICATION
+from maxcarrot.message import load_specification
+from maxcarrot.metrics import Metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class CodecTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.codec = SpecCodec(load_specification())
+
+    def test_pack_values_and_plain_fields(self):
+        packed = self.codec.pack({'action': 'add', 'object': 'message', 'domain': 'test'})
+        self.assertEqual(packed, {'a': 'a', 'o': 'm', 'i': 'test'})
+
+    def test_pack_drops_unknown_fields_and_values(self):
+        packed = self.codec.pack({'action': 'unknown', 'foo': 'bar'})
+        self.assertEqual(packed, {})
+
+    def test_pack_object_fields(self):
+        packed = self.codec.pack({'user': {'username': 'foo', 'displayname': 'bar', 'extra': 1}})
+        self.assertEqual(packed, {'u': {'u': 'foo', 'd': 'bar', 'extra': 1}})
+
+    def test_unpack_object_fields(self):
+        unpacked = self.codec.unpack({'u': {'u': 'foo', 'd': 'bar'}})
+        self.assertEqual(unpacked, {'user': {'username': 'foo', 'displayname': 'bar'}})
+
+    def test_unpack_ignores_non_string_values(self):
+        unpacked = self.codec.unpack({'a': 1, 'o': 'm'})
+        self.assertEqual(unpacked, {'object': 'message'})
+
+    def test_pack_many_unpack_many(self):
+        messages = [
+            {'action': 'add', 'object': 'message', 'data': {'text': 'Hello'}},
+            {'action': 'delete', 'object': 'conversation'}
+        ]
+        packed = self.codec.pack_many(messages)
+        self.assertEqual(packed[0], {'a': 'a', 'o': 'm', 'd': {'text': 'Hello'}})
+        self.assertEqual(self.codec.unpack_many(packed), messages)
+
+
+    def test_metrics(self):
+        metrics = Metrics()
+        codec = LazySpecCodec(load_specification, metrics=metrics)
+
+        codec.unpack(codec.pack({'action': 'add'}))
+        codec.metrics = None
+        codec.pack({'action': 'add'})
+
+        self.assertEqual(metrics.value('maxcarrot_codec_seconds', operation='pack'), 1)
+        self.assertEqual(metrics.value('maxcarrot_codec_seconds', operation='unpack'), 1)
+        self.assertEqual(self.codec.metrics, None)
+
+
+class SpecificationTests(unittest.TestCase):
+    """
+    """
+    def test_module_aliases(self):
+        self.assertEqual(dict(SPECIFICATION), load_specification())
+        self.assertEqual(_SPECIFICATION[SPECIFICATION['action']['id']]['name'], 'action')
+
+    def test_import_defers_optional_modules(self):
+        code = 'import sys, maxcarrot; print(" ".join(sorted(sys.modules)))'
+        modules = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT).split()
+        for module in ('gevent', 'requests', 'ijson', 'multiprocessing.pool', 'BaseHTTPServer',
+                       'maxcarrot.memory', 'maxcarrot.cluster', 'maxcarrot.sharding', 'maxcarrot.management'):
+            self.assertNotIn(module, modules)
@@ -1,4 +1,8 @@
+from maxcarrot import RabbitClient
+from maxcarrot.management import ManagementCache
 from maxcarrot.tests import RabbitTests
+from maxcarrot.tests import TEST_TRANSPORT
+from maxcarrot.tests import TEST_VHOST_URL
 from time import sleep
 
 
@@ -236,3 +240,155 @@ class FunctionalTests(RabbitTests):
 
         conversation_bindings = [binding for binding in bindings if binding['routing_key'].startswith('conversation')]
         self.assertEqual(len(conversation_bindings), 4)
+
+    def test_delete_conversation_prefixed_others_remain(self):
+        """
+        Given two users in two conversations, one name prefixing the other
+        When the shorter conversation gets removed from a fresh client
+        Then only it's associated bindings disappear
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+        self.server.conversations.create('conversation10', users=['sheldon', 'leonard'])
+
+        client = self.getClient('sheldon')
+        client.conversations.delete('conversation1')
+
+        bindings = self.server.management.load_exchange_bindings('conversations')
+
+        conversation_bindings = [binding['routing_key'] for binding in bindings if binding['routing_key'].startswith('conversation')]
+        self.assertEqual(conversation_bindings, ['conversation10.*'] * 4)
+
+    def test_delete_conversation_bound_elsewhere(self):
+        """
+        Given a client with its conversation bindings index loaded
+        When another client adds a user to the conversation
+        And the conversation is removed once the index expired
+        Then the bindings made by the other client disappear too
+        """
+        self.server.create_users(['sheldon', 'leonard', 'penny'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+        self.server.conversations.rebuild_index()
+
+        client = self.getClient('sheldon')
+        client.conversations.bind_user('conversation1', 'penny')
+        self.server.conversations.index.loaded_at -= self.server.conversations.index.ttl
+
+        self.server.conversations.delete('conversation1')
+
+        bindings = self.server.management.load_exchange_bindings('conversations')
+        conversation_bindings = [binding for binding in bindings if binding['routing_key'].startswith('conversation1')]
+        self.assertEqual(conversation_bindings, [])
+
+    def test_delete_conversation_failed_batch(self):
+        """
+        Given a client with its conversation bindings index loaded
+        When the conversation is removed but some of its unbinds fail
+        Then the index is loaded again on next use
+        And removing the conversation again unbinds what was left
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+        self.server.conversations.rebuild_index()
+        self.server.ch.exchange.delete('sheldon.subscribe')
+
+        report = self.server.conversations.delete('conversation1')
+
+        self.assertEqual(len(report.failed_batches), 1)
+        self.assertFalse(self.server.conversations.index.loaded)
+
+        report = self.server.conversations.delete('conversation1')
+
+        bindings = self.server.management.load_exchange_bindings('conversations')
+        conversation_bindings = [binding for binding in bindings if binding['routing_key'].startswith('conversation1')]
+        self.assertEqual(report.failed_batches, [])
+        self.assertEqual(conversation_bindings, [])
+
+    def test_conversation_index_ttl(self):
+        """
+        Given a client created with index_ttl=None
+        When its conversation bindings index is loaded
+        Then it never expires
+        """
+        client = RabbitClient(TEST_VHOST_URL, transport=TEST_TRANSPORT, index_ttl=None)
+        client.conversations.rebuild_index()
+        client.conversations.index.loaded_at -= 3600
+        client.disconnect()
+
+        self.assertTrue(client.conversations.index.loaded)
+
+    def test_sync_conversation(self):
+        """
+        Given two users in a conversation
+        When the conversation members are synced to one of them and a new user
+        Then the removed user stops receiving messages
+        And the new user receives messages
+        """
+        self.server.create_users(['sheldon', 'leonard', 'penny'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+
+        result = self.server.conversations.sync('conversation1', ['sheldon', 'penny'])
+
+        sheldon = self.getClient('sheldon')
+        leonard = self.getClient('leonard')
+        penny = self.getClient('penny')
+
+        sheldon.conversations.send('conversation1', 'Hello')
+
+        self.assertEqual(result['added'], ['penny'])
+        self.assertEqual(result['removed'], ['leonard'])
+        self.assertEqual(result['bound'].processed, 2)
+        self.assertEqual(result['unbound'].processed, 2)
+        self.assertEqual(len(leonard.get_all()), 0)
+        self.assertEqual(len(penny.get_all(retry=True, timeout=5)), 1)
+
+    def test_send_many(self):
+        """
+        Given two users in a conversation
+        When one of them sends a burst of messages
+        Then all the messages are confirmed
+        And the other user receives all of them
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+
+        sheldon = self.getClient('sheldon')
+        leonard = self.getClient('leonard')
+
+        acked = []
+        result = sheldon.conversations.send_many(
+            [('conversation1', 'Hello {}'.format(num)) for num in range(10)],
+            window=3, ack_cb=acked.append)
+
+        messages_to_leonard = leonard.get_all()
+
+        self.assertEqual(result, {'published': 10, 'acked': 10, 'nacked': 0, 'pending': 0})
+        self.assertEqual(len(acked), 10)
+        self.assertEqual(len(messages_to_leonard), 10)
+
+        # The callbacks only apply to the burst
+        sheldon.publisher.publish('', 'nowhere', '"Bye"')
+        self.assertTrue(sheldon.publisher.wait_for_confirms(timeout=5))
+        self.assertEqual(len(acked), 10)
+
+    def test_cached_bindings_invalidated_by_unbind(self):
+        """
+        Given two users in a conversation and a management cache
+        When the conversation bindings are loaded twice
+        Then the second load comes from the cache
+        And unbinding a user invalidates the cached bindings
+        """
+        self.server.create_users(['sheldon', 'leonard'])
+        self.server.conversations.create('conversation1', users=['sheldon', 'leonard'])
+
+        management = self.server.management
+        management.cache = ManagementCache(ttl=60)
+        list(management.load_exchange_bindings('conversations'))
+        bindings = list(management.load_exchange_bindings('conversations'))
+        self.assertEqual(management.cache.stats['hits'], 1)
+        self.assertEqual(len([binding for binding in bindings if binding['routing_key'] == 'conversation1.*']), 4)
+
+        self.server.conversations.unbind_user('conversation1', 'leonard')
+        bindings = list(management.load_exchange_bindings('conversations'))
+        self.assertEqual(management.cache.stats['misses'], 2)
+        self.assertEqual(len([binding for binding in bindings if binding['routing_key'] == 'conversation1.*']), 2)
@@ -0,0 +1,28 @@
+import unittest
+from maxcarrot.decoder import JSONDecoder
+
+
+class DecoderTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.decoder = JSONDecoder(backend='json')
+
+    def test_clean_body_is_not_repaired(self):
+        decoded = self.decoder.loads('{"d": {"text": "a \\"quoted\\" \\u00e9"}}')
+        self.assertEqual(decoded['d']['text'], u'a "quoted" \xe9')
+        self.assertEqual(self.decoder.stats['repaired'], 0)
+
+    def test_body_with_control_chars_is_repaired(self):
+        decoded = self.decoder.loads('{"d": {"text": "this is a\nline break"}}')
+        self.assertEqual(decoded['d']['text'], 'this is a\nline break')
+        self.assertEqual(self.decoder.stats['decoded'], 1)
+        self.assertEqual(self.decoder.stats['repaired'], 1)
+        self.assertEqual(self.decoder.stats['repair_ratio'], 1.0)
+
+    def test_invalid_body_fails(self):
+        self.assertRaises(ValueError, self.decoder.loads, '{"d": ')
+        self.assertEqual(self.decoder.stats['failed'], 1)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, JSONDecoder, backend='foojson')
@@ -0,0 +1,54 @@
+import unittest
+from maxcarrot.index import BindingIndex
+
+
+class BindingIndexTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.index = BindingIndex()
+        self.index.add('conversation1', 'sheldon', ('sheldon.publish', 'conversations', 'conversation1.*'))
+        self.index.add('conversation1', 'sheldon', ('conversations', 'sheldon.subscribe', 'conversation1.*'))
+        self.index.add('conversation1', 'leonard', ('conversations', 'leonard.subscribe', 'conversation1.*'))
+        self.index.add('conversation10', 'sheldon', ('conversations', 'sheldon.subscribe', 'conversation10.*'))
+
+    def test_users_and_keys(self):
+        self.assertEqual(self.index.users('conversation1'), set(['sheldon', 'leonard']))
+        self.assertEqual(self.index.keys('sheldon'), set(['conversation1', 'conversation10']))
+        self.assertEqual(self.index.users('unknown'), set())
+
+    def test_pop_matches_key_exactly(self):
+        removed = self.index.pop('conversation1')
+        self.assertEqual(len(removed), 3)
+        self.assertEqual(self.index.users('conversation1'), set())
+        self.assertEqual(self.index.users('conversation10'), set(['sheldon']))
+        self.assertEqual(self.index.keys('leonard'), set())
+
+    def test_remove(self):
+        removed = self.index.remove('conversation1', 'sheldon')
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(self.index.users('conversation1'), set(['leonard']))
+        self.assertEqual(self.index.keys('sheldon'), set(['conversation10']))
+
+    def test_remove_user(self):
+        removed = self.index.remove_user('sheldon')
+        self.assertEqual(len(removed), 3)
+        self.assertEqual(self.index.keys('sheldon'), set())
+        self.assertEqual(self.index.users('conversation1'), set(['leonard']))
+        self.assertNotIn('conversation10', self.index.bindings)
+
+    def test_clear(self):
+        self.index.loaded = True
+        self.index.clear()
+        self.assertEqual(self.index.bindings, {})
+        self.assertEqual(self.index.keys_by_user, {})
+        self.assertFalse(self.index.loaded)
+
+    def test_loaded_expires(self):
+        self.index.loaded = True
+        self.assertTrue(self.index.loaded)
+        self.index.loaded_at -= 31
+        self.assertFalse(self.index.loaded)
+
+        self.index.ttl = None
+        self.assertTrue(self.index.loaded)
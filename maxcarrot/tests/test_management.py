@@ -0,0 +1,109 @@
+import threading
+import unittest
+from maxcarrot.client import RabbitClient
+from maxcarrot.management import ManagementCache
+from maxcarrot.management import SpecMatcher
+
+
+class SpecMatcherTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.matcher = SpecMatcher(RabbitClient.resource_specs['exchanges'])
+
+    def test_match_first_spec(self):
+        self.assertEqual(self.matcher.match('conversations')['name'], 'conversations')
+        self.assertEqual(self.matcher.match('sheldon.publish')['name'], 'user_publish')
+        self.assertEqual(self.matcher.match('sheldon.subscribe')['name'], 'user_subscribe')
+        self.assertEqual(self.matcher.match('amq.direct')['name'], 'internal')
+        self.assertEqual(self.matcher.match('')['name'], 'default')
+
+    def test_match_is_anchored_at_start(self):
+        self.assertEqual(self.matcher.match('conversations.old')['name'], 'conversations')
+        self.assertIsNone(self.matcher.match('old.conversations'))
+
+    def test_no_match(self):
+        self.assertIsNone(self.matcher.match('unknown'))
+
+    def test_mismatches(self):
+        spec = self.matcher.match('conversations')
+        self.assertFalse(self.matcher.mismatches({'type': 'topic', 'auto_delete': False, 'durable': True}, spec))
+        self.assertTrue(self.matcher.mismatches({'type': 'fanout', 'auto_delete': False, 'durable': True}, spec))
+        self.assertTrue(self.matcher.mismatches({'type': 'topic', 'auto_delete': True, 'durable': True}, spec))
+        self.assertTrue(self.matcher.mismatches({'type': 'topic', 'auto_delete': False, 'durable': False}, spec))
+
+
+class ManagementCacheTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.loads = []
+
+    def load(self, value):
+        def load():
+            self.loads.append(value)
+            return value
+        return load
+
+    def test_hit_and_miss(self):
+        cache = ManagementCache(ttl=60)
+        self.assertEqual(cache.get(('exchanges',), self.load(1)), 1)
+        self.assertEqual(cache.get(('exchanges',), self.load(2)), 1)
+        self.assertEqual(self.loads, [1])
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_expired_entries_are_reloaded(self):
+        cache = ManagementCache(ttl=-1)
+        cache.get(('exchanges',), self.load(1))
+        self.assertEqual(cache.get(('exchanges',), self.load(2)), 2)
+        self.assertEqual(cache.stats['hits'], 0)
+
+    def test_size_bound_drops_least_recently_used(self):
+        cache = ManagementCache(ttl=60, size=2)
+        cache.get(('bindings', 'a'), self.load('a'))
+        cache.get(('bindings', 'b'), self.load('b'))
+        cache.get(('bindings', 'a'), self.load('a'))
+        cache.get(('bindings', 'c'), self.load('c'))
+        self.assertEqual(list(cache.entries), [('bindings', 'a'), ('bindings', 'c')])
+
+    def test_invalidate(self):
+        cache = ManagementCache(ttl=60)
+        cache.get(('bindings', 'a'), self.load('a'))
+        cache.get(('bindings', 'b'), self.load('b'))
+        cache.invalidate(('bindings', 'a'), ('bindings', 'unknown'))
+        self.assertEqual(list(cache.entries), [('bindings', 'b')])
+        cache.invalidate()
+        self.assertEqual(cache.stats['entries'], 0)
+        self.assertEqual(cache.stats['invalidations'], 2)
+
+    def test_invalidated_while_loading(self):
+        cache = ManagementCache(ttl=60)
+
+        def load():
+            cache.invalidate(('exchanges',))
+            return 1
+
+        self.assertEqual(cache.get(('exchanges',), load), 1)
+        self.assertEqual(cache.get(('exchanges',), self.load(2)), 2)
+
+    def test_threads(self):
+        cache = ManagementCache(ttl=60, size=10)
+        errors = []
+
+        def work(offset):
+            try:
+                for num in range(2000):
+                    cache.get(('bindings', (num + offset) % 20), self.load(num))
+                    if num % 7 == 0:
+                        cache.invalidate(('bindings', num % 20))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(cache.stats['entries'], 10)
@@ -1,5 +1,13 @@
+import datetime
+import json
+import time
 import unittest
+from maxcarrot.message import MessagePreparer
 from maxcarrot.message import RabbitMessage
+from rfc3339 import rfc3339
+from uuid import UUID
+from uuid import getnode
+from uuid import uuid1
 
 
 class FunctionalTests(unittest.TestCase):
@@ -52,3 +60,89 @@ class FunctionalTests(unittest.TestCase):
         packed = '{"d": {"text": "this is a\nline break"}}'
         message = RabbitMessage.unpack(packed)
         self.assertEqual(message['data']['text'], 'this is a\nline break')
+
+    def test_message_without_copy(self):
+        unpacked = {'action': 'add', 'data': {'text': 'Hello'}}
+        message = RabbitMessage(unpacked, copy=False)
+        self.assertIs(message['data'], unpacked['data'])
+
+    def test_unpack_from_dict_is_copied(self):
+        packed = {'a': 'a', 'd': {'text': 'Hello'}}
+        message = RabbitMessage.unpack(packed)
+        self.assertIsNot(message['data'], packed['d'])
+
+    def test_unpack_from_dict_without_copy(self):
+        packed = {'a': 'a', 'd': {'text': 'Hello'}}
+        message = RabbitMessage.unpack(packed, copy=False)
+        self.assertIs(message['data'], packed['d'])
+
+    def test_lazy_view_from_string(self):
+        message = RabbitMessage.view('{"a": "a", "o": "m", "u": {"u": "foo"}}')
+        self.assertEqual(message['action'], 'add')
+        self.assertEqual(message.object, 'message')
+        self.assertEqual(sorted(dict.keys(message)), ['action', 'object'])
+        self.assertEqual(message.get('source'), None)
+        self.assertNotIn('source', message)
+        self.assertEqual(message['user'], {'username': 'foo'})
+
+    def test_lazy_view_materializes(self):
+        message = RabbitMessage.view({'a': 'a', 'o': 'm'})
+        self.assertEqual(len(message), 2)
+        self.assertEqual(message, {'action': 'add', 'object': 'message'})
+        self.assertEqual(message.packed, {'a': 'a', 'o': 'm'})
+
+    def test_lazy_view_copies_are_complete(self):
+        expected = {'action': 'add', 'object': 'message', 'data': {'text': 'Hello'}}
+        body = '{"a": "a", "o": "m", "d": {"text": "Hello"}}'
+
+        message = RabbitMessage.view(body)
+        message['action']
+        self.assertEqual(dict(message), expected)
+
+        updated = {}
+        updated.update(RabbitMessage.view(body))
+        self.assertEqual(updated, expected)
+
+        message = RabbitMessage.view(body)
+        message['object']
+        self.assertEqual(json.loads(json.dumps(message)), expected)
+        self.assertEqual(dict(message.items()), expected)
+
+    def test_lazy_view_delete_field(self):
+        message = RabbitMessage.view({'a': 'a', 'o': 'm'})
+        del message['action']
+        self.assertNotIn('action', message)
+        self.assertEqual(message.keys(), ['object'])
+
+    def test_prepare_many(self):
+        messages = RabbitMessage.prepare_many([RabbitMessage() for num in range(3)], {'source': 'max'})
+        self.assertEqual(len(set(message['uuid'] for message in messages)), 3)
+        self.assertEqual(len(set(message['published'] for message in messages)), 1)
+        self.assertEqual(messages[0]['source'], 'max')
+
+    def test_preparer_formats(self):
+        preparer = MessagePreparer()
+        now = time.time()
+        self.assertEqual(
+            preparer.published(now),
+            rfc3339(datetime.datetime.utcfromtimestamp(int(now)), utc=True, use_system_timezone=False))
+
+        uuids = preparer.uuids(1000, now)
+        self.assertEqual(len(set(uuids)), 1000)
+        parsed = [UUID(value) for value in uuids]
+        self.assertEqual([str(value) for value in parsed], uuids)
+        self.assertEqual(set(value.version for value in parsed), set([1]))
+        self.assertEqual(set(value.node for value in parsed), set([getnode()]))
+        self.assertEqual([value.time for value in parsed], sorted(value.time for value in parsed))
+        self.assertAlmostEqual(parsed[0].time, uuid1().time, delta=10 ** 7)
+
+        # Next batches never reuse timestamps, even for a clock going back
+        self.assertGreater(UUID(preparer.uuids(1, now - 1)[0]).time, parsed[-1].time)
+
+    def test_preparer_published_alternating_seconds(self):
+        preparer = MessagePreparer()
+        now = time.time()
+        dates = [preparer.published(now + offset) for offset in [0, 1, 0, 1]]
+        self.assertEqual(dates, [
+            rfc3339(datetime.datetime.utcfromtimestamp(int(now + offset)), utc=True, use_system_timezone=False)
+            for offset in [0, 1, 0, 1]])
@@ -0,0 +1,66 @@
+import unittest
+from maxcarrot.metrics import Metrics
+
+
+class MetricsTests(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.1, 1.0))
+
+    def test_counters(self):
+        self.metrics.inc('requests_total', method='GET')
+        self.metrics.inc('requests_total', 2, method='GET')
+        self.metrics.inc('requests_total', method='DELETE')
+        self.assertEqual(self.metrics.value('requests_total', method='GET'), 3)
+        self.assertEqual(self.metrics.value('requests_total', method='DELETE'), 1)
+        self.assertEqual(self.metrics.value('requests_total', method='POST'), 0)
+
+    def test_histograms(self):
+        self.metrics.observe('latency_seconds', 0.05)
+        self.metrics.observe('latency_seconds', 0.5)
+        self.metrics.observe('latency_seconds', 5)
+        histogram = self.metrics.histograms[('latency_seconds', ())]
+        self.assertEqual(histogram['buckets'], [1, 1, 1])
+        self.assertEqual(histogram['count'], 3)
+        self.assertAlmostEqual(histogram['sum'], 5.55)
+
+    def test_timed(self):
+        @self.metrics.timed('call_seconds', operation='test')
+        def call(value):
+            return value
+
+        self.assertEqual(call(1), 1)
+        self.assertEqual(self.metrics.value('call_seconds', operation='test'), 1)
+
+    def test_disabled(self):
+        self.metrics.enabled = False
+        self.metrics.inc('requests_total')
+        with self.metrics.timer('call_seconds'):
+            pass
+        self.assertEqual(self.metrics.counters, {})
+        self.assertEqual(self.metrics.histograms, {})
+
+    def test_sinks(self):
+        records = []
+        self.metrics.add_sink(lambda *record: records.append(record))
+        self.metrics.inc('requests_total', method='GET')
+        self.metrics.observe('latency_seconds', 0.5)
+        self.assertEqual(records, [
+            ('counter', 'requests_total', {'method': 'GET'}, 1),
+            ('histogram', 'latency_seconds', {}, 0.5)
+        ])
+
+    def test_exposition(self):
+        self.metrics.inc('requests_total', method='GET')
+        self.metrics.observe('latency_seconds', 0.5, endpoint='queues')
+        self.assertEqual(self.metrics.exposition().splitlines(), [
+            '# TYPE requests_total counter',
+            'requests_total{method="GET"} 1',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{endpoint="queues",le="0.1"} 0',
+            'latency_seconds_bucket{endpoint="queues",le="1.0"} 1',
+            'latency_seconds_bucket{endpoint="queues",le="+Inf"} 1',
+            'latency_seconds_sum{endpoint="queues"} 0.5',
+            'latency_seconds_count{endpoint="queues"} 1',
+        ])
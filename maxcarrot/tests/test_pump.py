@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from maxcarrot.metrics import Metrics
+from maxcarrot.pump import MessagePump
+
+import gevent
+import gevent.socket
+import unittest
+
+
+class SocketTransport(object):
+
+    def __init__(self, sock):
+        self._sock = sock
+
+
+class LineConnection(object):
+    """
+        Connection reading newline terminated frames from a socket,
+        with the attributes of a haigha connection used by the pump
+    """
+
+    def __init__(self, sock, heartbeat=None):
+        self.transport = SocketTransport(sock)
+        self.frames_read = 0
+        self.closed = False
+        self.heartbeats = 0
+        self._heartbeat = heartbeat
+
+    def read_frames(self):
+        data = self.transport._sock.recv(65536)
+        if not data:
+            self.transport_closed()
+            return
+        self.frames_read += data.count('\n')
+
+    def transport_closed(self, **kwargs):
+        self.transport = None
+
+    def channel(self, channel_id):
+        return self
+
+    def send_heartbeat(self):
+        self.heartbeats += 1
+
+
+class MessagePumpTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.pump = MessagePump(self.metrics)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def connect(self, heartbeat=None):
+        local, remote = gevent.socket.socketpair()
+        self.sockets.extend([local, remote])
+        connection = LineConnection(local, heartbeat)
+        self.pump.register(connection)
+        return connection, remote
+
+    def test_reads_frames_of_readable_connections(self):
+        """
+        Given a pump serving several connections
+        When frames arrive on some of them
+        Then the pump reads them, waking up once per batch of frames
+        """
+        connections = [self.connect() for num in range(10)]
+        gevent.sleep(0.01)
+
+        for connection, remote in connections[:3]:
+            remote.sendall('frame\n' * 5)
+        gevent.sleep(0.01)
+
+        self.assertEqual([connection.frames_read for connection, remote in connections], [5, 5, 5] + [0] * 7)
+        self.assertEqual(self.pump.stats['frames'], 15)
+        self.assertEqual(self.pump.stats['wakeups'], 1)
+        self.assertEqual(self.pump.stats['frames_per_wakeup'], 15.0)
+        self.assertEqual(self.metrics.value('maxcarrot_pump_frames_total'), 15)
+
+    def test_idle_connections_dont_wake_up_the_pump(self):
+        for num in range(100):
+            self.connect()
+        gevent.sleep(0.2)
+        self.assertEqual(self.pump.stats['wakeups'], 0)
+
+    def test_closed_connections_are_unregistered(self):
+        connection, remote = self.connect()
+        other, other_remote = self.connect()
+        remote.close()
+        gevent.sleep(0.01)
+
+        self.assertIsNone(connection.transport)
+        self.assertEqual(self.pump.stats['connections'], 1)
+
+        other_remote.sendall('frame\n')
+        gevent.sleep(0.01)
+        self.assertEqual(other.frames_read, 1)
+
+    def test_heartbeats(self):
+        """
+        Given a connection with heartbeats
+        When it stays idle
+        Then the pump sends heartbeats and closes it after two silent intervals
+        """
+        connection, remote = self.connect(heartbeat=0.05)
+        remote.sendall('frame\n')
+        gevent.sleep(0.06)
+        self.assertGreater(connection.heartbeats, 0)
+
+        gevent.sleep(0.1)
+        self.assertIsNone(connection.transport)
+        self.assertEqual(self.pump.stats['connections'], 0)
@@ -23,17 +23,21 @@ setup(name='maxcarrot',
       author_email='carles.bruguera@upcnet.es',
       url='https://github.com/UPCnet/maxcarrot',
       license='GPL',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks', 'benchmarks.*']),
       include_package_data=True,
       zip_safe=True,
       install_requires=requires,
       tests_require=requires + test_requires,
       test_suite="maxcarrot.tests",
       extras_require={
-          'test': []
+          'test': [],
+          'asyncio': ['trollius'],
+          'streaming': ['ijson'],
       },
 
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      maxcarrot-worker = maxcarrot.worker:main
       """,
       )